@@ -5,6 +5,7 @@ import hashlib
 
 from ckanext.dgu.drupalclient import DrupalClient, DrupalXmlRpcSetupError, \
      DrupalRequestError
+from ckanext.dgu.authentication.drupal_session_cache import DrupalSessionCache
 from xmlrpclib import ServerProxy
 
 log = logging.getLogger(__name__)
@@ -23,6 +24,9 @@ class DrupalAuthMiddleware(object):
         self.seconds_between_checking_drupal_cookie = int(minutes_between_checking_drupal_cookie) * 60
         # if that int() raises a ValueError then the app will not start
 
+        # None if disabled
+        self.session_cache = DrupalSessionCache.from_config(app_conf)
+
     def _parse_cookies(self, environ):
         is_ckan_cookie = [False]
         drupal_session_id = [False]
@@ -187,20 +191,21 @@ class DrupalAuthMiddleware(object):
         the equivalent CKAN user with properties copied from Drupal and log the
         person in with auth_tkt and its cookie.
         '''
-        if self.drupal_client is None:
-            self.drupal_client = DrupalClient()
-        # ask drupal for the drupal_user_id for this session
         try:
-            drupal_user_id = self.drupal_client.get_user_id_from_session_id(drupal_session_id)
+            if self.session_cache:
+                drupal_user_properties = \
+                    self.session_cache.get_user_properties(
+                        drupal_session_id, self._get_drupal_user_properties)
+            else:
+                drupal_user_properties = \
+                    self._get_drupal_user_properties(drupal_session_id)
         except DrupalRequestError, e:
             log.error('Error checking session with Drupal: %s', e)
             return
-        if not drupal_user_id:
+        if not drupal_user_properties:
             log.debug('Drupal said the session ID found in the cookie is not valid.')
             return
 
-        # ask drupal about this user
-        drupal_user_properties = self.drupal_client.get_user_properties(drupal_user_id)
         user_dict = DrupalUserMapping.drupal_user_to_ckan_user(
                 drupal_user_properties)
 
@@ -253,6 +258,19 @@ class DrupalAuthMiddleware(object):
         environ['REMOTE_USER'] = user.name
         log.debug('Set REMOTE_USER = %r', user.name)
 
+    def _get_drupal_user_properties(self, drupal_session_id):
+        '''Asks Drupal for the properties of the user logged in with the
+        session, returning None if the session is not valid.'''
+        if self.drupal_client is None:
+            self.drupal_client = DrupalClient()
+        # ask drupal for the drupal_user_id for this session
+        drupal_user_id = self.drupal_client.get_user_id_from_session_id(drupal_session_id)
+        if not drupal_user_id:
+            return None
+
+        # ask drupal about this user
+        return self.drupal_client.get_user_properties(drupal_user_id)
+
     def set_roles(self, user_name, drupal_roles):
         '''Sets CKAN user roles based on the drupal roles.
 
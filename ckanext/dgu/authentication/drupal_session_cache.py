@@ -0,0 +1,170 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class DrupalSessionCache(object):
+    '''Remembers what Drupal said about a session (the user's properties, or
+    None if the session is not valid), so that the XMLRPC calls to Drupal are
+    not made for every request that needs a login or recheck.
+
+    It is an in-process LRU, with a time-to-live for each entry. Invalid
+    sessions are remembered too, for negative_ttl seconds. Concurrent lookups
+    of the same session are done only once - other threads wait for the
+    first one's result.
+
+    Optionally the results are also shared between processes, via a beaker
+    cache (e.g. type 'file', 'dbm' or 'ext:database').
+
+    Sessions are keyed by a hash of the session ID, so the IDs are not kept.
+    '''
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=60,
+                 shared_cache=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.shared_cache = shared_cache
+        self._entries = OrderedDict()  # key: (expires, user_properties)
+        self._in_flight = {}  # key: threading.Event
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app_conf):
+        '''Creates the cache from the options in the [app:main] config:
+
+        drupal_session_cache_seconds - time to remember a session for
+            (default 300, 0 to disable the cache). Keep this well below
+            minutes_between_checking_drupal_cookie, so that the recheck
+            still spots users Drupal has logged out.
+        drupal_session_cache_negative_seconds - time to remember an invalid
+            session for (default 60)
+        drupal_session_cache_size - maximum number of sessions held in each
+            process (default 10000)
+        drupal_session_cache_type - beaker cache type to share results
+            between processes (default none). Needs
+            drupal_session_cache_data_dir (for file/dbm) or
+            drupal_session_cache_url (for ext:database / ext:memcached).
+        '''
+        app_conf = app_conf or {}
+        ttl = int(app_conf.get('drupal_session_cache_seconds', 300))
+        if not ttl:
+            return None
+        shared_cache = None
+        cache_type = app_conf.get('drupal_session_cache_type')
+        if cache_type:
+            from beaker.cache import CacheManager
+            options = {'type': cache_type}
+            for key in ('data_dir', 'url'):
+                value = app_conf.get('drupal_session_cache_%s' % key)
+                if value:
+                    options[key] = value
+            shared_cache = CacheManager(**options) \
+                .get_cache('dgu_drupal_sessions')
+        return cls(
+            max_size=int(app_conf.get('drupal_session_cache_size', 10000)),
+            ttl=ttl,
+            negative_ttl=int(app_conf.get(
+                'drupal_session_cache_negative_seconds', 60)),
+            shared_cache=shared_cache)
+
+    @staticmethod
+    def _key(session_id):
+        return hashlib.sha256(session_id).hexdigest()
+
+    def get_user_properties(self, session_id, lookup):
+        '''Returns the user properties for the Drupal session, from the cache
+        or by calling lookup(session_id), which should return the properties,
+        or None if the session is not valid. Exceptions from lookup are
+        raised and the result is not cached.
+        '''
+        key = self._key(session_id)
+        with self._lock:
+            user_properties = self._get_local(key)
+            if user_properties is not _missing:
+                return user_properties
+            event = self._in_flight.get(key)
+            if event is None:
+                self._in_flight[key] = event = threading.Event()
+                is_first = True
+            else:
+                is_first = False
+
+        if not is_first:
+            # another thread is asking Drupal about this session
+            event.wait(30)
+            with self._lock:
+                user_properties = self._get_local(key)
+            if user_properties is not _missing:
+                return user_properties
+            # it failed, so have a go ourselves
+            return lookup(session_id)
+
+        try:
+            entry = self._get_shared(key)
+            if entry is _missing:
+                user_properties = lookup(session_id)
+                ttl = self.ttl if user_properties else self.negative_ttl
+                entry = (time.time() + ttl, user_properties)
+                self._set_shared(key, entry)
+            with self._lock:
+                self._set_local(key, entry)
+            return entry[1]
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+
+    def invalidate(self, session_id):
+        key = self._key(session_id)
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.shared_cache is not None:
+            try:
+                self.shared_cache.remove_value(key)
+            except Exception, e:
+                log.warning('Could not remove Drupal session from shared '
+                            'cache: %s', e)
+
+    def _get_local(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return _missing
+        if entry[0] < time.time():
+            return _missing
+        # put it back at the most recently used end
+        self._entries[key] = entry
+        return entry[1]
+
+    def _set_local(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _get_shared(self, key):
+        if self.shared_cache is None:
+            return _missing
+        try:
+            entry = self.shared_cache.get(key)
+        except KeyError:
+            return _missing
+        except Exception, e:
+            log.warning('Could not read shared Drupal session cache: %s', e)
+            return _missing
+        if entry[0] < time.time():
+            return _missing
+        return entry
+
+    def _set_shared(self, key, entry):
+        if self.shared_cache is None:
+            return
+        try:
+            self.shared_cache.set_value(key, entry)
+        except Exception, e:
+            log.warning('Could not write shared Drupal session cache: %s', e)
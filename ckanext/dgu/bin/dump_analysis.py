@@ -47,6 +47,8 @@ OLD_THEMES = {
 THEMES = ('Society', 'Government Spending', 'Education', 'Crime & Justice', 'Environment', 'Towns & Cities', 'Mapping', 'Health', 'Government', 'Defence', 'Business & Economy', 'Transport')
 
 
+remove_id_regex = re.compile(' \[\d+\]')
+
 date_converters = (
     (re.compile('(\d{4})(\d{2})(\d{2})'), '%Y%m%d'),
     (re.compile('(\d{4})-(\d{2})-(\d{2})'), '%Y-%m-%d'),
@@ -224,10 +226,60 @@ class TxtAnalysisFile(AnalysisFile):
             fileobj.close()
         
 
+class PackageBins(object):
+    '''Counts packages into bins, keeping only a few example names for each
+    bin, so that memory use doesn't grow with the size of the dump.'''
+    def __init__(self, num_examples=1):
+        self.num_examples = num_examples
+        self.counts = defaultdict(int)
+        self.examples = defaultdict(list)
+
+    def add(self, bin, pkg_name):
+        self.counts[bin] += 1
+        if len(self.examples[bin]) < self.num_examples:
+            self.examples[bin].append(pkg_name)
+
+    def items(self):
+        return self.counts.items()
+
+
+def iter_json_values(f, chunk_size=64 * 1024):
+    '''Yields the values from a file containing either a JSON array or JSON
+    lines (or any whitespace separated JSON values), reading it a chunk at a
+    time. Only one value is parsed and held in memory at a time.'''
+    decoder = json.JSONDecoder()
+    buf = ''
+    eof = False
+    while True:
+        # skip whitespace and the array's brackets and commas
+        buf = buf.lstrip(' \t\r\n,[]')
+        if not buf:
+            if eof:
+                return
+            buf = f.read(chunk_size)
+            eof = not buf
+            continue
+        try:
+            value, end = decoder.raw_decode(buf)
+        except ValueError:
+            # the value is probably incomplete, so read more
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+            continue
+        yield value
+        buf = buf[end:]
+
+
 class DumpAnalysis(object):
     '''
     Reads a JSON dump file and runs analysis according to the options, and
     saves it in self.analysis_dict
+
+    The dump is streamed, with each package fed through all the enabled
+    analyses in a single pass, so memory use is constant.
     '''
     def __init__(self, dump_filepath, options):
         log.info('Analysing %s' % dump_filepath)
@@ -235,32 +287,48 @@ class DumpAnalysis(object):
         self.options = options
         self.run()
 
-    def run(self):
-        self.save_date()
-        self.analysis_dict = OrderedDict()
-        packages = self.get_packages()
-        packages = self.filter_out_deleted_packages(packages)
-        self.analysis_dict[total_label] = len(packages)
-
+    def get_analyses(self):
+        '''Returns the enabled analyses as a list of tuples:
+        (title, package filter function, bin function)'''
+        analyses = []
         if self.options.analyse_by_source:
-            pkg_bins = self.analyse_by_source(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by source: %s' % bin] = len(pkgs)
+            analyses.append(('Datasets by source', None, self.bin_by_source))
         if self.options.analyse_ons_by_published_by:
-            ons_packages = self.filter_by_ons_packages(packages)
-            pkg_bins = self.analyse_by_published_by(ons_packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['National Statistics Pub Hub by published_by: %s' % bin] = len(pkgs)
+            analyses.append(('National Statistics Pub Hub by published_by',
+                             self.is_ons_package, self.bin_by_published_by))
         if self.options.analyse_by_theme:
-            pkg_bins = self.analyse_by_theme(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by theme: %s' % bin] = len(pkgs)
+            analyses.append(('Datasets by theme', None, self.bin_by_theme))
         if self.options.analyse_by_unpublished:
-            pkg_bins = self.analyse_by_unpublished(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by unpublished: %s' % bin] = len(pkgs)
+            analyses.append(('Datasets by unpublished', None,
+                             self.bin_by_unpublished))
+        return analyses
+
+    def run(self):
+        self.save_date()
+        analyses = self.get_analyses()
+        num_examples = int(self.options.examples or 0)
+        pkg_bins_list = [PackageBins(num_examples) for analysis in analyses]
+        num_packages = num_deleted = 0
+        for pkg in self.iter_packages():
+            if not self.is_active_package(pkg):
+                num_deleted += 1
+                continue
+            num_packages += 1
+            for (title, filter_func, bin_func), pkg_bins in \
+                    zip(analyses, pkg_bins_list):
+                if filter_func and not filter_func(pkg):
+                    continue
+                pkg_bins.add(bin_func(pkg), pkg['name'])
+        log.info('Deleted datasets discarded: %i', num_deleted)
+        log.info('Number of active datsets: %i', num_packages)
 
-        self.print_analysis(pkg_bins)
+        self.analysis_dict = OrderedDict()
+        self.analysis_dict[total_label] = num_packages
+        for (title, filter_func, bin_func), pkg_bins in \
+                zip(analyses, pkg_bins_list):
+            for bin, count in pkg_bins.items():
+                self.analysis_dict['%s: %s' % (title, bin)] = count
+            self.print_analysis(title, pkg_bins)
 
     def save_date(self):
         try:
@@ -271,114 +339,103 @@ class DumpAnalysis(object):
         datestr = format_date(self.date) if self.date else None
         log.info('Date of dumpfile: %r', datestr)
 
-    def get_packages(self):
-        '''Returns the packages listed in the JSON dump file'''
+    def open_dump_file(self):
         if zipfile.is_zipfile(self.dump_filepath):
-            log.info('Unzipping...')
             zf = zipfile.ZipFile(self.dump_filepath)
             assert len(zf.infolist()) == 1, 'Archive must contain one file: %r' % zf.infolist()
-            f = zf.open(zf.namelist()[0])
-        elif self.dump_filepath.endswith('gz'):            
-            f = gzip.open(self.dump_filepath, 'rb')
+            return zf.open(zf.namelist()[0])
+        elif self.dump_filepath.endswith('gz'):
+            return gzip.open(self.dump_filepath, 'rb')
         else:
-            f = open(self.dump_filepath, 'rb')
-        log.info('Reading file...')
-        json_buf = f.read()
-        log.info('Parsing JSON...')
-        packages = json.loads(json_buf)
-        log.info('Read in packages: %i' % len(packages))
-        return packages
-
-    def filter_out_deleted_packages(self, packages):
-        filtered_pkgs = []
-        for pkg in packages:
-            if pkg.has_key('state'):
-                is_active = pkg['state'] == 'active'
-            else:
-                is_active = pkg['state_id'] == 1
-            if is_active:
-                filtered_pkgs.append(pkg)
-        log.info('Deleted datasets discarded: %i', (len(packages) - len(filtered_pkgs)))
-        log.info('Number of active datsets: %i', (len(filtered_pkgs)))
-        return filtered_pkgs
-
-    def filter_by_ons_packages(self, packages):
-        filtered_pkgs = []
-        ons_prefix = 'ONS'
-        for pkg in packages:
-            import_source = pkg['extras'].get('import_source')
-            if import_source and import_source.startswith(ons_prefix):
-                filtered_pkgs.append(pkg)
-        log.info('Number of Pub Hub packages: %i', (len(filtered_pkgs)))
-        return filtered_pkgs
-
-    def analyse_by_source(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            import_source = pkg['extras'].get('import_source')
-            if import_source:
-                for prefix in import_source_prefixes:
-                    if import_source.startswith(prefix):
-                        import_source = import_source_prefixes[prefix]
-                        break
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if pkg['extras'].get('UKLP') == 'True':
-                pkg_bins['UKLP'].append(pkg['name'])
-                continue
-            if (pkg.get('url') or '').startswith('http://www.data4nr.net/resources/'):
-                import_source = import_source_prefixes['DATA4NR']
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if pkg['extras'].get('co_id'):
-                import_source = import_source_prefixes['COSPREAD']
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if asbool(pkg['extras'].get('unpublished')):
-                import_source = unpublished
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            pkg_bins[manual_creation].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_published_by(self, packages):
-        pkg_bins = defaultdict(list)
-        remove_id_regex = re.compile(' \[\d+\]')
-        for pkg in packages:
-            published_by = pkg['extras'].get('published_by')
-            published_by = remove_id_regex.sub('', published_by)
-            if published_by:
-                pkg_bins[published_by].append(pkg['name'])
-                continue
-            pkg_bins['No value'].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_theme(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            theme = pkg['extras'].get('theme-primary')
-            if (not theme) or (not theme.strip()):
-                pkg_bins['No value'].append(pkg['name'])
-                continue
-            # Fix old names for themes so they are consistent
-            if theme in OLD_THEMES:
-                theme = OLD_THEMES[theme]
-            if theme not in THEMES:
-                theme = 'Other: %s' % theme
-            pkg_bins[theme].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_unpublished(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            unpublished = pkg['extras'].get('unpublished')
-            pkg_bins[asbool(unpublished)].append(pkg['name'])
-        return pkg_bins
-
-    def print_analysis(self, pkg_bins):
-        log.info('* Analysis by source *')
-        for pkg_bin, pkgs in sorted(pkg_bins.items(), key=lambda (pkg_bin, pkgs): -len(pkgs)):
-            log.info('  %s: %i (e.g. %r)', pkg_bin, len(pkgs), pkgs[:int(self.options.examples)])
+            return open(self.dump_filepath, 'rb')
+
+    def iter_packages(self):
+        '''Yields the packages in the dump file, which may be a JSON array
+        (e.g. the .json dump) or JSON lines (e.g. the v2.jsonl dump).
+        The extras are always given as a dict.'''
+        f = self.open_dump_file()
+        count = 0
+        try:
+            for pkg in iter_json_values(f):
+                if isinstance(pkg.get('extras'), list):
+                    # ckanapi dumps list the extras as key/value dicts
+                    pkg['extras'] = dict((extra['key'], extra['value'])
+                                         for extra in pkg['extras'])
+                count += 1
+                yield pkg
+        finally:
+            f.close()
+        log.info('Read in packages: %i' % count)
+
+    def get_packages(self):
+        '''Returns the packages listed in the JSON dump file'''
+        return list(self.iter_packages())
+
+    @staticmethod
+    def is_active_package(pkg):
+        if pkg.has_key('state'):
+            return pkg['state'] == 'active'
+        return pkg['state_id'] == 1
+
+    @staticmethod
+    def is_ons_package(pkg):
+        import_source = pkg['extras'].get('import_source')
+        return bool(import_source and import_source.startswith('ONS'))
+
+    @staticmethod
+    def bin_by_source(pkg):
+        import_source = pkg['extras'].get('import_source')
+        if import_source:
+            for prefix in import_source_prefixes:
+                if import_source.startswith(prefix):
+                    return import_source_prefixes[prefix]
+            return import_source
+        if pkg['extras'].get('UKLP') == 'True':
+            return 'UKLP'
+        if (pkg.get('url') or '').startswith('http://www.data4nr.net/resources/'):
+            return import_source_prefixes['DATA4NR']
+        if pkg['extras'].get('co_id'):
+            return import_source_prefixes['COSPREAD']
+        if asbool(pkg['extras'].get('unpublished')):
+            return unpublished
+        return manual_creation
+
+    @staticmethod
+    def bin_by_published_by(pkg):
+        published_by = pkg['extras'].get('published_by')
+        published_by = remove_id_regex.sub('', published_by or '')
+        return published_by or 'No value'
+
+    @staticmethod
+    def bin_by_theme(pkg):
+        theme = pkg['extras'].get('theme-primary')
+        if (not theme) or (not theme.strip()):
+            return 'No value'
+        # Fix old names for themes so they are consistent
+        if theme in OLD_THEMES:
+            theme = OLD_THEMES[theme]
+        if theme not in THEMES:
+            theme = 'Other: %s' % theme
+        return theme
+
+    @staticmethod
+    def bin_by_unpublished(pkg):
+        return asbool(pkg['extras'].get('unpublished'))
+
+    def print_analysis(self, title, pkg_bins):
+        log.info('* %s *', title)
+        for pkg_bin, count in sorted(pkg_bins.items(), key=lambda (pkg_bin, count): -count):
+            log.info('  %s: %i (e.g. %r)', pkg_bin, count, pkg_bins.examples[pkg_bin])
+
+
+def analyse_dump(args):
+    '''Runs DumpAnalysis on a dump file, returning (date, analysis_dict).
+    A module-level function so that it can be run in a multiprocessing
+    Pool.'''
+    dump_filepath, options = args
+    analysis = DumpAnalysis(dump_filepath, options)
+    return analysis.date, analysis.analysis_dict
+
 
 class Command(command.Command):
     usage = 'usage: %prog [options] dumpfile.json.zip'
@@ -404,6 +461,10 @@ class Command(command.Command):
                                action="store_true")
         self.parser.add_option('--analyse-by-unpublished', dest='analyse_by_unpublished',
                                action="store_true")
+        self.parser.add_option('--processes', dest='processes',
+                               default='1',
+                               help='analyse NUMBER of dump files in parallel',
+                               metavar='NUMBER')
 
     def parse_args(self):
         super(Command, self).parse_args()
@@ -431,19 +492,33 @@ class Command(command.Command):
             if output_filepath:
                 analysis_files[analysis_file_class] = analysis_file_class(output_filepath, run_info)
 
-        for input_filepath in input_filepaths:
-            # Run analysis
-            analysis = DumpAnalysis(input_filepath, self.options)
+        # Run analysis
+        jobs = [(input_filepath, self.options)
+                for input_filepath in input_filepaths]
+        processes = int(self.options.processes)
+        if processes > 1 and len(jobs) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap(analyse_dump, jobs)
+        else:
+            pool = None
+            results = (analyse_dump(job) for job in jobs)
 
+        for input_filepath, (date, analysis_dict) in \
+                zip(input_filepaths, results):
             if analysis_files:
-                assert analysis.date, 'The results are requested to be saved to '
+                assert date, 'The results are requested to be saved to '
                 'an analysis file which is sorted by date, but could not find '
                 'a date in the input filename: %s' % input_filepath
 
             for analysis_file_class, analysis_file in analysis_files.items():
-                analysis_file.add_analysis(analysis.date, analysis.analysis_dict)
-                # Save
-                analysis_file.save()
+                analysis_file.add_analysis(date, analysis_dict)
+        # Save
+        for analysis_file in analysis_files.values():
+            analysis_file.save()
+        if pool:
+            pool.close()
+            pool.join()
         log.info('Finished')
 
 def command():
@@ -36,6 +36,7 @@ def command(config_file):
                                DumpAnalysis)
 
     from pylons import config
+    from paste.deploy.converters import asbool
 
     # settings
     ckan_instance_name = os.path.basename(config_file).replace('.ini', '')
@@ -202,20 +203,34 @@ def command(config_file):
         dump_filepath = os.path.join(dump_dir, dump_file_base + '.csv.zip')
 
         log.info('Creating CSV files: %s' % dump_filepath)
-        dumpobj = dgu_dumper.CSVDumper()
-        dumpobj.dump()
+        dump_csv_bulk = asbool(config.get('dgu.dump_csv.bulk', False))
+        dump_csv_processes = int(config.get('dgu.dump_csv.processes', 1))
+        dump_csv_state_filepath = config.get('dgu.dump_csv.incremental_state')
+        if dump_csv_state_filepath:
+            # Only the datasets changed since the last run are dumped, and
+            # they are also written to a delta file
+            delta_filepath = os.path.join(
+                dump_dir, dump_file_base + '.csv-delta.zip')
+            log.info('Incremental dump, with delta: %s', delta_filepath)
+            dgu_dumper.IncrementalCSVDump(
+                os.path.expanduser(dump_csv_state_filepath))\
+                .dump(dump_filepath, delta_filepath)
+            dataset_file = resource_file = None
+        else:
+            dumpobj = dgu_dumper.CSVDumper()
+            dumpobj.dump(bulk=dump_csv_bulk, processes=dump_csv_processes)
 
-        dataset_file, resource_file = dumpobj.close()
+            dataset_file, resource_file = dumpobj.close()
 
-        log.info('Dumped datasets file is %dMb in size' % (
-            os.path.getsize(dataset_file) / (1024 * 1024)))
-        log.info('Dumped resources file is %dMb in size' % (
-            os.path.getsize(resource_file) / (1024 * 1024)))
+            log.info('Dumped datasets file is %dMb in size' % (
+                os.path.getsize(dataset_file) / (1024 * 1024)))
+            log.info('Dumped resources file is %dMb in size' % (
+                os.path.getsize(resource_file) / (1024 * 1024)))
 
-        dump_file = zipfile.ZipFile(dump_filepath, 'w', zipfile.ZIP_DEFLATED)
-        dump_file.write(dataset_file, "datasets.csv")
-        dump_file.write(resource_file, "resources.csv")
-        dump_file.close()
+            dump_file = zipfile.ZipFile(dump_filepath, 'w', zipfile.ZIP_DEFLATED)
+            dump_file.write(dataset_file, "datasets.csv")
+            dump_file.write(resource_file, "resources.csv")
+            dump_file.close()
 
         link_filepath = os.path.join(
             dump_dir, 'data.gov.uk-ckan-meta-data-latest.csv.zip')
@@ -223,63 +238,71 @@ def command(config_file):
         if os.path.exists(link_filepath):
             os.unlink(link_filepath)
         os.symlink(dump_filepath, link_filepath)
-        os.remove(dataset_file)
-        os.remove(resource_file)
+        if dataset_file:
+            os.remove(dataset_file)
+            os.remove(resource_file)
 
     def dump_datasets(file_type, dumper_func, dumper_type, dump_dir,
                       *dumper_args, **dumper_kwargs):
         '''
-        Runs the dump, outputing to a tempfile, zips it in correct place,
-        adds 'current' symlink.
+        Runs the dump, compressing it into zip and gz (plus any formats in
+        dgu.dump.extra_compression) in one pass, writes them into place
+        atomically and then updates the 'latest' symlinks.
 
         dumper_func params depend on dumper_type:
-         1: (file object, Package query)
-         2: ckanapi.cli.dump.dump_things
+         1: (file object, Package query) - the dump is compressed as it is
+            written, without a temporary file
+         2: ckanapi.cli.dump.dump_things - this writes to a temporary file,
+            which is then read once
         '''
-        import gzip
-        import shutil
+        from ckanext.dgu.lib.compress import MultiCompressor, replace_symlink
         dump_file_base = start_time.strftime(dump_filebase)
         dump_filename = '%s.%s' % (dump_file_base, file_type)
-        zip_filepath = os.path.join(dump_dir, dump_filename + '.zip')
-        gz_filepath = os.path.join(dump_dir, dump_filename + '.gz')
-        log.info('Creating %s dump: %s', file_type, tmp_filepath)
-        # Dump the data to a temporary file
-        if dumper_type == 1:
-            tmp_file = open(tmp_filepath, 'w+b')
-            query = model.Session.query(model.Package) \
-                .filter(model.Package.state == 'active')
-            dumper_func(tmp_file, query)
-            tmp_file.close()
-        elif dumper_type == 2:
-            dumper_args[2]['--output'] = tmp_filepath
-            dumper_func(*dumper_args, **dumper_kwargs)
+        filepaths_by_format = {}
+        for extension in ['zip', 'gz'] + \
+                config.get('dgu.dump.extra_compression', '').split():
+            if extension == 'xz':
+                try:
+                    from backports import lzma
+                except ImportError:
+                    log.warning('Cannot create xz dump - install '
+                                'backports.lzma')
+                    continue
+            filepaths_by_format[extension] = os.path.join(
+                dump_dir, '%s.%s' % (dump_filename, extension))
+        log.info('Creating %s dump: %s', file_type,
+                 ' '.join(sorted(filepaths_by_format.values())))
+        compressor = MultiCompressor(filepaths_by_format, dump_filename)
         try:
-            log.info('Dumped data file is %dMB in size' %
-                     (os.path.getsize(tmp_filepath) / (1024 * 1024)))
-            # Create zip and gz versions
-            log.info('Zipping dump to: %s & %s' % (zip_filepath, gz_filepath))
-            zip_file = zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED)
-            zip_file.write(tmp_filepath, dump_filename)
-            zip_file.close()
-            with open(tmp_filepath, 'rb') as f_in, \
-                    gzip.open(gz_filepath, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-
-            # Setup a symbolic link to dumps from
-            # data.gov.uk-ckan-meta-data-latest.{0}.zip so that it is up-to-date
-            # with the latest version for both JSON and CSV.
-            for dump_filepath, extension in ((zip_filepath, 'zip'),
-                                             (gz_filepath, 'gz')):
-                link_filepath = os.path.join(
-                    dump_dir,
-                    'data.gov.uk-ckan-meta-data-latest.{0}.{1}'.format(
-                        file_type, extension))
-
-                if os.path.lexists(link_filepath):
-                    os.unlink(link_filepath)
-                os.symlink(dump_filepath, link_filepath)
-        finally:
-            os.remove(tmp_filepath)
+            if dumper_type == 1:
+                query = model.Session.query(model.Package) \
+                    .filter(model.Package.state == 'active')
+                dumper_func(compressor, query)
+            elif dumper_type == 2:
+                dumper_args[2]['--output'] = tmp_filepath
+                try:
+                    dumper_func(*dumper_args, **dumper_kwargs)
+                    compressor.write_from_file(tmp_filepath)
+                finally:
+                    if os.path.exists(tmp_filepath):
+                        os.remove(tmp_filepath)
+        except:
+            # don't publish a truncated dump
+            compressor.abort()
+            raise
+        compressor.close()
+        log.info('Dumped data is %dMB in size' %
+                 (compressor.size / (1024 * 1024)))
+
+        # Setup a symbolic link to dumps from
+        # data.gov.uk-ckan-meta-data-latest.{0}.zip so that it is up-to-date
+        # with the latest version for both JSON and CSV.
+        for extension, dump_filepath in filepaths_by_format.items():
+            link_filepath = os.path.join(
+                dump_dir,
+                'data.gov.uk-ckan-meta-data-latest.{0}.{1}'.format(
+                    file_type, extension))
+            replace_symlink(dump_filepath, link_filepath)
 
     if run_task('dump-csv-unpublished'):
         log.info('Creating database dumps - CSV unpublished')
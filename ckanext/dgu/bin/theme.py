@@ -1,6 +1,7 @@
 from optparse import OptionParser
 from collections import defaultdict
 import logging
+import sys
 
 from sqlalchemy import or_, not_
 import nltk
@@ -10,6 +11,10 @@ from running_stats import StatsList
 
 # NB put no CKAN imports here, or logging breaks
 
+# Where progress messages are printed. suggest writes its JSON lines to stdout,
+# so for it they go to stderr.
+status_output = sys.stdout
+
 def learn(options):
     '''Analyse datasets that are already categorise to find out which words
     associate with which theme.
@@ -173,7 +178,63 @@ def recategorize(options):
     if options.write:
         write_themes(themes_to_write)
 
-def get_packages(publisher=None, theme=None, uncategorized=False, limit=None):
+def suggest(options):
+    '''Suggests themes for many datasets, loading them in bulk and scoring
+    them across processes. Writes a line of JSON per dataset to the output
+    and, with --write, sets the themes of datasets whose suggested primary
+    theme is different to their current one.
+    '''
+    import json
+    from ckanext.dgu.lib.theme import (categorize_packages, theme_suggestion,
+                                       write_themes_in_bulk, PRIMARY_THEME)
+
+    stats = StatsList()
+    stats.report_value_limit = 1000
+
+    if options.dataset:
+        pkg = model.Package.get(options.dataset)
+        assert pkg
+        package_ids = [pkg.id]
+    else:
+        package_ids = get_packages(publisher=options.publisher,
+                                   theme=None,
+                                   uncategorized=options.uncategorized,
+                                   limit=options.limit,
+                                   ids_only=True)
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    themes_to_write = {}  # pkg_id:themes
+    try:
+        for pkg_dict, themes in categorize_packages(
+                package_ids, processes=int(options.processes or 1)):
+            existing_theme = pkg_dict['extras'].get(PRIMARY_THEME)
+            result = theme_suggestion(themes)
+            result['id'] = pkg_dict['id']
+            result['name'] = pkg_dict['name']
+            result['current-theme'] = existing_theme
+            output.write(json.dumps(result) + '\n')
+            pkg_identity = '%s (%s)' % (pkg_dict['name'], existing_theme)
+            if not themes:
+                stats.add('Cannot decide theme', pkg_identity)
+            elif existing_theme == themes[0]['name']:
+                stats.add('Theme unchanged %s' % themes[0]['name'],
+                          pkg_identity)
+            else:
+                stats.add('Recategorized to %s' % themes[0]['name'],
+                          pkg_identity)
+                themes_to_write[pkg_dict['id']] = themes
+    finally:
+        if options.output:
+            output.close()
+
+    print >> sys.stderr, 'Suggest summary:'
+    print >> sys.stderr, stats.report()
+
+    if options.write:
+        write_themes_in_bulk(themes_to_write)
+
+def get_packages(publisher=None, theme=None, uncategorized=False, limit=None,
+                 ids_only=False):
     from ckan import model
     from ckanext.dgu.lib.theme import PRIMARY_THEME, Themes
     packages = model.Session.query(model.Package) \
@@ -199,7 +260,6 @@ def get_packages(publisher=None, theme=None, uncategorized=False, limit=None):
         valid_themes = Themes.instance().data.keys()
         packages = packages.outerjoin(themes, themes.c.package_id==model.Package.id) \
                             .filter(not_(themes.c.value.in_(valid_themes)))
-        import pdb; pdb.set_trace()
     elif theme:
         # only packages of a particular theme
         packages = packages.join(model.PackageExtra) \
@@ -221,8 +281,12 @@ def get_packages(publisher=None, theme=None, uncategorized=False, limit=None):
     total_count = packages.count()
     if limit is not None:
         packages = packages.limit(int(limit))
-    packages = packages.all()
-    print 'Datasets: %s/%s' % (len(packages), total_count)
+    if ids_only:
+        packages = [row[0] for row in
+                    packages.with_entities(model.Package.id)]
+    else:
+        packages = packages.all()
+    print >> status_output, 'Datasets: %s/%s' % (len(packages), total_count)
     return packages
 
 
@@ -234,7 +298,9 @@ Commands:
     learn - look at datasets already with themes and show the key words
     test - try categorizing datasets that already have themes to see how well it does
     categorize - categorize datasets without themes
-    recategorize - recategorize datasets"""
+    recategorize - recategorize datasets
+    suggest - suggest themes for datasets in bulk, as JSON lines (and write
+              them with -w)"""
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--dataset', dest='dataset')
     parser.add_option('-p', '--publisher', dest='publisher')
@@ -247,17 +313,25 @@ Commands:
                       action="store_true", dest="write",
                       help="write the theme to the datasets")
     parser.add_option('--limit', dest='limit')
+    parser.add_option('--processes', dest='processes', default='1',
+                      help='Number of processes to score datasets with '
+                      '(for suggest command only)')
+    parser.add_option('-o', '--output', dest='output',
+                      help='File to write the JSON lines to, instead of '
+                      'stdout (for suggest command only)')
     (options, args) = parser.parse_args()
     if len(args) != 2:
         parser.error('Wrong number of arguments (%i)' % len(args))
     config_ini, command = args
-    commands = ('learn', 'test', 'categorize', 'recategorize')
+    commands = ('learn', 'test', 'categorize', 'recategorize', 'suggest')
     if command not in commands:
         parser.error('Command %s should be one of: %s' % (command, commands))
-    print 'Loading CKAN config...'
+    if command == 'suggest':
+        status_output = sys.stderr
+    print >> status_output, 'Loading CKAN config...'
     common.load_config(config_ini)
     common.register_translator()
-    print 'Done'
+    print >> status_output, 'Done'
     # Setup logging to print debug out for theme stuff only
     rootLogger = logging.getLogger()
     rootLogger.setLevel(logging.WARNING)
@@ -276,5 +350,7 @@ Commands:
         categorize(options)
     elif command == 'recategorize':
         recategorize(options)
+    elif command == 'suggest':
+        suggest(options)
     else:
         raise NotImplemented()
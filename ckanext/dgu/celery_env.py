@@ -0,0 +1,129 @@
+'''
+The CKAN environment for celery tasks that need it (e.g. the gemini
+post-processing). It is loaded once per worker process, rather than for
+every task, and is loaded when the worker process starts if the ini file is
+known then (paster celeryd sets CKAN_CONFIG).
+'''
+import os
+import time
+import logging
+import threading
+
+from celery import signals
+
+from ckan.lib.celery_app import celery
+
+log = logging.getLogger(__name__)
+
+_environment = {'config_filepath': None, 'loaded_at': None, 'pid': None,
+                'tasks_run': 0}
+_lock = threading.Lock()
+_thread_local = threading.local()
+
+
+def load_environment(ckan_ini_filepath):
+    '''Makes sure the CKAN environment for the ini file is loaded in this
+    process, and a translator is registered in this thread. Does nothing if
+    they are already.'''
+    config_filepath = os.path.abspath(ckan_ini_filepath)
+    with _lock:
+        if _environment['config_filepath'] != config_filepath or \
+                _environment['pid'] != os.getpid():
+            if _environment['config_filepath'] and \
+                    _environment['config_filepath'] != config_filepath:
+                log.warning('Reloading CKAN environment for a different '
+                            'config: %s (was %s)', config_filepath,
+                            _environment['config_filepath'])
+            _load_config(config_filepath)
+            _environment.update(config_filepath=config_filepath,
+                                loaded_at=time.time(), pid=os.getpid())
+            _thread_local.translator_registered = False
+    if not getattr(_thread_local, 'translator_registered', False):
+        _register_translator()
+        _thread_local.translator_registered = True
+
+
+def _load_config(config_filepath):
+    import paste.deploy
+    log.info('Loading CKAN environment: %s', config_filepath)
+    conf = paste.deploy.appconfig('config:' + config_filepath)
+    import ckan.config.environment
+    ckan.config.environment.load_environment(conf.global_conf,
+                                             conf.local_conf)
+
+
+def _register_translator():
+    # Register a translator in this thread so that
+    # the _() functions in logic layer can work
+    from paste.registry import Registry
+    from pylons import translator
+    from ckan.lib.cli import MockTranslator
+    registry = Registry()
+    registry.prepare()
+    _thread_local.registry = registry
+    registry.register(translator, MockTranslator())
+
+
+def is_loaded():
+    return _environment['config_filepath'] is not None and \
+        _environment['pid'] == os.getpid()
+
+
+@signals.worker_process_init.connect
+def _worker_process_init(**kwargs):
+    '''Loads the environment as each worker process starts, so the first
+    task doesn't have to.'''
+    if _environment['config_filepath']:
+        # inherited from the parent process, so the db connections must not
+        # be shared
+        from ckan import model
+        model.meta.engine.dispose()
+    config_filepath = os.environ.get('CKAN_CONFIG')
+    if config_filepath and os.path.exists(config_filepath):
+        try:
+            load_environment(config_filepath)
+        except Exception:
+            log.exception('Could not load the CKAN environment at worker '
+                          'start - tasks will try again')
+
+
+@signals.task_postrun.connect
+def _task_postrun(**kwargs):
+    '''Tidies up after each task, as the environment outlives it.'''
+    if not is_loaded():
+        return
+    with _lock:
+        _environment['tasks_run'] += 1
+    from ckan import model
+    model.Session.remove()
+
+
+def health_check():
+    '''Returns the state of this worker process's CKAN environment and
+    whether it can reach the database.'''
+    status = {'pid': os.getpid(),
+              'config_filepath': _environment['config_filepath'],
+              'loaded': is_loaded(),
+              'loaded_seconds_ago': (time.time() - _environment['loaded_at']
+                                     if is_loaded() else None),
+              'tasks_run': _environment['tasks_run'],
+              'database': None}
+    if is_loaded():
+        from ckan import model
+        try:
+            model.Session.execute('SELECT 1').scalar()
+            status['database'] = 'ok'
+        except Exception, e:
+            status['database'] = 'error: %s' % e
+        finally:
+            model.Session.remove()
+    return status
+
+
+@celery.task(name='dgu.health_check')
+def health_check_task(ckan_ini_filepath=None):
+    '''Reports the health_check of the worker that runs it, loading the
+    environment first if given the ini file.'''
+    if ckan_ini_filepath:
+        load_environment(ckan_ini_filepath)
+    return health_check()
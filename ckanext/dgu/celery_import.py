@@ -1,4 +1,5 @@
 def task_imports():
   return ['ckanext.dgu.tasks',
           'ckanext.dgu.gemini_postprocess_tasks',
+          'ckanext.dgu.celery_env',
           ]
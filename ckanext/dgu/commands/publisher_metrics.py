@@ -0,0 +1,84 @@
+import datetime
+import logging
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+log = logging.getLogger(__name__)
+
+
+class PublisherMetricsCommand(CkanCommand):
+    """Keeps the publisher_metrics table (for the publisher page traffic
+    lights) up to date
+
+    Usage:
+      publisher_metrics init
+        - create the table
+      publisher_metrics update [publisher_name ...]
+        - recalculate the metrics of publishers that have changed since the
+          last update, plus any older than dgu.publisher_metrics.max_age
+          hours (default 24, so that the issue ages move on). Or just those
+          of the publishers listed.
+
+    The first update (or one with --all) calculates every publisher. Run the
+    update regularly from cron e.g. hourly.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = None
+    min_args = 1
+
+    def __init__(self, name):
+        super(PublisherMetricsCommand, self).__init__(name)
+        self.parser.add_option('--all', dest='all', action='store_true',
+                               default=False,
+                               help='Recalculate all publishers')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'init':
+            self.init()
+        elif cmd == 'update':
+            self.update(self.args[1:])
+        else:
+            self.parser.error('Command not recognized: %s' % cmd)
+
+    def init(self):
+        from ckan import model
+        import ckanext.dgu.model.publisher_metrics as pm_model
+        pm_model.init_tables(model.meta.engine)
+        log.info('Publisher metrics table is setup')
+
+    def update(self, publisher_names):
+        from pylons import config
+        from ckan import model
+        from ckanext.dgu.lib import publisher as publib
+        import ckanext.dgu.model.publisher_metrics as pm_model
+
+        started = datetime.datetime.utcnow()
+        if publisher_names:
+            publisher_ids = set()
+            for name in publisher_names:
+                publisher = model.Group.get(name)
+                if not publisher:
+                    self.parser.error('Publisher not found: %s' % name)
+                publisher_ids.add(publisher.id)
+        elif self.options.all:
+            publisher_ids = set(row[0] for row in
+                                model.Session.query(model.Group.id)
+                                .filter(model.Group.type == 'organization')
+                                .filter(model.Group.state == 'active'))
+        else:
+            max_age = datetime.timedelta(hours=int(
+                config.get('dgu.publisher_metrics.max_age', 24)))
+            publisher_ids = publib.publishers_needing_metrics_update(
+                pm_model.get_last_update(), max_age)
+
+        publib.update_publisher_metrics(publisher_ids)
+        model.Session.commit()
+        if not publisher_names:
+            # only an update of all that need it moves the watermark on
+            pm_model.set_last_update(started)
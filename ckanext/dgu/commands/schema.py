@@ -213,6 +213,7 @@ class Schema(CkanCommand):
             # Print JSONL with ids, in case you want to save with IDs
             print json.dumps(schema_obj.as_dict())
         model.Session.remove()
+        Schema.invalidate_cache()
 
     def import_codelists(self, codelist_filepath):
         from ckan import model
@@ -245,6 +246,7 @@ class Schema(CkanCommand):
             # Print JSONL with ids, in case you want to save with IDs
             print json.dumps(codelist_obj.as_dict())
         model.Session.remove()
+        Codelist.invalidate_cache()
 
     def patch_datasets(self, patch_filepath):
         import ckanapi
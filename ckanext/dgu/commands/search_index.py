@@ -0,0 +1,173 @@
+import logging
+import os
+import time
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+log = logging.getLogger(__name__)
+
+
+class SearchIndex(CkanCommand):
+    """Rebuilds the search index for datasets, in chunks across processes
+
+    Usage:
+      search_index rebuild [dataset_name_or_id ...]
+        - reindex all active datasets (or just the ones listed)
+
+    Each worker process takes a chunk of datasets, prefetches the DGU
+    enrichment data for the whole chunk (see SearchIndexing.prefetch) and
+    commits to Solr once per chunk.
+
+    With --checkpoint, the ids of datasets indexed successfully in completed
+    chunks are appended to the file, and those datasets are skipped when the
+    command is run again with the same checkpoint file, so an interrupted
+    rebuild can be resumed and failed datasets are retried.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = None
+    min_args = 1
+
+    def __init__(self, name):
+        super(SearchIndex, self).__init__(name)
+        self.parser.add_option('-w', '--workers', dest='workers', type='int',
+                               default=4,
+                               help='Number of worker processes')
+        self.parser.add_option('-s', '--chunk-size', dest='chunk_size',
+                               type='int', default=200,
+                               help='Number of datasets per chunk')
+        self.parser.add_option('--checkpoint', dest='checkpoint',
+                               help='File recording completed datasets, '
+                               'for resuming')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'rebuild':
+            self.rebuild(self.args[1:])
+        else:
+            self.parser.error('Command not recognized: %s' % cmd)
+
+    def rebuild(self, dataset_refs):
+        from multiprocessing import Pool
+        from ckan import model
+
+        package_ids = remaining_package_ids(get_package_ids(dataset_refs),
+                                            self.options.checkpoint)
+        chunks = list(chunk_list(package_ids, self.options.chunk_size))
+        log.info('Indexing %s datasets in %s chunks with %s workers',
+                 len(package_ids), len(chunks), self.options.workers)
+
+        # DB connections must not be shared with the forked workers
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        start = time.time()
+        num_indexed = 0
+        pool = Pool(self.options.workers, initializer=init_worker)
+        try:
+            for indexed_ids, errors in pool.imap_unordered(index_chunk,
+                                                            chunks):
+                num_indexed += len(indexed_ids) + len(errors)
+                for package_id, error in errors:
+                    log.error('Error indexing %s: %s', package_id, error)
+                # failed datasets are left out, so a resumed run retries them
+                write_checkpoint(self.options.checkpoint, indexed_ids)
+                elapsed = time.time() - start
+                log.info('Indexed %s/%s datasets (%.1f/s)',
+                         num_indexed, len(package_ids),
+                         num_indexed / elapsed if elapsed else 0)
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        log.info('Finished indexing %s datasets in %.0fs',
+                 num_indexed, time.time() - start)
+
+
+def get_package_ids(dataset_refs):
+    from ckan import model
+    if dataset_refs:
+        package_ids = []
+        for ref in dataset_refs:
+            pkg = model.Package.get(ref)
+            assert pkg, 'Dataset not found: %s' % ref
+            package_ids.append(pkg.id)
+        return package_ids
+    q = model.Session.query(model.Package.id) \
+             .filter(model.Package.state == 'active') \
+             .order_by(model.Package.id)
+    return [row[0] for row in q]
+
+
+def chunk_list(items, chunk_size):
+    for i in xrange(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def remaining_package_ids(package_ids, checkpoint_filepath):
+    '''Returns the package_ids that are not recorded in the checkpoint file
+    as already indexed.'''
+    done_ids = read_checkpoint(checkpoint_filepath)
+    if not done_ids:
+        return package_ids
+    log.info('Skipping %s datasets already in the checkpoint', len(done_ids))
+    return [id_ for id_ in package_ids if id_ not in done_ids]
+
+
+def read_checkpoint(checkpoint_filepath):
+    if not checkpoint_filepath or not os.path.exists(checkpoint_filepath):
+        return set()
+    with open(checkpoint_filepath) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def write_checkpoint(checkpoint_filepath, package_ids):
+    if not checkpoint_filepath:
+        return
+    with open(checkpoint_filepath, 'a') as f:
+        for package_id in package_ids:
+            f.write(package_id + '\n')
+
+
+def init_worker():
+    from ckan import model
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def index_chunk(package_ids):
+    '''Indexes a chunk of datasets in a worker process. Returns the ids of
+    the datasets that were indexed and a list of (package_id, error message)
+    for any that failed.'''
+    from ckan import model
+    from ckan.lib.search import index_for
+    from ckan.logic import get_action
+    from ckanext.dgu.search_indexing import SearchIndexing
+
+    package_index = index_for(model.Package)
+    indexed_ids = []
+    errors = []
+    SearchIndexing.prefetch(package_ids)
+    try:
+        for package_id in package_ids:
+            context = {'model': model, 'session': model.Session,
+                       'ignore_auth': True, 'validate': False,
+                       'use_cache': False}
+            try:
+                pkg_dict = get_action('package_show')(context,
+                                                      {'id': package_id})
+                package_index.update_dict(pkg_dict, defer_commit=True)
+                indexed_ids.append(package_id)
+            except Exception, e:
+                errors.append((package_id, '%s: %s' % (type(e).__name__, e)))
+        package_index.commit()
+    finally:
+        SearchIndexing.clear_prefetch()
+        model.Session.remove()
+    return indexed_ids, errors
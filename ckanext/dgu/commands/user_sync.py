@@ -1,3 +1,4 @@
+import os
 import logging
 
 from ckan.lib.cli import CkanCommand
@@ -10,6 +11,12 @@ stats = StatsList()
 class UserSync(CkanCommand):
     """
     Syncs the CKAN user details with the master copy in Drupal
+
+    Drupal is asked about the users concurrently (--threads) and the changes
+    are written in batches (--batch-size). With --checkpoint, the Drupal ID
+    of the last user in each written batch is saved to the file, so that an
+    interrupted sync can be run again and carry on where it left off. The
+    file is deleted when the sync completes.
     """
     summary = __doc__.strip().split('\n')[0]
     usage = '\n' + __doc__
@@ -25,63 +32,143 @@ class UserSync(CkanCommand):
         self.parser.add_option('-w', '--write',
                                dest='write', action='store_true',
                                help='Write the changes to the db')
+        self.parser.add_option('--threads',
+                               dest='threads', type='int', default=10,
+                               help='Number of concurrent requests to Drupal '
+                                    '(default 10)')
+        self.parser.add_option('--batch-size',
+                               dest='batch_size', type='int', default=500,
+                               help='Number of users per transaction '
+                                    '(default 500)')
+        self.parser.add_option('--checkpoint',
+                               dest='checkpoint',
+                               help='File to record progress in, for resuming')
 
     def command(self):
         self._load_config()
         self.log = logging.getLogger(__name__)
         self.log.info('Database access initialised')
 
-        self.sync(write=self.options.write, user=self.options.user)
+        self.sync(write=self.options.write, user=self.options.user,
+                  threads=self.options.threads,
+                  batch_size=self.options.batch_size,
+                  checkpoint=self.options.checkpoint)
 
-    def sync(self, write, user):
+    def sync(self, write, user, threads=10, batch_size=500, checkpoint=None):
+        from multiprocessing.pool import ThreadPool
         from ckan import model
-        from ckanext.dgu.drupalclient import DrupalClient, DrupalRequestError
+        from ckanext.dgu.drupalclient import DrupalClient
         from ckanext.dgu.authentication.drupal_auth import DrupalUserMapping
         log = self.log
-        update_keys = set(('email', 'fullname'))
         drupal = DrupalClient()
-        users = model.Session.query(model.User)\
+
+        # Just the IDs up front - the user objects are loaded a batch at a
+        # time, since committing expires them
+        users = model.Session.query(model.User.id, model.User.name)\
                      .filter_by(state='active')\
                      .filter(model.User.name.like('user_d%'))
         if user:
             users = users.filter(model.User.fullname == user)
-        users = users.all()
+        drupal_ids = [(DrupalUserMapping.ckan_user_name_to_drupal_id(name),
+                       id_) for id_, name in users]
+        users = sorted((int(drupal_id), id_) for drupal_id, id_ in drupal_ids
+                       if drupal_id and drupal_id.isdigit())
         log.info('Drupal users in CKAN: %s', len(users))
-        for user in users:
-            drupal_user_id = DrupalUserMapping.ckan_user_name_to_drupal_id(user.name)
-            try:
-                drupal_user = drupal.get_user_properties(drupal_user_id)
-            except DrupalRequestError, e:
-                if 'There is no user with ID' in str(e):
-                    log.info(stats.add('Removed deleted user',
-                                       '%s %s' % (drupal_user_id, user.fullname)))
-                    if write:
-                        user.delete()
-                    continue
-                elif 'Access denied for user' in str(e):
-                    log.info(stats.add('Removed blocked user',
-                                       '%s %s' % (drupal_user_id, user.fullname)))
-                    if write:
-                        user.delete()
-                    continue
-                raise
-            DrupalRequestError
-            user_dict = DrupalUserMapping.drupal_user_to_ckan_user(drupal_user)
-            user_changed = False
-            for key in update_keys:
-                if getattr(user, key) != user_dict[key]:
-                    log.info(stats.add(
-                        'Updating field %s' % key,
-                        '%s %s %s->%s' % (drupal_user_id, user.fullname,
-                                          getattr(user, key), user_dict[key])))
-                    if write:
-                        setattr(user, key, user_dict[key])
-                    user_changed = True
-            if not user_changed:
-                log.info(stats.add('Unchanged user',
-                                   '%s %s' % (drupal_user_id, user.fullname)))
+
+        done_up_to = read_checkpoint(checkpoint)
+        if done_up_to is not None:
+            users = [u for u in users if u[0] > done_up_to]
+            log.info('Resuming after Drupal user %s - %s users to go',
+                     done_up_to, len(users))
+
+        def fetch(drupal_user_id):
+            return get_drupal_user(drupal, drupal_user_id)
+
+        pool = ThreadPool(max(threads, 1))
+        try:
+            for i in xrange(0, len(users), batch_size):
+                batch = users[i:i + batch_size]
+                drupal_users = pool.map(fetch,
+                                        [drupal_id for drupal_id, id_ in batch])
+                ckan_users = dict(
+                    (u.id, u) for u in model.Session.query(model.User)
+                    .filter(model.User.id.in_([id_ for drupal_id, id_
+                                                in batch])))
+                for (drupal_user_id, id_), drupal_user in \
+                        zip(batch, drupal_users):
+                    self.sync_user(ckan_users[id_], drupal_user_id,
+                                   drupal_user, write)
+                if write:
+                    model.repo.commit_and_remove()
+                    write_checkpoint(checkpoint, batch[-1][0])
+                log.info('Synced %s/%s users', i + len(batch), len(users))
+        finally:
+            pool.close()
+            pool.join()
+
         log.info(stats.report())
+        DrupalClient.log_metrics()
         if write:
-            log.info('Writing...')
-            model.repo.commit_and_remove()
             log.info('...done')
+            if checkpoint and os.path.exists(checkpoint):
+                os.remove(checkpoint)
+
+    def sync_user(self, user, drupal_user_id, drupal_user, write):
+        '''Updates the CKAN user with the details from Drupal.
+        drupal_user is the user properties or a string saying why they are
+        not available (the user is deleted or blocked).'''
+        from ckanext.dgu.authentication.drupal_auth import DrupalUserMapping
+        log = self.log
+        update_keys = set(('email', 'fullname'))
+        if isinstance(drupal_user, basestring):
+            log.info(stats.add(drupal_user,
+                               '%s %s' % (drupal_user_id, user.fullname)))
+            if write:
+                user.delete()
+            return
+        user_dict = DrupalUserMapping.drupal_user_to_ckan_user(drupal_user)
+        user_changed = False
+        for key in update_keys:
+            if getattr(user, key) != user_dict[key]:
+                log.info(stats.add(
+                    'Updating field %s' % key,
+                    '%s %s %s->%s' % (drupal_user_id, user.fullname,
+                                      getattr(user, key), user_dict[key])))
+                if write:
+                    setattr(user, key, user_dict[key])
+                user_changed = True
+        if not user_changed:
+            log.info(stats.add('Unchanged user',
+                               '%s %s' % (drupal_user_id, user.fullname)))
+
+
+def get_drupal_user(drupal, drupal_user_id):
+    '''Returns the Drupal user's properties, or if the user has gone, a
+    string saying why. Other errors are raised.'''
+    from ckanext.dgu.drupalclient import DrupalRequestError
+    try:
+        return drupal.get_user_properties(drupal_user_id)
+    except DrupalRequestError, e:
+        if 'There is no user with ID' in str(e):
+            return 'Removed deleted user'
+        elif 'Access denied for user' in str(e):
+            return 'Removed blocked user'
+        raise
+
+
+def read_checkpoint(filepath):
+    '''Returns the Drupal ID recorded by write_checkpoint, or None.'''
+    if not filepath or not os.path.exists(filepath):
+        return None
+    with open(filepath) as f:
+        content = f.read().strip()
+    return int(content) if content else None
+
+
+def write_checkpoint(filepath, drupal_user_id):
+    if not filepath:
+        return
+    # write and rename, so an interruption can't leave it half-written
+    with open(filepath + '.tmp', 'w') as f:
+        f.write('%s\n' % drupal_user_id)
+    os.rename(filepath + '.tmp', filepath)
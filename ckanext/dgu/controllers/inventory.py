@@ -159,6 +159,8 @@ class InventoryController(BaseController):
 
         c.task = root
         c.task.packages = None
+        c.progress = None
+        failed_task = None
 
         for t in tasks:
             # Looks for a completed version with errors and stuff
@@ -170,9 +172,84 @@ class InventoryController(BaseController):
 
                 if t.value:
                     c.task.packages = json.loads(t.value)
+            elif t.key == 'progress' and t.value:
+                c.progress = json.loads(t.value)
+            elif t.task_type == 'inventory.upload' and \
+                    t.key == 'celery_task_id' and t.error:
+                # the task failed, so there'll be no Complete one
+                failed_task = t
+
+        if c.task.state == 'Complete':
+            c.progress = None
+        elif failed_task:
+            c.task = failed_task
+            c.task.state = 'Error'
+            c.task.error = [failed_task.error]
+            # show what was done before it failed
+            c.task.packages = c.progress['results'] if c.progress else None
+            c.progress = None
 
         return render('inventory/status.html')
 
+    def upload_progress(self, id, upload_id):
+        """
+        How far the upload has got, as JSON, for the status page to poll
+        while it is processed. Only the task_status rows are read.
+        With results=1 the packages processed so far are listed too.
+        """
+        group = model.Group.get(id)
+        if not group:
+            abort(404, 'Group not found')
+        context = {'model': model, 'session': model.Session,
+                   'user': c.user or c.author, 'group': group}
+        try:
+            check_access('organization_update', context)
+        except NotAuthorized, e:
+            abort(401, 'User %r not authorized to view internal inventory' % (c.user))
+
+        root = model.Session.query(model.TaskStatus).filter(model.TaskStatus.id==upload_id).first()
+        if not root:
+            abort(404, 'Upload details not found')
+        tasks = dict((t.key, t) for t in
+                     model.Session.query(model.TaskStatus)
+                     .filter(model.TaskStatus.entity_id==root.entity_id)
+                     .filter(model.TaskStatus.task_type=='inventory.upload'))
+
+        progress = {'state': root.state, 'rows': None, 'rows_done': 0,
+                    'rows_per_second': None, 'eta_seconds': None,
+                    'added': 0, 'updated': 0, 'errors': [], 'results': [],
+                    'last_updated': root.last_updated.isoformat()}
+        task = tasks.get('progress')
+        if task and task.value:
+            progress.update(json.loads(task.value))
+            # 'Finished' is just until the final status is saved
+            progress['state'] = 'Running'
+            progress['last_updated'] = task.last_updated.isoformat()
+        task = tasks.get('celery_task_id')
+        if task and task.error:
+            # the task failed
+            progress['state'] = 'Error'
+            progress['errors'] = progress['errors'] + [task.error]
+            progress['eta_seconds'] = None
+        task = tasks.get('status')
+        if task and task.state == 'Complete':
+            progress['state'] = 'Complete'
+            progress['errors'] = json.loads(task.error) if task.error else []
+            progress['results'] = json.loads(task.value) if task.value else []
+            progress['added'] = len([r for r in progress['results']
+                                     if r['action'] == 'Added'])
+            progress['updated'] = len([r for r in progress['results']
+                                       if r['action'] == 'Updated'])
+            progress['eta_seconds'] = 0
+            progress['last_updated'] = task.last_updated.isoformat()
+        progress['errors_so_far'] = len(progress['errors'])
+        progress['results_so_far'] = len(progress['results'])
+        if not request.params.get('results'):
+            del progress['results']
+
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        return json.dumps(progress)
+
     def upload_complete(self, id):
         context = {'model': model, 'session': model.Session,
                    'user': c.user or c.author, 'for_view': True}
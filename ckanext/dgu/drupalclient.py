@@ -1,10 +1,17 @@
 import logging
+import re
 import socket
-from xmlrpclib import ServerProxy, Fault, ProtocolError
+import threading
+import time
+import httplib
+from collections import defaultdict
+from xmlrpclib import ServerProxy, Fault, ProtocolError, Transport, \
+     SafeTransport
 from xml.parsers.expat import ExpatError
 from httplib import BadStatusLine
 
 import requests
+from requests.adapters import HTTPAdapter
 
 log = logging.getLogger(__name__)
 
@@ -12,6 +19,102 @@ class DrupalXmlRpcSetupError(Exception): pass
 class DrupalRequestError(Exception): pass
 class DrupalKeyError(Exception): pass
 
+
+class TimeoutTransport(Transport):
+    '''XMLRPC transport with a socket timeout. Like the standard one, it
+    keeps the HTTP/1.1 connection open between calls.'''
+    def __init__(self, timeout, *args, **kwargs):
+        Transport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        self._connection = host, httplib.HTTPConnection(
+            chost, timeout=self.timeout)
+        return self._connection[1]
+
+
+class TimeoutSafeTransport(SafeTransport):
+    '''HTTPS version of TimeoutTransport.'''
+    def __init__(self, timeout, *args, **kwargs):
+        SafeTransport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        self._connection = host, httplib.HTTPSConnection(
+            chost, None, timeout=self.timeout, **(x509 or {}))
+        return self._connection[1]
+
+
+class CircuitBreaker(object):
+    '''After a number of consecutive failures to reach Drupal, calls fail
+    straight away for a while, rather than each waiting for a timeout. Then
+    a single trial call is let through, and the rest keep failing until it
+    succeeds.'''
+    def __init__(self, max_failures, reset_seconds):
+        self.max_failures = max_failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            now = time.time()
+            if now - self.opened_at > self.reset_seconds and \
+                    (self.trial_started_at is None or
+                     now - self.trial_started_at > self.reset_seconds):
+                # let one call through to see if Drupal is back (or another,
+                # if the last trial never reported back)
+                self.trial_started_at = now
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_started_at is not None:
+                # the trial call failed, so stay open
+                self.opened_at = time.time()
+                self.trial_started_at = None
+            elif self.failures >= self.max_failures and \
+                    self.opened_at is None:
+                log.error('Drupal circuit breaker opened after %s failures',
+                          self.failures)
+                self.opened_at = time.time()
+
+
+def rest_metric_path(path):
+    '''Returns the REST API path with the ids replaced by a placeholder,
+    e.g. /node/123 -> /node/:id, so that calls are recorded per endpoint
+    rather than per object.'''
+    return re.sub(r'/[^/]*\d[^/]*', '/:id', path)
+
+
+def is_retryable_error(e):
+    '''Returns whether the error means Drupal could not be reached or
+    failed, as opposed to giving a valid response, such as a Fault.'''
+    if isinstance(e, ProtocolError):
+        return e.errcode >= 500
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    return isinstance(e, (socket.error, BadStatusLine,
+                          requests.ConnectionError, requests.Timeout))
+
 class DrupalClient(object):
     def __init__(self, xmlrpc_settings=None):
         '''If you do not supply xmlrpc settings then it looks them
@@ -23,7 +126,142 @@ class DrupalClient(object):
         '''
         self.xmlrpc_url, self.xmlrpc_url_log_safe, self.rest_url, \
             self.requests_auth = DrupalClient.get_xmlrpc_url(xmlrpc_settings)
-        self.drupal_xmlrpc = ServerProxy(self.xmlrpc_url)
+        self.timeout = float(self._get_setting(xmlrpc_settings, 'timeout',
+                                               10))
+        self.retries = int(self._get_setting(xmlrpc_settings, 'retries', 1))
+        self.drupal_xmlrpc = _XmlRpcMethod(self, None)
+        # XMLRPC connections are kept open per thread
+        self._local = threading.local()
+        with self._class_lock:
+            if self.xmlrpc_url not in self._circuit_breakers:
+                self._circuit_breakers[self.xmlrpc_url] = CircuitBreaker(
+                    int(self._get_setting(
+                        xmlrpc_settings, 'circuit_breaker_failures', 5)),
+                    int(self._get_setting(
+                        xmlrpc_settings, 'circuit_breaker_seconds', 30)))
+            if self.rest_url not in self._requests_sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=20)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._requests_sessions[self.rest_url] = session
+        self.circuit_breaker = self._circuit_breakers[self.xmlrpc_url]
+        self.requests_session = self._requests_sessions[self.rest_url]
+
+    # Shared by all the clients in the process, so that connections are
+    # reused and Drupal's failures are noticed across them.
+    _class_lock = threading.Lock()
+    _circuit_breakers = {}  # xmlrpc_url: CircuitBreaker
+    _requests_sessions = {}  # rest_url: requests.Session
+    # method: [number of calls, number of errors, total seconds, max seconds]
+    _metrics = defaultdict(lambda: [0, 0, 0.0, 0.0])
+
+    @staticmethod
+    def _get_setting(xmlrpc_settings, key, default):
+        '''Returns an option from the settings dict (e.g. 'timeout') or, if
+        no settings are supplied, the pylons config (e.g.
+        'dgu.drupal_timeout').'''
+        if xmlrpc_settings:
+            return xmlrpc_settings.get(key, default)
+        try:
+            from pylons import config
+        except ImportError:
+            return default
+        return config.get('dgu.drupal_%s' % key, default)
+
+    def _server_proxy(self):
+        server_proxy = getattr(self._local, 'server_proxy', None)
+        if server_proxy is None:
+            if self.xmlrpc_url.startswith('https'):
+                transport = TimeoutSafeTransport(self.timeout)
+            else:
+                transport = TimeoutTransport(self.timeout)
+            server_proxy = ServerProxy(self.xmlrpc_url, transport=transport)
+            self._local.server_proxy = server_proxy
+        return server_proxy
+
+    def _call(self, method_name, func):
+        '''Calls func, a request to Drupal, recording metrics and retrying
+        with backoff if Drupal could not be reached. Raises
+        DrupalRequestError straight away if the circuit breaker is open.
+        Other errors are raised for the caller to deal with.'''
+        if self.circuit_breaker.is_open():
+            raise DrupalRequestError('Not calling Drupal (%s) as it has been '
+                                     'failing' % method_name)
+        for attempt in xrange(self.retries + 1):
+            start = time.time()
+            try:
+                result = func()
+            except Exception, e:
+                self._record_metric(method_name, time.time() - start, True)
+                if not is_retryable_error(e):
+                    self.circuit_breaker.record_success()
+                    raise
+                self.circuit_breaker.record_failure()
+                if attempt == self.retries or \
+                        self.circuit_breaker.is_open():
+                    raise
+                log.warning('Drupal call %s failed (%r) - retrying',
+                            method_name, e)
+                time.sleep(0.5 * 2 ** attempt)
+            else:
+                self._record_metric(method_name, time.time() - start, False)
+                self.circuit_breaker.record_success()
+                return result
+
+    def _xmlrpc_call(self, method_name, args):
+        def call():
+            method = self._server_proxy()
+            for name in method_name.split('.'):
+                method = getattr(method, name)
+            return method(*args)
+        return self._call(method_name, call)
+
+    def _rest_get(self, url):
+        '''GETs a url of the REST API, returning the response.'''
+        method_name = 'rest ' + rest_metric_path(
+            url[len(self.rest_url):].split('?')[0])
+        def call():
+            response = self.requests_session.get(
+                url, auth=self.requests_auth, timeout=self.timeout)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            return response
+        try:
+            return self._call(method_name, call)
+        except requests.RequestException, e:
+            raise DrupalRequestError('Error with url \'%s\': %r' % (url, e))
+
+    @classmethod
+    def _record_metric(cls, method_name, seconds, is_error):
+        with cls._class_lock:
+            metric = cls._metrics[method_name]
+            metric[0] += 1
+            if is_error:
+                metric[1] += 1
+            metric[2] += seconds
+            metric[3] = max(metric[3], seconds)
+
+    @classmethod
+    def get_metrics(cls):
+        '''Returns the calls made to Drupal by this process:
+            {method: {'calls': n, 'errors': n, 'mean_seconds': s,
+                      'max_seconds': s}}
+        '''
+        with cls._class_lock:
+            return dict((method_name,
+                         {'calls': calls, 'errors': errors,
+                          'mean_seconds': total / calls if calls else 0.0,
+                          'max_seconds': max_seconds})
+                        for method_name, (calls, errors, total, max_seconds)
+                        in cls._metrics.items())
+
+    @classmethod
+    def log_metrics(cls):
+        for method_name, metric in sorted(cls.get_metrics().items()):
+            log.info('Drupal %s: %s calls, %s errors, mean %.3fs, max %.3fs',
+                     method_name, metric['calls'], metric['errors'],
+                     metric['mean_seconds'], metric['max_seconds'])
 
     @staticmethod
     def get_xmlrpc_url(xmlrpc_settings=None):
@@ -192,7 +430,7 @@ class DrupalClient(object):
     def get_organogram_files(self):
         url = self.rest_url + '/organogram'
         try:
-            response = requests.get(url, auth=self.requests_auth)
+            response = self._rest_get(url)
         except socket.error, e:
             raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
         except Fault, e:
@@ -206,7 +444,7 @@ class DrupalClient(object):
     def get_organogram_file_properties(self, fid):
         url = self.rest_url + '/organogram/%s' % fid
         try:
-            response = requests.get(url, auth=self.requests_auth)
+            response = self._rest_get(url)
         except socket.error, e:
             raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
         except Fault, e:
@@ -221,7 +459,7 @@ class DrupalClient(object):
         '''Includes apps'''
         url = self.rest_url + '/views/dataset_referrers'
         try:
-            response = requests.get(url, auth=self.requests_auth)
+            response = self._rest_get(url)
         except socket.error, e:
             raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
         except Fault, e:
@@ -237,7 +475,7 @@ class DrupalClient(object):
         '''Includes apps'''
         url = self.rest_url + '/node/{nid}'.format(nid=nid)
         try:
-            response = requests.get(url, auth=self.requests_auth)
+            response = self._rest_get(url)
         except socket.error, e:
             raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
         except Fault, e:
@@ -257,7 +495,7 @@ class DrupalClient(object):
         if type_filter:
             url += '?parameters[type]=%s' % type_filter
         try:
-            response = requests.get(url, auth=self.requests_auth)
+            response = self._rest_get(url)
         except socket.error, e:
             raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
         except Fault, e:
@@ -287,7 +525,7 @@ class DrupalClient(object):
         url = self.rest_url + '/views/replies' \
             '?entity_type=node&entity_id={nid}'.format(nid=node_id)
         try:
-            response = requests.get(url, auth=self.requests_auth)
+            response = self._rest_get(url)
         except socket.error, e:
             raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
         except Fault, e:
@@ -310,7 +548,7 @@ class DrupalClient(object):
         url = self.rest_url + '/views/replies' \
             '?entity_type=ckan_dataset&entity_id={id}'.format(id=entity_id)
         try:
-            response = requests.get(url, auth=self.requests_auth)
+            response = self._rest_get(url)
         except socket.error, e:
             raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
         except Fault, e:
@@ -327,3 +565,21 @@ class DrupalClient(object):
             for reply in replies:
                 reply[key] = reply[key].replace(',', '')
         return replies
+
+
+class _XmlRpcMethod(object):
+    '''Stands in for a ServerProxy, so that calls like
+    client.drupal_xmlrpc.user.retrieve(id) go through DrupalClient._call.'''
+    def __init__(self, client, method_name):
+        self._client = client
+        self._method_name = method_name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._method_name:
+            name = '%s.%s' % (self._method_name, name)
+        return _XmlRpcMethod(self._client, name)
+
+    def __call__(self, *args):
+        return self._client._xmlrpc_call(self._method_name, args)
@@ -539,14 +539,14 @@ def id_to_dict(key, data, errors, context):
     from ckanext.dgu.model.schema_codelist import Schema, Codelist
     for i, id_ in enumerate(data[key]):
         if key == ('schema',):
-            obj = Schema.get(id_)
+            obj_dict = Schema.cached_dict(id_)
         elif key == ('codelist',):
-            obj = Codelist.get(id_)
+            obj_dict = Codelist.cached_dict(id_)
         else:
             raise NotImplementedError('Bad key: %s' % key)
-        if not obj:
+        if not obj_dict:
             raise Invalid('%s id does not exist: %s' % (key, id_))
-        data[key][i] = obj.as_dict()
+        data[key][i] = obj_dict
 
 def fold_in_schema_codelist_if_a_sub_dict(key, data, errors, context):
     '''If round-tripping a dataset via the API then the schema/codelist will be
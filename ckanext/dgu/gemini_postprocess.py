@@ -6,8 +6,13 @@ import traceback
 import urlparse
 import urllib
 import json
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 
 import requests
+from requests.adapters import HTTPAdapter
 from urllib3.contrib import pyopenssl
 
 from owslib import wms as owslib_wms
@@ -24,9 +29,148 @@ def hash_a_dict(dict_):
     return json.dumps(dict_, sort_keys=True)
 
 
-def process_package_(package_id):
+def _config_int(key, default):
+    from pylons import config
+    return int(config.get(key, default))
+
+
+class ProbeCache(object):
+    '''Remembers the results of probing WMS servers, for ttl seconds, so that
+    resources that point at the same server are checked once. Exceptions are
+    remembered too, for error_ttl seconds, so that a host that timed out is
+    not tried again for every resource, but is tried again soon after.
+    Concurrent lookups of the same key are done only once - other threads
+    wait for the first one's result.
+    '''
+    def __init__(self, ttl, error_ttl=60, max_size=1000):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_size = max_size
+        self._entries = {}  # key: (expires, is_error, value)
+        self._in_flight = {}  # key: threading.Event
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] > time.time():
+                    if entry[1]:
+                        raise entry[2]
+                    return entry[2]
+                event = self._in_flight.get(key)
+                if event is None:
+                    self._in_flight[key] = threading.Event()
+                    break
+            # another thread is fetching it
+            event.wait()
+        try:
+            try:
+                value = compute()
+            except Exception, e:
+                self._set(key, True, e)
+                raise
+            self._set(key, False, value)
+            return value
+        finally:
+            with self._lock:
+                self._in_flight.pop(key).set()
+
+    def _set(self, key, is_error, value):
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                now = time.time()
+                for k, entry in self._entries.items():
+                    if entry[0] <= now:
+                        del self._entries[k]
+                if len(self._entries) >= self.max_size:
+                    self._entries.clear()
+            ttl = self.error_ttl if is_error else self.ttl
+            self._entries[key] = (time.time() + ttl, is_error, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_capabilities_cache = None
+_requests_session = None
+_module_lock = threading.Lock()
+
+
+def _get_capabilities_cache():
+    global _capabilities_cache
+    with _module_lock:
+        if _capabilities_cache is None:
+            _capabilities_cache = ProbeCache(
+                ttl=_config_int('dgu.wms_check.cache_seconds', 3600),
+                error_ttl=_config_int('dgu.wms_check.error_cache_seconds',
+                                      60))
+        return _capabilities_cache
+
+
+def _get_requests_session():
+    '''Returns the requests Session shared by the probing threads, so that
+    connections to each WMS host are kept open and reused.'''
+    global _requests_session
+    with _module_lock:
+        if _requests_session is None:
+            threads = _config_int('dgu.wms_check.threads', 8)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=100, pool_maxsize=threads)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _requests_session = session
+        return _requests_session
+
+
+# GetMap parameters, which don't affect a GetCapabilities response, so URLs
+# for different layers on the same server share a cached response
+WMS_LAYER_PARAMS = set(('layers', 'styles', 'bbox', 'width', 'height',
+                        'format', 'crs', 'srs', 'transparent', 'bgcolor'))
+
+
+def capabilities_cache_key(capabilities_url):
+    if '?' not in capabilities_url:
+        return capabilities_url
+    base_url, query = capabilities_url.split('?', 1)
+    params = [(key, value) for key, value in urlparse.parse_qsl(query)
+              if key.lower() not in WMS_LAYER_PARAMS]
+    return base_url + '?' + urllib.urlencode(params)
+
+
+def get_capabilities(capabilities_url):
+    '''Returns the content of the response to a GetCapabilities request,
+    from the cache or by requesting it (with a timeout of
+    dgu.wms_check.timeout seconds). Raises
+    requests.exceptions.RequestException if the request fails.'''
+    def fetch():
+        log.debug('WMS GetCapabilities request: %s', capabilities_url)
+        res = _get_requests_session().get(
+            capabilities_url,
+            timeout=_config_int('dgu.wms_check.timeout', 20))
+        res.raise_for_status()
+        return res.content
+    return _get_capabilities_cache().get(
+        capabilities_cache_key(capabilities_url), fetch)
+
+
+def process_package_(package_id, only_if_resources_changed=False):
+    '''Post-processes the package. With only_if_resources_changed, it is
+    skipped if its resource ids and URLs are the same as when it was last
+    processed.'''
     from ckan import model
 
+    pkg = model.Package.get(package_id)
+    if not pkg:
+        raise p.toolkit.ObjectNotFound('Package not found: %s' % package_id)
+    fingerprint = package_resource_fingerprint(pkg)
+    if only_if_resources_changed and \
+            fingerprint == get_stored_fingerprint(pkg.id):
+        log.info('No new or changed resources since last processed - '
+                 'skipping %s', pkg.name)
+        return
+
     # Using default CKAN schema instead of DGU, because we will write it back
     # in the same way in a moment. However it changes formats to lowercase.
     context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
@@ -34,24 +178,93 @@ def process_package_(package_id):
                 }
     package = p.toolkit.get_action('package_show')(
         context_, {'id': package_id})
-    package_changed = None
+    package_changed = process_package_resources(package)
+    # stored in the same transaction as the package update, so that the
+    # update is not seen as a change that needs processing
+    store_fingerprint(package['id'], fingerprint)
+    write_package_if_changed(package, package_changed)
+    model.Session.commit()
 
-    # process each resource
-    for resource in package.get('individual_resources', []) + \
-            package.get('timeseries_resources', []) + \
-            package.get('additional_resources', []):
+
+# The resource ids and URLs a package had when it was last processed are
+# stored (as a hash) in the task_status table, so that it is cheap to tell
+# whether it needs processing again.
+FINGERPRINT_TASK_TYPE = 'gemini_postprocess'
+FINGERPRINT_KEY = 'resource_fingerprint'
+
+
+def resource_fingerprint(resource_ids_and_urls):
+    '''Returns a hash of the (resource id, url) pairs.'''
+    return hashlib.md5(json.dumps(
+        sorted([id_, url or ''] for id_, url in resource_ids_and_urls)
+        )).hexdigest()
+
+
+def package_resource_fingerprint(pkg):
+    '''Returns the resource_fingerprint of a Package object.'''
+    return resource_fingerprint((res.id, res.url) for res in pkg.resources)
+
+
+def _fingerprint_query(package_id):
+    from ckan import model
+    return model.Session.query(model.TaskStatus) \
+        .filter_by(entity_id=package_id) \
+        .filter_by(task_type=FINGERPRINT_TASK_TYPE) \
+        .filter_by(key=FINGERPRINT_KEY)
+
+
+def get_stored_fingerprint(package_id):
+    '''Returns the fingerprint stored when the package was last processed,
+    or None.'''
+    task_status = _fingerprint_query(package_id).first()
+    return task_status.value if task_status else None
+
+
+def store_fingerprint(package_id, fingerprint):
+    '''Records the package's fingerprint. Doesn't commit.'''
+    import datetime
+    from ckan import model
+    task_status = _fingerprint_query(package_id).first()
+    if not task_status:
+        task_status = model.TaskStatus(entity_id=package_id,
+                                       entity_type='package',
+                                       task_type=FINGERPRINT_TASK_TYPE,
+                                       key=FINGERPRINT_KEY,
+                                       state='', error='')
+        model.Session.add(task_status)
+    task_status.value = fingerprint
+    task_status.last_updated = datetime.datetime.now()
+
+
+def _package_resources(package):
+    return package.get('individual_resources', []) + \
+        package.get('timeseries_resources', []) + \
+        package.get('additional_resources', [])
+
+
+def process_package_resources(package):
+    '''Processes the package's resources in-place, probing them
+    concurrently. Returns whether any of them changed.'''
+    resources = _package_resources(package)
+    probe_results = probe_wms_urls(
+        [resource['url'] for resource in resources])
+    package_changed = False
+    for resource in resources:
         log.info('Processing package=%s resource=%s',
                  package['name'], resource['id'][:4])
         resource_hash_before = hash_a_dict(resource)
-        process_resource(resource)
+        process_resource(resource, probe_results.get(resource['url']))
         # note if it made a change
-        if not package_changed:
-            resource_changed = hash_a_dict(resource) != resource_hash_before
-            log.info('Resource change: %s %s',
-                     resource_changed, resource['url'])
-            if resource_changed:
-                package_changed = True
+        resource_changed = hash_a_dict(resource) != resource_hash_before
+        log.info('Resource change: %s %s',
+                 resource_changed, resource['url'])
+        if resource_changed:
+            package_changed = True
+    return package_changed
 
+
+def write_package_if_changed(package, package_changed):
+    from ckan import model
     if package_changed:
         log.info('Writing dataset changes')
         tidy_up_package(package)
@@ -68,21 +281,43 @@ def process_package_(package_id):
         log.info('No changes to write')
 
 
-def process_resource(resource):
+def process_resource(resource, probe_result=None):
     '''
-    Edits resource in-place.
+    Edits resource in-place. probe_result is the result of probe_wms for its
+    URL, if that has already been done.
     '''
     url = resource['url']
 
     # Check if the service is a view service
-    is_wms = _is_wms(url)
+    is_wms, base_urls = probe_result or probe_wms(url)
     if is_wms:
         # this no longer sets 'verified' or 'verified_date'
-        base_urls = _wms_base_urls(url)
-        resource['wms_base_urls'] = ' '.join(base_urls)
+        resource['wms_base_urls'] = ' '.join(sorted(base_urls or []))
         resource['format'] = 'WMS'
 
 
+def probe_wms(url):
+    '''Returns (is_wms, base_urls) for the URL.'''
+    is_wms = _is_wms(url)
+    base_urls = _wms_base_urls(url) if is_wms else None
+    return is_wms, base_urls
+
+
+def probe_wms_urls(urls):
+    '''Probes the URLs concurrently, with up to dgu.wms_check.threads at a
+    time. Returns {url: (is_wms, base_urls)}.'''
+    urls = list(set(url for url in urls if url))
+    if len(urls) < 2:
+        return dict((url, probe_wms(url)) for url in urls)
+    pool = ThreadPool(min(len(urls), _config_int('dgu.wms_check.threads', 8)))
+    try:
+        results = pool.map(probe_wms, urls)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(urls, results))
+
+
 def _is_wms(url):
     '''Given a WMS URL this method returns whether it thinks it is a WMS
     server or not. It does it by making basic WMS requests.
@@ -152,9 +387,11 @@ def _try_wms_url(url, version='1.3'):
         capabilities_url = wms_capabilities_url(url, version)
         log.debug('WMS check url: %s', capabilities_url)
         try:
-            res = requests.get(capabilities_url)
-            res.raise_for_status()
-            xml = res.content
+            xml = get_capabilities(capabilities_url)
+        except (requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError), e:
+            log.info('WMS check for %s failed - host not responding "%s".', capabilities_url, e)
+            return None
         except requests.exceptions.RequestException, e:
             log.info('WMS check for %s failed due to HTTP error "%s".', capabilities_url, e)
             return False
@@ -224,9 +461,7 @@ def _wms_base_urls(url):
         # can't use OWSLIB to parse the result though.
         try:
             log.debug('WMS base url check: %s', capabilities_url)
-            res = requests.get(capabilities_url)
-            res.raise_for_status()
-            xml_str = res.content
+            xml_str = get_capabilities(capabilities_url)
         except requests.exceptions.RequestException, e:
             log.info('WMS check for %s failed due to HTTP error "%s".', capabilities_url, e)
             return False
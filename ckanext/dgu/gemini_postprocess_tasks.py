@@ -4,28 +4,34 @@ from ckan.lib.celery_app import celery
 import ckan.plugins as p
 
 from ckanext.dgu.gemini_postprocess import process_package_
+from ckanext.dgu.celery_env import load_environment
 
 
-def create_package_task(package, queue):
+def create_package_task(package, queue, only_if_resources_changed=False):
+    '''Queues post-processing of the package. With
+    only_if_resources_changed, the task checks whether the resource ids and
+    URLs have changed since the package was last processed, and does nothing
+    if not.'''
     from pylons import config
     from ckan.model.types import make_uuid
     log = __import__('logging').getLogger(__name__)
     task_id = '%s/%s' % (package.name, make_uuid()[:4])
     ckan_ini_filepath = os.path.abspath(config['__file__'])
     celery.send_task('gemini_postprocess.process_package',
-                     args=[ckan_ini_filepath, package.id, queue],
+                     args=[ckan_ini_filepath, package.id, queue,
+                           only_if_resources_changed],
                      task_id=task_id, queue=queue)
     log.debug('Gemini PostProcess of package put into celery queue %s: %s',
               queue, package.name)
 
 
 @celery.task(name="gemini_postprocess.process_package")
-def process_package(ckan_ini_filepath, package_id, queue='bulk'):
+def process_package(ckan_ini_filepath, package_id, queue='bulk',
+                    only_if_resources_changed=False):
     '''
     Archive a package.
     '''
-    load_config(ckan_ini_filepath)
-    register_translator()
+    load_environment(ckan_ini_filepath)
 
     log = process_package.get_logger()
     log.info('Starting gemini process_package task: package_id=%r queue=%s', package_id, queue)
@@ -34,7 +40,7 @@ def process_package(ckan_ini_filepath, package_id, queue='bulk'):
     # Also put try/except around it is easier to monitor ckan's log rather than
     # celery's task status.
     try:
-        process_package_(package_id)
+        process_package_(package_id, only_if_resources_changed)
     except Exception, e:
         if os.environ.get('DEBUG'):
             raise
@@ -44,29 +50,6 @@ def process_package(ckan_ini_filepath, package_id, queue='bulk'):
         raise
 
 
-def load_config(ckan_ini_filepath):
-    import paste.deploy
-    config_abs_path = os.path.abspath(ckan_ini_filepath)
-    conf = paste.deploy.appconfig('config:' + config_abs_path)
-    import ckan
-    ckan.config.environment.load_environment(conf.global_conf,
-                                             conf.local_conf)
-
-
-def register_translator():
-    # Register a translator in this thread so that
-    # the _() functions in logic layer can work
-    from paste.registry import Registry
-    from pylons import translator
-    from ckan.lib.cli import MockTranslator
-    global registry
-    registry = Registry()
-    registry.prepare()
-    global translator_obj
-    translator_obj = MockTranslator()
-    registry.register(translator, translator_obj)
-
-
 def _update_search_index(package_id, log):
     '''
     Tells CKAN to update its search index for a given package.
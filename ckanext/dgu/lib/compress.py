@@ -0,0 +1,246 @@
+'''
+Compresses a stream of data into several archive formats at once, so that a
+dump only needs to be serialized (or read) once, whatever formats it is
+published in.
+'''
+import os
+import sys
+import time
+import gzip
+import zlib
+import zipfile
+import struct
+import threading
+import Queue
+
+log = __import__('logging').getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+FORMATS = ('zip', 'gz', 'xz')
+
+
+class ZipStreamWriter(object):
+    '''Writes a zip file containing a single deflated member, whose data is
+    given in chunks, so that (unlike zipfile.ZipFile) it doesn't need the
+    data in a file or all in memory. The sizes and CRC go in a data
+    descriptor after the data. Limited to 4GB, as there is no zip64
+    support.'''
+    def __init__(self, fileobj, member_name):
+        self.fileobj = fileobj
+        self.member_name = member_name
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -15)
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        t = time.localtime()
+        self.dos_date = (t[0] - 1980) << 9 | t[1] << 5 | t[2]
+        self.dos_time = t[3] << 11 | t[4] << 5 | t[5] // 2
+        self.fileobj.write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, 0x08, zipfile.ZIP_DEFLATED,
+            self.dos_time, self.dos_date, 0, 0, 0, len(member_name), 0))
+        self.fileobj.write(member_name)
+        self.header_size = 30 + len(member_name)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        self._write_compressed(self.compressor.compress(data))
+
+    def _write_compressed(self, data):
+        self.compressed_size += len(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        self._write_compressed(self.compressor.flush())
+        if self.size > 0xffffffff or self.compressed_size > 0xffffffff:
+            raise ValueError('Zip member too large without zip64: %s'
+                             % self.member_name)
+        self.fileobj.write(struct.pack(
+            '<IIII', 0x08074b50, self.crc, self.compressed_size, self.size))
+        central_dir_offset = self.header_size + self.compressed_size + 16
+        central_dir = struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | 20, 20, 0x08,
+            zipfile.ZIP_DEFLATED, self.dos_time, self.dos_date, self.crc,
+            self.compressed_size, self.size, len(self.member_name), 0, 0, 0,
+            0, 0644 << 16, 0) + self.member_name
+        self.fileobj.write(central_dir)
+        self.fileobj.write(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, 1, 1, len(central_dir),
+            central_dir_offset, 0))
+        self.fileobj.close()
+
+    def abort(self):
+        '''Closes the file without finishing the archive.'''
+        self.fileobj.close()
+
+
+class GzipStreamWriter(gzip.GzipFile):
+    '''GzipFile that writes to filepath and closes it too (GzipFile
+    doesn't close a fileobj it is given).'''
+    def __init__(self, filepath, member_name):
+        self.raw_fileobj = open(filepath, 'wb')
+        gzip.GzipFile.__init__(self, filename=member_name, mode='wb',
+                               fileobj=self.raw_fileobj)
+
+    def close(self):
+        try:
+            gzip.GzipFile.close(self)
+        finally:
+            self.raw_fileobj.close()
+
+    def abort(self):
+        '''Closes the file without finishing the archive.'''
+        # so that GzipFile.close() doesn't write the trailer
+        self.fileobj = None
+        self.raw_fileobj.close()
+
+
+def open_encoder(format, filepath, member_name):
+    '''Returns a file-like object that writes the given archive format to
+    filepath. format is one of 'zip', 'gz' or 'xz' (xz needs the
+    backports.lzma package).'''
+    if format == 'zip':
+        return ZipStreamWriter(open(filepath, 'wb'), member_name)
+    elif format == 'gz':
+        return GzipStreamWriter(filepath, member_name)
+    elif format == 'xz':
+        from backports import lzma
+        return lzma.LZMAFile(filepath, 'wb')
+    raise ValueError('Unknown compression format: %s' % format)
+
+
+class MultiCompressor(object):
+    '''File-like object that compresses what is written to it into several
+    archive files at once. Each format is compressed on its own thread (zlib
+    releases the GIL), fed through a bounded queue.
+
+    The archives are written to temporary files alongside their final paths
+    and only renamed into place by close(), so readers never see a
+    half-written archive. If anything fails, the temporary files are
+    removed and the error is raised by close(). If the data can't all be
+    written, call abort() instead of close(), to discard the archives.
+
+    filepaths_by_format - {format: filepath} e.g. {'zip': '/dump/x.json.zip'}
+    member_name - name of the file in the archive (for zip and gz)
+    '''
+    def __init__(self, filepaths_by_format, member_name):
+        self.filepaths_by_format = filepaths_by_format
+        self.threads = []
+        self.queues = []
+        self.errors = []
+        self.size = 0
+        self._buffer = []
+        self._buffer_size = 0
+        self._aborted = False
+        # check them all before any encoder is started
+        for format in filepaths_by_format:
+            if format not in FORMATS:
+                raise ValueError('Unknown compression format: %s' % format)
+        try:
+            for format, filepath in filepaths_by_format.items():
+                encoder = open_encoder(format, filepath + '.tmp', member_name)
+                queue = Queue.Queue(maxsize=16)
+                thread = threading.Thread(target=self._compress,
+                                          args=(encoder, queue, format))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+                self.queues.append(queue)
+        except Exception:
+            # stop the encoders already started and remove their files
+            exc_info = sys.exc_info()
+            self.abort()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _compress(self, encoder, queue, format):
+        failed = False
+        while True:
+            data = queue.get()
+            if data is None:
+                break
+            if failed:
+                continue  # keep draining so that write() doesn't block
+            try:
+                encoder.write(data)
+            except Exception, e:
+                log.exception('Error compressing %s', format)
+                self.errors.append(e)
+                failed = True
+        if self._aborted:
+            try:
+                getattr(encoder, 'abort', encoder.close)()
+            except Exception, e:
+                log.warning('Error aborting %s: %s', format, e)
+            return
+        try:
+            encoder.close()
+        except Exception, e:
+            log.exception('Error closing %s', format)
+            self.errors.append(e)
+
+    def write(self, data):
+        # small writes are batched up, to keep the queue overhead down
+        self.size += len(data)
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= CHUNK_SIZE:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+        for queue in self.queues:
+            queue.put(data)
+
+    def write_from_file(self, filepath):
+        '''Compresses the contents of a file, reading it once.'''
+        with open(filepath, 'rb') as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self.write(data)
+
+    def close(self):
+        self._flush_buffer()
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            self._remove_tmp_files()
+            raise self.errors[0]
+        for filepath in self.filepaths_by_format.values():
+            os.rename(filepath + '.tmp', filepath)
+
+    def abort(self):
+        '''Stops compressing and deletes the temporary files, so nothing is
+        published and any existing archives are left as they are.'''
+        self._aborted = True
+        self._buffer = []
+        self._buffer_size = 0
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._remove_tmp_files()
+
+    def _remove_tmp_files(self):
+        for filepath in self.filepaths_by_format.values():
+            if os.path.exists(filepath + '.tmp'):
+                os.remove(filepath + '.tmp')
+
+
+def replace_symlink(target_filepath, link_filepath):
+    '''Points the symlink at the target, atomically replacing any existing
+    link.'''
+    tmp_link_filepath = link_filepath + '.tmp'
+    if os.path.lexists(tmp_link_filepath):
+        os.unlink(tmp_link_filepath)
+    os.symlink(target_filepath, tmp_link_filepath)
+    os.rename(tmp_link_filepath, link_filepath)
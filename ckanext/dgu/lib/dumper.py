@@ -6,8 +6,16 @@ them.
 """
 import unicodecsv as csv
 import json
+import os
+import gzip
+import datetime
 import tempfile
 import urlparse
+import zipfile
+from collections import defaultdict, deque
+from itertools import islice
+from operator import itemgetter
+from cStringIO import StringIO
 
 from paste.deploy.converters import asbool
 
@@ -15,6 +23,8 @@ from pylons import config
 import ckan.logic as logic
 import ckan.model as model
 
+log = __import__('logging').getLogger(__name__)
+
 IGNORE_KEYS = [
     u'ratings_count',
     u'ratings_average',
@@ -58,35 +68,86 @@ def make_nice_name(name):
 
     return name.replace('_', ' ').replace('-', ' ').title()
 
-
-class CSVDumper(object):
+# The columns of datasets.csv that follow the fixed ones (Name, Title etc),
+# as keys of the flattened package dict (see CSVDumper._flatten). They are
+# declared, rather than taken from whichever dataset comes first, so that
+# every dump has the same columns.
+DATASET_KEYS = [
+    u'author',
+    u'geographic_coverage',
+    u'isopen',
+    u'license_id',
+    u'maintainer',
+    u'mandate',
+    u'metadata_created',
+    u'metadata_modified',
+    u'notes',
+    u'odi-certificate-url',
+    u'recent',
+    u'tags',
+    u'temporal_coverage-from',
+    u'temporal_coverage-to',
+    u'theme-primary',
+    u'theme-secondary',
+    u'total',
+    u'update_frequency',
+    u'version',
+]
+DATASET_HEADINGS = [make_nice_name(key) for key in DATASET_KEYS]
+get_dataset_values = itemgetter(*DATASET_KEYS)
 
 
-    def __init__(self, *args, **kwargs):
-        self.dataset_file = tempfile.NamedTemporaryFile(delete=False)
-        self.resource_file = tempfile.NamedTemporaryFile(delete=False)
+class CSVDumper(object):
+    """
+    Dumps the public datasets and their resources as CSV.
+
+    in_memory - write the CSVs to memory rather than temporary files, so that
+        they can go straight into a zip with write_zip(), rather than using
+        close() to get the filenames. The whole CSVs are held in memory, so
+        this is only for small dumps.
+    """
+
+    def __init__(self, in_memory=False):
+        self.in_memory = in_memory
+        if in_memory:
+            self.dataset_file = StringIO()
+            self.resource_file = StringIO()
+            self.dataset_filename = self.resource_filename = None
+        else:
+            self.dataset_file = tempfile.NamedTemporaryFile(delete=False)
+            self.resource_file = tempfile.NamedTemporaryFile(delete=False)
+            self.dataset_filename = self.dataset_file.name
+            self.resource_filename = self.resource_file.name
 
         self.dataset_csv = csv.writer(self.dataset_file)
         self.resource_csv = csv.writer(self.resource_file)
 
-        self.dataset_filename = self.dataset_file.name
-        self.resource_filename = self.resource_file.name
-
         self.organization_cache = {}
 
-        self.keys = []
+    def dump(self, limit=None, bulk=False, processes=1):
+        """
+        Writes the CSV rows for all the public datasets.
 
-    def dump(self, limit=None):
-        packages = model.Session.query(model.Package)\
-            .filter(model.Package.state == 'active')\
-            .filter(model.Package.private == False)\
-            .order_by('name')
+        bulk - load each batch of datasets with a few set-based queries,
+            rather than lazy-loading the tags, extras, resources etc for every
+            dataset with pkg.as_dict(). The output is the same.
+        processes - split the loading across this many worker processes.
+            Implies bulk.
+        """
+        packages = public_packages_query(model.Package)
         if limit:
             packages = packages.limit(limit)
 
+        if processes > 1:
+            pkg_dicts = package_dicts_in_parallel(packages, processes)
+        elif bulk:
+            pkg_dicts = package_dicts_in_bulk(packages)
+        else:
+            pkg_dicts = (pkg.as_dict() for pkg in packages.yield_per(200))
+
         first = True
-        for pkg in packages.yield_per(200):
-            self.write_object(pkg, first)
+        for pkg_dict in pkg_dicts:
+            self.write_package_dict(pkg_dict, first)
             first = False
 
     def _encode(self, s):
@@ -106,22 +167,37 @@ class CSVDumper(object):
         return s
 
     def write_object(self, pkg, first=False):
-        pkg_dict, resources = self._flatten(pkg)
+        self.write_package_dict(pkg.as_dict(), first)
 
+    def write_package_dict(self, pkg_dict, first=False):
+        """
+        Writes the rows for a dataset, given its pkg.as_dict().
+        """
         if first:
-            # TODO Get a better list of fields to dump than just what we see in
-            # the first dataset...
-            self.dataset_keys = sorted(pkg_dict.keys())
-            self.dataset_keys.remove('license')  # duplicate
-            self.write_header(self.dataset_keys)
+            self.write_header()
+        self.write_rows(*self.package_rows(pkg_dict))
+
+    def write_rows(self, dataset_row, resource_rows):
+        self.dataset_csv.writerow(dataset_row)
+        for row in resource_rows:
+            self.resource_csv.writerow(row)
+
+    def package_rows(self, pkg_dict):
+        """
+        Returns the datasets.csv row and the resources.csv rows for a
+        dataset, given its pkg.as_dict().
+        """
+        extras = pkg_dict['extras']
+        flat_dict, resources = self._flatten(pkg_dict)
 
         url = config.get('ckan.site_url')
-        full_url = urlparse.urljoin(url, '/dataset/%s' % pkg.name)
+        full_url = urlparse.urljoin(url, '/dataset/%s' % pkg_dict['name'])
 
-        if pkg.owner_org in self.organization_cache:
-            organization, top_level_publisher = self.organization_cache.get(pkg.owner_org)
+        owner_org = pkg_dict['owner_org']
+        if owner_org in self.organization_cache:
+            organization, top_level_publisher = self.organization_cache.get(owner_org)
         else:
-            org = model.Group.get(pkg.owner_org)
+            org = model.Group.get(owner_org)
             organization = org.title
 
             parent_group_hierarchy = org.get_parent_group_hierarchy('organization')
@@ -130,36 +206,36 @@ class CSVDumper(object):
             else:
                 top_level_publisher = organization
 
-            self.organization_cache[pkg.owner_org] = (organization, top_level_publisher)
+            self.organization_cache[owner_org] = (organization, top_level_publisher)
 
-        license = pkg.license or ''
-        if license:
-            license = pkg.license.title
+        license = get_license(pkg_dict['license_id'])
+        license = license.title if license else ''
 
         # This really should have been published, rather than unpublished.
-        published = not asbool(pkg.extras.get('unpublished') or False)
-        nii = asbool(pkg.extras.get('core-dataset') or False)
-        location = asbool(pkg.extras.get('UKLP') or False)
-        import_source = pkg.extras.get('import_source') or \
-            'harvest' if pkg.extras.get('harvest_object_id') else ''
+        published = not asbool(extras.get('unpublished') or False)
+        nii = asbool(extras.get('core-dataset') or False)
+        location = asbool(extras.get('UKLP') or False)
+        import_source = extras.get('import_source') or \
+            'harvest' if extras.get('harvest_object_id') else ''
 
-        vals = [self._encode(val) for val in [pkg.name, pkg.title, full_url, organization, top_level_publisher, license, published, nii, location, import_source]]
-        vals += [self._encode(pkg_dict.get(k)) for k in self.dataset_keys]
-
-        self.dataset_csv.writerow(vals)
+        vals = [self._encode(val) for val in [pkg_dict['name'], pkg_dict['title'], full_url, organization, top_level_publisher, license, published, nii, location, import_source]]
+        vals += [self._encode(val) for val in get_dataset_values(flat_dict)]
 
         # Flatten the list
         resources = sum(resources, [])
 
+        resource_rows = []
         for resource in resources:
             # Important to include the date column for timeseries.
             date = resource.get('date', '')
 
-            row = [pkg.name, resource['url'], resource['format'], resource.get('description', ''),
+            row = [pkg_dict['name'], resource['url'], resource['format'], resource.get('description', ''),
                 resource['id'], resource['position'], date, organization, top_level_publisher]
-            self.resource_csv.writerow(row)
+            resource_rows.append(row)
 
-    def write_header(self, dataset_keys):
+        return vals, resource_rows
+
+    def write_header(self):
         """
         Generate the header row for datasets.csv (with some preset fields) and then
         the fixed headers for resources.
@@ -172,21 +248,21 @@ class CSVDumper(object):
             'Dataset Name', 'URL', 'Format', 'Description', 'Resource ID', 'Position', 'Date', 'Organization', 'Top level organization'
         ]
 
-        for k in dataset_keys:
-            dataset_header_row.append(self._encode(make_nice_name(k)))
+        dataset_header_row += [self._encode(heading)
+                               for heading in DATASET_HEADINGS]
 
         self.dataset_csv.writerow(dataset_header_row)
         self.resource_csv.writerow(resource_header_row)
 
-    def _flatten(self, pkg):
+    def _flatten(self, pkg_dict):
         """
-        Pull and flatten the package dict, making sure to promote any interesting
+        Flatten the package dict, making sure to promote any interesting
         extras we find.
         """
-        pkg_dict = pkg.as_dict()
         resources = []
 
-        new_dict = {}
+        # every declared column has a value, even if the dataset lacks it
+        new_dict = dict.fromkeys(DATASET_KEYS)
 
         for name, value in pkg_dict.items()[:]:
             if name == 'extras' or name in IGNORE_KEYS:
@@ -255,3 +331,348 @@ class CSVDumper(object):
         self.resource_file.close()
 
         return self.dataset_filename, self.resource_filename
+
+    def write_zip(self, zip_filepath):
+        """
+        Writes datasets.csv and resources.csv straight into a zip file. For
+        in_memory dumpers only.
+        """
+        assert self.in_memory
+        zip_file = zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED)
+        zip_file.writestr('datasets.csv', self.dataset_file.getvalue())
+        zip_file.writestr('resources.csv', self.resource_file.getvalue())
+        zip_file.close()
+
+
+def public_packages_query(*entities):
+    '''Query for the datasets that go in the dump, in the order they go.'''
+    return model.Session.query(*entities)\
+        .filter(model.Package.state == 'active')\
+        .filter(model.Package.private == False)\
+        .order_by('name')
+
+
+def get_license(license_id):
+    '''Returns the License object, as Package.license does.'''
+    if not license_id:
+        return None
+    try:
+        return model.Package.get_license_register()[license_id]
+    except KeyError:
+        return None
+
+
+def package_dicts_in_bulk(packages, batch_size=200):
+    """
+    Yields the equivalent of pkg.as_dict() for each of the Package query's
+    results (for the keys that CSVDumper uses). The packages are streamed
+    with a server-side cursor, and for each batch the tags, extras,
+    resources and tracking summaries are loaded with one query each, rather
+    than lazily for every package.
+    """
+    batch = []
+    for pkg in packages.execution_options(stream_results=True)\
+            .yield_per(batch_size):
+        batch.append(pkg)
+        if len(batch) == batch_size:
+            for pkg_dict in _package_dicts(batch):
+                yield pkg_dict
+            batch = []
+    for pkg_dict in _package_dicts(batch):
+        yield pkg_dict
+
+
+def _package_dicts(pkgs):
+    from sqlalchemy.orm import contains_eager
+    if not pkgs:
+        return []
+    ids = [pkg.id for pkg in pkgs]
+
+    tags = defaultdict(list)
+    q = model.Session.query(model.PackageTag.package_id, model.Tag.name)\
+        .join(model.Tag, model.Tag.id == model.PackageTag.tag_id)\
+        .filter(model.PackageTag.package_id.in_(ids))\
+        .filter(model.PackageTag.state == 'active')\
+        .filter(model.Tag.vocabulary_id == None)
+    for package_id, tag_name in q:
+        tags[package_id].append(tag_name)
+
+    extras = defaultdict(dict)
+    q = model.Session.query(model.PackageExtra.package_id,
+                            model.PackageExtra.key, model.PackageExtra.value)\
+        .filter(model.PackageExtra.package_id.in_(ids))\
+        .filter(model.PackageExtra.state == 'active')
+    for package_id, key, value in q:
+        extras[package_id][key] = value
+
+    resources = defaultdict(list)
+    q = model.Session.query(model.Resource)\
+        .join(model.ResourceGroup,
+              model.ResourceGroup.id == model.Resource.resource_group_id)\
+        .options(contains_eager(model.Resource.resource_group))\
+        .filter(model.ResourceGroup.package_id.in_(ids))\
+        .filter(model.Resource.state != 'deleted')\
+        .order_by(model.ResourceGroup.package_id, model.Resource.position)
+    for res in q:
+        resources[res.resource_group.package_id].append(
+            res.as_dict(core_columns_only=False))
+
+    # latest summary for each package, as TrackingSummary.get_for_package
+    tracking = {}
+    q = model.Session.query(model.TrackingSummary.package_id,
+                            model.TrackingSummary.running_total,
+                            model.TrackingSummary.recent_views)\
+        .filter(model.TrackingSummary.package_id.in_(ids))\
+        .distinct(model.TrackingSummary.package_id)\
+        .order_by(model.TrackingSummary.package_id,
+                  model.TrackingSummary.tracking_date.desc())
+    for package_id, running_total, recent_views in q:
+        tracking[package_id] = {'total': running_total,
+                                'recent': recent_views}
+
+    pkg_dicts = []
+    for pkg in pkgs:
+        # core columns only - Package.as_dict adds the related objects
+        pkg_dict = model.DomainObject.as_dict(pkg)
+        # as Package.as_dict - DomainObject.as_dict uses str() on datetimes
+        pkg_dict['metadata_modified'] = pkg.metadata_modified.isoformat() \
+            if pkg.metadata_modified else None
+        pkg_dict['metadata_created'] = pkg.metadata_created.isoformat() \
+            if pkg.metadata_created else None
+        license = get_license(pkg.license_id)
+        pkg_dict['license'] = license.title if license \
+            else pkg_dict.get('license_id', '')
+        pkg_dict['isopen'] = bool(license and license.isopen())
+        pkg_dict['tags'] = sorted(tags[pkg.id])
+        pkg_dict['extras'] = extras[pkg.id]
+        pkg_dict['resources'] = resources[pkg.id]
+        pkg_dict['tracking_summary'] = tracking.get(pkg.id,
+                                                    {'total': 0, 'recent': 0})
+        pkg_dicts.append(pkg_dict)
+    return pkg_dicts
+
+
+def package_dicts_in_parallel(packages, processes, chunk_size=200):
+    """
+    Yields the same as package_dicts_in_bulk, in the same order, but the
+    packages are loaded in chunks by worker processes. Each chunk is yielded
+    as soon as it (and the ones before it) has loaded, and only a couple of
+    chunks per worker are loaded ahead, so the whole catalogue is never held
+    in memory.
+    """
+    from multiprocessing import Pool
+
+    package_ids = [row[0] for row in
+                   packages.with_entities(model.Package.id)]
+    chunks = (package_ids[i:i + chunk_size]
+              for i in xrange(0, len(package_ids), chunk_size))
+
+    # DB connections must not be shared with the forked workers
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+    pool = Pool(processes, initializer=_init_worker)
+    try:
+        pending = deque(pool.apply_async(_load_package_dicts, (chunk,))
+                        for chunk in islice(chunks, processes * 2))
+        while pending:
+            pkg_dicts = pending.popleft().get()
+            for chunk in islice(chunks, 1):
+                pending.append(pool.apply_async(_load_package_dicts,
+                                                (chunk,)))
+            for pkg_dict in pkg_dicts:
+                yield pkg_dict
+        pool.close()
+    except:
+        # including the consumer abandoning the generator
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _init_worker():
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def _load_package_dicts(package_ids):
+    '''Worker process for package_dicts_in_parallel. Returns the package
+    dicts in the order of package_ids.'''
+    try:
+        pkgs = model.Session.query(model.Package)\
+            .filter(model.Package.id.in_(package_ids)).all()
+        position = dict((id_, i) for i, id_ in enumerate(package_ids))
+        pkgs.sort(key=lambda pkg: position[pkg.id])
+        return _package_dicts(pkgs)
+    finally:
+        model.Session.remove()
+
+
+def changed_package_ids(since_timestamp):
+    """
+    Returns the ids of datasets that have changed since the given (UTC)
+    timestamp - themselves, or their tags, extras, resources or
+    organization membership - using the revision tables, like the
+    /api/util/revisions call. Datasets with new tracking summaries are
+    included too, as the view counts are in the dump.
+
+    Returns None if a publisher has changed, since the publisher titles are
+    in the rows of all its datasets.
+    """
+    def revised(q, revision_table):
+        return q.join(model.Revision,
+                      model.Revision.id == revision_table.revision_id)\
+            .filter(model.Revision.timestamp >= since_timestamp)
+
+    for revision_table in (model.GroupRevision, model.GroupExtraRevision):
+        if revised(model.Session.query(revision_table.id),
+                   revision_table).first():
+            return None
+    q = model.Session.query(model.MemberRevision.id)\
+        .filter(model.MemberRevision.table_name == 'group')
+    if revised(q, model.MemberRevision).first():
+        return None
+
+    package_ids = set()
+    queries = (
+        revised(model.Session.query(model.PackageRevision.id),
+                model.PackageRevision),
+        revised(model.Session.query(model.PackageTagRevision.package_id),
+                model.PackageTagRevision),
+        revised(model.Session.query(model.PackageExtraRevision.package_id),
+                model.PackageExtraRevision),
+        revised(model.Session.query(model.ResourceGroup.package_id)
+                .join(model.ResourceRevision,
+                      model.ResourceRevision.resource_group_id ==
+                      model.ResourceGroup.id),
+                model.ResourceRevision),
+        revised(model.Session.query(model.MemberRevision.table_id)
+                .filter(model.MemberRevision.table_name == 'package'),
+                model.MemberRevision),
+        model.Session.query(model.TrackingSummary.package_id)
+        .filter(model.TrackingSummary.tracking_date >=
+                since_timestamp.date()),
+        )
+    for q in queries:
+        package_ids.update(row[0] for row in q.distinct())
+    # due to corrupt old obj revision tables, some package_ids may be blank
+    package_ids.discard(None)
+    return package_ids
+
+
+class IncrementalCSVDump(object):
+    """
+    Produces the CSV dump by updating the rows from the previous run, rather
+    than dumping every dataset again, so the time taken depends on how many
+    datasets changed.
+
+    The rows of every dataset are kept in a state file (gzipped JSON lines,
+    keyed by dataset id, with its metadata_modified), together with the time
+    of the run. Each run re-dumps just the datasets that changed since then
+    (see changed_package_ids), writes the full dump plus optionally a delta
+    of the changed datasets, and saves the new state. The first run, or one
+    after a publisher change, dumps everything.
+    """
+    # Increase when the rows in the state file change format, so that they
+    # are all dumped again. 2 - metadata dates in isoformat
+    STATE_VERSION = 2
+
+    def __init__(self, state_filepath):
+        self.state_filepath = state_filepath
+
+    def dump(self, dump_filepath, delta_filepath=None, batch_size=200):
+        started = datetime.datetime.utcnow()
+        since_timestamp, records = self.load_state()
+
+        package_ids = [row[0] for row in public_packages_query(model.Package.id)]
+        public_ids = set(package_ids)
+        changed_ids = changed_package_ids(since_timestamp) \
+            if since_timestamp else None
+        if changed_ids is None:
+            ids_to_dump = public_ids
+        else:
+            ids_to_dump = (changed_ids & public_ids) | \
+                (public_ids - set(records))
+        removed_ids = set(records) - public_ids
+        log.info('Dumping %s changed datasets, removing %s, of %s',
+                 len(ids_to_dump), len(removed_ids), len(package_ids))
+
+        dumper = CSVDumper(in_memory=True)
+        ids_to_dump_list = sorted(ids_to_dump)
+        for i in xrange(0, len(ids_to_dump_list), batch_size):
+            pkgs = model.Session.query(model.Package)\
+                .filter(model.Package.id.in_(
+                    ids_to_dump_list[i:i + batch_size]))\
+                .all()
+            for pkg_dict in _package_dicts(pkgs):
+                dataset_row, resource_rows = dumper.package_rows(pkg_dict)
+                records[pkg_dict['id']] = {
+                    'name': pkg_dict['name'],
+                    'metadata_modified': pkg_dict['metadata_modified'],
+                    'dataset_row': dataset_row,
+                    'resource_rows': resource_rows}
+        removed_names = []
+        for id_ in removed_ids:
+            removed_names.append(records.pop(id_)['name'])
+
+        self._write_zip(dump_filepath, package_ids, records)
+        if delta_filepath:
+            self._write_zip(delta_filepath,
+                            [id_ for id_ in package_ids if id_ in ids_to_dump],
+                            records, removed_names=sorted(removed_names))
+        self.save_state(started, records)
+
+    def _write_zip(self, zip_filepath, package_ids, records,
+                   removed_names=None):
+        # the full dump is too big to build in memory, so write temp files
+        dumper = CSVDumper()
+        dumper.write_header()
+        for id_ in package_ids:
+            dumper.write_rows(records[id_]['dataset_row'],
+                              records[id_]['resource_rows'])
+        dataset_filename, resource_filename = dumper.close()
+        try:
+            zip_file = zipfile.ZipFile(zip_filepath, 'w',
+                                       zipfile.ZIP_DEFLATED)
+            zip_file.write(dataset_filename, 'datasets.csv')
+            zip_file.write(resource_filename, 'resources.csv')
+            if removed_names is not None:
+                zip_file.writestr('removed.csv', ''.join(
+                    '%s\n' % name.encode('utf-8')
+                    for name in ['Name'] + removed_names))
+            zip_file.close()
+        finally:
+            os.remove(dataset_filename)
+            os.remove(resource_filename)
+
+    def load_state(self):
+        '''Returns the timestamp of the previous run and its records, or
+        (None, {}) if there was no previous run.'''
+        if not os.path.exists(self.state_filepath):
+            return None, {}
+        records = {}
+        with gzip.open(self.state_filepath, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != self.STATE_VERSION:
+                # rows in an older format - dump everything again
+                log.info('Ignoring incremental dump state in an old format')
+                return None, {}
+            for line in f:
+                record = json.loads(line)
+                records[record.pop('id')] = record
+        timestamp = datetime.datetime.strptime(header['timestamp'],
+                                               '%Y-%m-%dT%H:%M:%S.%f')
+        return timestamp, records
+
+    def save_state(self, timestamp, records):
+        tmp_filepath = self.state_filepath + '.tmp'
+        with gzip.open(tmp_filepath, 'wb') as f:
+            f.write(json.dumps(
+                {'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                 'version': self.STATE_VERSION})
+                + '\n')
+            for id_, record in records.iteritems():
+                record = dict(record, id=id_)
+                f.write(json.dumps(record) + '\n')
+        os.rename(tmp_filepath, self.state_filepath)
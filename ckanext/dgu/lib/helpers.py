@@ -1628,41 +1628,31 @@ def publisher_performance_data(publisher, include_sub_publishers):
     except ImportError:
         return None
     import time
-    from ckanext.qa.reports import broken_resource_links_for_organisation
     from ckanext.dgu.lib import publisher as publib
 
     start_time = time.time()
 
-    rcount = publib.resource_count(publisher, include_sub_publishers)
+    # Precalculated by: paster publisher_metrics update
+    metrics = publib.get_publisher_metrics(publisher, include_sub_publishers)
+    rcount = metrics['resource_count']
     log.debug("{p} has {r} resources".format(p=publisher.name, r=rcount))
 
     # Issues data
-    issues = "green"
-
-    if 'issues' in config['ckan.plugins']:
-        # If issues are installed then we can use the info to determine
-        # whether the issues are older than a month, between a fortnight
-        # and a month, or less than a fortnight.
-        from ckanext.issues.lib import util
-
-        more_than_month = util.old_unresolved(publisher, days=30)
-        more_than_fortnight = util.old_unresolved(publisher, days=14)
-
-        if more_than_month:
-            issues = 'red'
-        elif more_than_fortnight:
-            issues = 'amber'
-        else:
-            issues = 'green'
+    # If issues are installed then we can use the info to determine
+    # whether the issues are older than a month, between a fortnight
+    # and a month, or less than a fortnight.
+    if metrics['issues_older_than_month']:
+        issues = 'red'
+    elif metrics['issues_older_than_fortnight']:
+        issues = 'amber'
+    else:
+        issues = 'green'
 
     spending = 'green'
     if publisher_has_spend_data(publisher):
         spending = 'red'
 
-    # TODO: Add a count to result of broken_resource_links_for_organisation or write a version
-    # that returns count().
-    data = broken_resource_links_for_organisation(publisher.name, include_sub_publishers, use_cache=True)
-    broken_count = len(data['data'])
+    broken_count = metrics['broken_count']
 
     if broken_count == 0 or rcount == 0:
         pct = 0
@@ -1677,7 +1667,8 @@ def publisher_performance_data(publisher, include_sub_publishers):
         broken_links = 'red'
 
     openness = ''
-    total, counters = publib.openness_scores(publisher, include_sub_publishers)
+    counters = metrics['openness_scores']
+    total = sum(counters.values())
     number_x_or_above = lambda x: sum(counters.get(str(c),0) for c in xrange(x, 6))
 
     above_3 = number_x_or_above(3)
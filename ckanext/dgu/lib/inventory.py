@@ -51,6 +51,7 @@ def enqueue_document(user, filename, publisher):
     to ensure that the user sees immediately that something is happening.
     """
     from pylons import config
+    from paste.deploy.converters import asbool
     from ckan import model
     from ckan.model.types import make_uuid
     from ckan.lib.celery_app import celery
@@ -61,12 +62,16 @@ def enqueue_document(user, filename, publisher):
     task_id = make_uuid()
 
     # Create the task for the queue
-    context = json.dumps({
+    context = {
         'username': user.name,
         'site_url': config.get('ckan.site_url_internally') or config.get('ckan.site_url'),
         'apikey': user.apikey,
         'site_user_apikey': site_user['apikey']
-    })
+    }
+    if asbool(config.get('dgu.inventory_upload.in_worker', True)):
+        # the worker writes the datasets itself, rather than using the API
+        context['ckan_ini_filepath'] = os.path.abspath(config['__file__'])
+    context = json.dumps(context)
     data = json.dumps({
         'file': filename,
         'publisher': publisher.name,
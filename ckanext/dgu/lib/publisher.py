@@ -1,5 +1,10 @@
-from ckan import model
+import time
 import logging
+from collections import defaultdict
+
+from sqlalchemy import text
+
+from ckan import model
 
 log = logging.getLogger(__name__)
 
@@ -7,33 +12,284 @@ def go_up_tree(publisher):
     '''Provided with a publisher object, it walks up the hierarchy and yields
     each publisher, including the one you supply.
 
-    Essentially this is a slower version of Group.get_parent_group_hierarchy
-    because it returns Group objects, rather than dicts. And it includes the
-    publisher you supply.
+    The hierarchy comes from the in-process PublisherTree, so there are no
+    queries per level, just one to get the Group objects. Where a publisher
+    has more than one parent, all of them are followed (each publisher is
+    yielded once).
     '''
-    yield publisher
-    for parent in publisher.get_parent_groups(type='organization'):
-        for grandparent in go_up_tree(parent):
-            yield grandparent
+    tree = _tree_containing(publisher)
+    if tree is None:
+        yield publisher
+        return
+    for group in _groups_by_id(tree.all_ancestor_ids(publisher.id),
+                               publisher):
+        yield group
 
 def go_down_tree(publisher):
     '''Provided with a publisher object, it walks down the hierarchy and yields
     each publisher, including the one you supply.
-   
-    Essentially this is a slower version of Group.get_children_group_hierarchy
-    because it returns Group objects, rather than dicts.
+
+    The hierarchy comes from the in-process PublisherTree, so there are no
+    queries per level, just one to get the Group objects.
+    '''
+    tree = _tree_containing(publisher)
+    if tree is None:
+        yield publisher
+        return
+    for group in _groups_by_id(tree.descendant_ids(publisher.id), publisher):
+        yield group
+
+def _tree_containing(publisher):
+    '''Returns the PublisherTree, reloaded if the publisher is new since it
+    was loaded, or None if the publisher is not in the tree (not an
+    organization, or not in the database yet).
+
+    A publisher still missing after a reload is remembered by that tree, so
+    it is not reloaded again for it until the tree is thrown away.'''
+    if publisher.type != 'organization':
+        return None
+    tree = publisher_tree()
+    if publisher.id in tree.publishers:
+        return tree
+    if publisher.id in tree.missing_ids:
+        return None
+    invalidate_publisher_tree()
+    tree = publisher_tree()
+    if publisher.id not in tree.publishers:
+        tree.missing_ids.add(publisher.id)
+        return None
+    return tree
+
+def _groups_by_id(ids, publisher):
+    '''Returns the Group objects for the ids in the same order, loaded in one
+    query. The publisher object given is used for its own id.'''
+    groups = {publisher.id: publisher}
+    other_ids = [id_ for id_ in ids if id_ != publisher.id]
+    if other_ids:
+        for group in model.Session.query(model.Group) \
+                          .filter(model.Group.id.in_(other_ids)):
+            groups[group.id] = group
+    return [groups[id_] for id_ in ids if id_ in groups]
+
+
+class PublisherTree(object):
+    '''In-process table of the publisher hierarchy, loaded from the group,
+    member and group_extra tables in three queries, so that ancestry, titles
+    and abbreviations can be looked up without a query per level.
+
+    Use publisher_tree() to get the shared instance. It is thrown away when a
+    commit touches a group (see PublisherPlugin.before_commit) and after
+    dgu.publisher_tree.max_age seconds, to pick up changes made by other
+    processes.
     '''
-    yield publisher
-    for child in publisher.get_children_groups(type='organization'):
-        for grandchild in go_down_tree(child):
-            yield grandchild
+    def __init__(self, publishers, parents, abbreviations):
+        # publishers: {id: (name, title)}
+        # parents: {child_id: [parent_id, ...]}
+        # abbreviations: {id: abbreviation}
+        self.publishers = publishers
+        self.parents = parents
+        self.abbreviations = abbreviations
+        self.ids_by_name = dict((name, id_)
+                                for id_, (name, title) in publishers.items())
+        # children: {parent_id: [child_id, ...]} in name order
+        self.children = defaultdict(list)
+        for child_id, parent_ids in sorted(parents.items(),
+                                           key=lambda x: publishers[x[0]][0]):
+            for parent_id in parent_ids:
+                self.children[parent_id].append(child_id)
+        self.loaded = time.time()
+        # ids looked up by _tree_containing but not found after loading
+        self.missing_ids = set()
+        self._ancestor_cache = {}
+        self._all_ancestor_cache = {}
+        self._descendant_cache = {}
+
+    @classmethod
+    def load(cls):
+        publishers = {}
+        q = model.Session.query(model.Group.id, model.Group.name,
+                                model.Group.title) \
+                 .filter(model.Group.type == 'organization')
+        for id_, name, title in q:
+            publishers[id_] = (name, title)
+
+        parents = defaultdict(list)
+        q = model.Session.query(model.Member.table_id, model.Member.group_id) \
+                 .filter(model.Member.table_name == 'group') \
+                 .filter(model.Member.state == 'active') \
+                 .order_by(model.Member.table_id, model.Member.group_id)
+        for child_id, parent_id in q:
+            if child_id in publishers and parent_id in publishers:
+                parents[child_id].append(parent_id)
+
+        q = model.Session.query(model.GroupExtra.group_id,
+                                model.GroupExtra.value) \
+                 .filter(model.GroupExtra.key == 'abbreviation') \
+                 .filter(model.GroupExtra.state == 'active')
+        abbreviations = dict(q.all())
+
+        log.debug('Loaded publisher tree: %s publishers', len(publishers))
+        return cls(publishers, dict(parents), abbreviations)
+
+    def is_stale(self):
+        from pylons import config
+        max_age = int(config.get('dgu.publisher_tree.max_age', 300))
+        return time.time() - self.loaded > max_age
+
+    def get_id(self, name_or_id):
+        '''Returns the publisher id for a name or id, or None.'''
+        if name_or_id in self.publishers:
+            return name_or_id
+        return self.ids_by_name.get(name_or_id)
+
+    def name(self, id_):
+        return self.publishers[id_][0]
+
+    def title(self, id_):
+        return self.publishers[id_][1]
+
+    def abbreviation(self, id_):
+        return self.abbreviations.get(id_)
+
+    def ancestor_ids(self, name_or_id):
+        '''Returns the ids of the publisher and its ancestors, starting with
+        the publisher itself and ending with the top-level one. Where a
+        publisher has more than one parent, only the first is followed.
+        Returns [] if the publisher is unknown.
+        '''
+        id_ = self.get_id(name_or_id)
+        if id_ is None:
+            return []
+        if id_ not in self._ancestor_cache:
+            ancestors = []
+            parent_id = id_
+            while parent_id is not None and parent_id not in ancestors:
+                ancestors.append(parent_id)
+                parent_ids = self.parents.get(parent_id)
+                if not parent_ids:
+                    parent_id = None
+                else:
+                    if len(parent_ids) > 1:
+                        log.warning('Publisher %s has more than one parent '
+                                    'publisher. Ignoring all but the first. '
+                                    '%r', self.name(parent_id), parent_ids)
+                    parent_id = parent_ids[0]
+            self._ancestor_cache[id_] = ancestors
+        return self._ancestor_cache[id_]
+
+    def ancestor_names(self, name_or_id):
+        return [self.name(id_) for id_ in self.ancestor_ids(name_or_id)]
+
+    def all_ancestor_ids(self, name_or_id):
+        '''Returns the ids of the publisher and all the publishers above it,
+        following every parent of a publisher that has more than one (unlike
+        ancestor_ids). They start with the publisher itself, then each parent
+        is followed by its own ancestors, with no repeats. Returns [] if the
+        publisher is unknown.
+        '''
+        id_ = self.get_id(name_or_id)
+        if id_ is None:
+            return []
+        if id_ not in self._all_ancestor_cache:
+            ancestors = []
+            seen = set()
+            to_visit = [id_]
+            while to_visit:
+                publisher_id = to_visit.pop()
+                if publisher_id in seen:
+                    continue
+                seen.add(publisher_id)
+                ancestors.append(publisher_id)
+                to_visit.extend(reversed(self.parents.get(publisher_id, [])))
+            self._all_ancestor_cache[id_] = ancestors
+        return self._all_ancestor_cache[id_]
+
+    def all_ancestor_names(self, name_or_id):
+        return [self.name(id_) for id_ in self.all_ancestor_ids(name_or_id)]
+
+    def descendant_ids(self, name_or_id):
+        '''Returns the ids of the publisher and all the publishers below it,
+        starting with the publisher itself, depth first. Returns [] if the
+        publisher is unknown.
+        '''
+        id_ = self.get_id(name_or_id)
+        if id_ is None:
+            return []
+        if id_ not in self._descendant_cache:
+            descendants = []
+            seen = set()
+            to_visit = [id_]
+            while to_visit:
+                publisher_id = to_visit.pop()
+                if publisher_id in seen:
+                    continue
+                seen.add(publisher_id)
+                descendants.append(publisher_id)
+                to_visit.extend(reversed(self.children.get(publisher_id, [])))
+            self._descendant_cache[id_] = descendants
+        return self._descendant_cache[id_]
+
+    def descendant_names(self, name_or_id):
+        return [self.name(id_) for id_ in self.descendant_ids(name_or_id)]
+
+    def top_level_id(self, name_or_id):
+        '''Returns the id of the top-level publisher above this one (or
+        itself if it is top-level), or None if the publisher is unknown.'''
+        ancestor_ids = self.ancestor_ids(name_or_id)
+        return ancestor_ids[-1] if ancestor_ids else None
+
+    def top_level_ids(self):
+        '''Returns the ids of the publishers with no parent, in name order.'''
+        return sorted((id_ for id_ in self.publishers
+                       if not self.parents.get(id_)),
+                      key=self.name)
+
+    def depth(self, name_or_id):
+        '''Returns how far the publisher is below its top-level publisher
+        (0 for a top-level one), or None if the publisher is unknown.'''
+        ancestor_ids = self.ancestor_ids(name_or_id)
+        return len(ancestor_ids) - 1 if ancestor_ids else None
+
+
+_publisher_tree = None
+
+def publisher_tree():
+    '''Returns the shared PublisherTree, loading it if necessary.'''
+    global _publisher_tree
+    if _publisher_tree is None or _publisher_tree.is_stale():
+        _publisher_tree = PublisherTree.load()
+    return _publisher_tree
+
+def invalidate_publisher_tree():
+    global _publisher_tree
+    _publisher_tree = None
+
+def is_publisher_tree_change(obj):
+    '''Returns whether a changed domain object affects the PublisherTree.'''
+    if isinstance(obj, (model.Group, model.GroupExtra)):
+        return True
+    if isinstance(obj, model.Member) and obj.table_name == 'group':
+        return True
+    return False
 
 def find_group_admins(group):
     '''Look for publisher admins up the tree'''
     recipients = []
     recipient_publisher = None
-    for publisher in go_up_tree(group):
-        admins = publisher.members_of_type(model.User, 'admin').all()
+    publishers = list(go_up_tree(group))
+    # the admins of all of them in one query
+    admins_by_publisher = defaultdict(list)
+    q = model.Session.query(model.Member.group_id, model.User) \
+             .join(model.User, model.User.id == model.Member.table_id) \
+             .filter(model.Member.group_id.in_([p.id for p in publishers])) \
+             .filter(model.Member.table_name == 'user') \
+             .filter(model.Member.state == 'active') \
+             .filter(model.Member.capacity == 'admin') \
+             .filter(model.User.state == 'active')
+    for publisher_id, user in q:
+        admins_by_publisher[publisher_id].append(user)
+    for publisher in publishers:
+        admins = admins_by_publisher[publisher.id]
         if admins:
             recipients = [(u.fullname,u.email) for u in admins]
             recipient_publisher = publisher.title
@@ -97,29 +353,12 @@ def openness_scores(publisher, include_sub_publishers=False, use_cache=True):
             return cache
 
 
-    q = """SELECT TS.value::INT from task_status  as TS
-           WHERE TS.task_type='qa' AND
-                 TS.entity_type ='resource' AND
-                 TS.key = 'openness_score' AND
-                 TS.entity_id in (
-                   SELECT R.id from resource  as R
-                   INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
-                   INNER JOIN package as P ON P.id = RG.package_id
-                   WHERE P.state = 'active' AND R.state='active' AND
-                         P.id in (SELECT table_id FROM member
-                                  WHERE group_id in ({pub_id})
-                                  AND table_name='package' AND state='active')
-                                 );"""
-
     d = defaultdict(int)
-
-    if include_sub_publishers:
-        pubids = ["'%s'" % p.id for p in go_down_tree(publisher)]
-    else:
-        pubids = ["'%s'" % publisher.id]
-
-    for m in model.Session.execute(q.format(pub_id=','.join(pubids))):
-        d[str(m[0])] += 1
+    for score, count in model.Session.execute(
+            _openness_scores_sql,
+            {'publisher_ids': _publisher_ids(publisher,
+                                             include_sub_publishers)}):
+        d[str(score)] = count
     total = sum(d.values())
 
     return total, d
@@ -129,18 +368,283 @@ def resource_count(publisher, include_sub_publishers=False):
         Counts the number of active resources within active datasets and
         returns the scalar.
     """
-    q = """SELECT count(R.id) from resource  as R
-           INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
-           INNER JOIN package as P ON P.id = RG.package_id
-           WHERE P.state = 'active' AND R.state='active' AND
-                 P.id in (SELECT table_id FROM member
-                          WHERE group_id IN ({pub_id})
-                          AND table_name='package' AND state='active');"""
+    return model.Session.scalar(
+        _resource_count_sql,
+        {'publisher_ids': _publisher_ids(publisher, include_sub_publishers)})
 
+def _publisher_ids(publisher, include_sub_publishers):
     if include_sub_publishers:
-        pubids = ["'%s'" % p.id for p in go_down_tree(publisher)]
+        return publisher_tree().descendant_ids(publisher.id) \
+            or [publisher.id]
+    return [publisher.id]
+
+# The publisher ids are bound as a single array parameter, so the statement
+# text is the same whatever the size of the publisher subtree.
+_publisher_package_ids_sql = """
+    SELECT table_id FROM member
+    WHERE group_id = ANY(:publisher_ids)
+    AND table_name='package' AND state='active'"""
+
+_openness_scores_sql = text("""
+    SELECT TS.value::INT, count(*) from task_status as TS
+    WHERE TS.task_type='qa' AND
+          TS.entity_type ='resource' AND
+          TS.key = 'openness_score' AND
+          TS.entity_id in (
+            SELECT R.id from resource as R
+            INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+            INNER JOIN package as P ON P.id = RG.package_id
+            WHERE P.state = 'active' AND R.state='active' AND
+                  P.id in (%s))
+    GROUP BY TS.value::INT;""" % _publisher_package_ids_sql)
+
+_resource_count_sql = text("""
+    SELECT count(R.id) from resource as R
+    INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+    INNER JOIN package as P ON P.id = RG.package_id
+    WHERE P.state = 'active' AND R.state='active' AND
+          P.id in (%s);""" % _publisher_package_ids_sql)
+
+
+def _publisher_resources_query(*entities):
+    '''Returns a query of the active resources of the active datasets in
+    publishers, for the given entities (which can include Member.group_id -
+    the publisher id).'''
+    return model.Session.query(*entities) \
+        .select_from(model.Resource) \
+        .join(model.ResourceGroup,
+              model.ResourceGroup.id == model.Resource.resource_group_id) \
+        .join(model.Package,
+              model.Package.id == model.ResourceGroup.package_id) \
+        .join(model.Member, model.Member.table_id == model.Package.id) \
+        .filter(model.Package.state == 'active') \
+        .filter(model.Resource.state == 'active') \
+        .filter(model.Member.table_name == 'package') \
+        .filter(model.Member.state == 'active')
+
+def calculate_publisher_metrics(publisher_ids):
+    '''Works out the figures for the performance traffic lights of each of
+    the given publishers (not including their sub-publishers). The resource
+    counts and openness scores are got for all of them in two queries.
+
+    Returns {publisher_id: metrics_dict}.
+    '''
+    from sqlalchemy import func
+    from pylons import config
+
+    publisher_ids = list(publisher_ids)
+    metrics = dict((id_, {'resource_count': 0,
+                          'broken_count': 0,
+                          'openness_scores': {},
+                          'issues_older_than_fortnight': False,
+                          'issues_older_than_month': False})
+                   for id_ in publisher_ids)
+    if not publisher_ids:
+        return metrics
+
+    q = _publisher_resources_query(model.Member.group_id,
+                                   func.count(model.Resource.id)) \
+        .filter(model.Member.group_id.in_(publisher_ids)) \
+        .group_by(model.Member.group_id)
+    for publisher_id, count in q:
+        metrics[publisher_id]['resource_count'] = count
+
+    q = _publisher_resources_query(model.Member.group_id,
+                                   model.TaskStatus.value,
+                                   func.count(model.Resource.id)) \
+        .join(model.TaskStatus,
+              model.TaskStatus.entity_id == model.Resource.id) \
+        .filter(model.TaskStatus.task_type == 'qa') \
+        .filter(model.TaskStatus.entity_type == 'resource') \
+        .filter(model.TaskStatus.key == 'openness_score') \
+        .filter(model.Member.group_id.in_(publisher_ids)) \
+        .group_by(model.Member.group_id, model.TaskStatus.value)
+    for publisher_id, score, count in q:
+        scores = metrics[publisher_id]['openness_scores']
+        score = str(int(score))
+        scores[score] = scores.get(score, 0) + count
+
+    try:
+        from ckanext.qa.reports import broken_resource_links_for_organisation
+    except ImportError:
+        broken_resource_links_for_organisation = None
+    if 'issues' in config.get('ckan.plugins', ''):
+        from ckanext.issues.lib import util as issues_util
     else:
-        pubids = ["'%s'" % publisher.id]
+        issues_util = None
+    if broken_resource_links_for_organisation or issues_util:
+        for publisher in model.Session.query(model.Group) \
+                .filter(model.Group.id.in_(publisher_ids)):
+            publisher_metrics = metrics[publisher.id]
+            if broken_resource_links_for_organisation:
+                data = broken_resource_links_for_organisation(
+                    publisher.name, False, use_cache=True)
+                publisher_metrics['broken_count'] = len(data['data'])
+            if issues_util:
+                publisher_metrics['issues_older_than_month'] = \
+                    bool(issues_util.old_unresolved(publisher, days=30))
+                publisher_metrics['issues_older_than_fortnight'] = \
+                    bool(issues_util.old_unresolved(publisher, days=14))
+    return metrics
+
+def calculate_publisher_metrics_including_sub(publisher_id, tree,
+                                             own_metrics=None):
+    '''Works out the figures for the performance traffic lights of a
+    publisher including its sub-publishers. A dataset in several of the
+    publishers is counted once, as resource_count and openness_scores do,
+    rather than adding up each publisher's figures. The issue ages are just
+    those of the publisher itself, taken from own_metrics if given.'''
+    publisher_ids = tree.descendant_ids(publisher_id) or [publisher_id]
+    metrics = {'resource_count': model.Session.scalar(
+                   _resource_count_sql, {'publisher_ids': publisher_ids}),
+               'broken_count': 0,
+               'openness_scores': {},
+               'issues_older_than_fortnight': False,
+               'issues_older_than_month': False}
+    for score, count in model.Session.execute(
+            _openness_scores_sql, {'publisher_ids': publisher_ids}):
+        metrics['openness_scores'][str(score)] = count
+    try:
+        from ckanext.qa.reports import broken_resource_links_for_organisation
+    except ImportError:
+        pass
+    else:
+        data = broken_resource_links_for_organisation(
+            tree.name(publisher_id), True, use_cache=True)
+        metrics['broken_count'] = len(data['data'])
+    if own_metrics:
+        for key in ('issues_older_than_fortnight', 'issues_older_than_month'):
+            metrics[key] = own_metrics[key]
+    return metrics
+
+def get_publisher_metrics(publisher, include_sub_publishers=False):
+    '''Returns the metrics for the publisher's performance traffic lights,
+    from the publisher_metrics table. If they are not there yet, they are
+    worked out now.'''
+    from ckanext.dgu.model import publisher_metrics as pm
+    if pm.table_exists():
+        row = pm.PublisherMetrics.get(publisher.id, include_sub_publishers)
+        if row:
+            return row.as_dict()
+    own_metrics = calculate_publisher_metrics([publisher.id])[publisher.id]
+    if include_sub_publishers:
+        tree = _tree_containing(publisher) or publisher_tree()
+        return calculate_publisher_metrics_including_sub(
+            publisher.id, tree, own_metrics)
+    return own_metrics
 
-    return model.Session.scalar(q.format(pub_id=','.join(pubids)))
+def publishers_changed_since(since_timestamp):
+    '''Returns the ids of publishers whose datasets or resources have been
+    edited (according to the revision tables), moved between publishers, or
+    had their QA/archival status updated, or that have gained or lost a
+    parent or sub-publisher, since the given (UTC) timestamp.
+    '''
+    def revised(q, revision_table):
+        return q.join(model.Revision,
+                      model.Revision.id == revision_table.revision_id)\
+            .filter(model.Revision.timestamp >= since_timestamp)
+
+    def package_publishers(package_ids_q):
+        return model.Session.query(model.Member.group_id) \
+            .filter(model.Member.table_name == 'package') \
+            .filter(model.Member.state == 'active') \
+            .filter(model.Member.table_id.in_(package_ids_q.subquery()))
+
+    queries = (
+        package_publishers(revised(
+            model.Session.query(model.PackageRevision.id),
+            model.PackageRevision)),
+        package_publishers(revised(
+            model.Session.query(model.ResourceGroup.package_id)
+            .join(model.ResourceRevision,
+                  model.ResourceRevision.resource_group_id ==
+                  model.ResourceGroup.id),
+            model.ResourceRevision)),
+        package_publishers(
+            model.Session.query(model.ResourceGroup.package_id)
+            .join(model.Resource,
+                  model.Resource.resource_group_id == model.ResourceGroup.id)
+            .join(model.TaskStatus,
+                  model.TaskStatus.entity_id == model.Resource.id)
+            .filter(model.TaskStatus.task_type.in_(['qa', 'archiver']))
+            .filter(model.TaskStatus.last_updated >= since_timestamp)),
+        # covers datasets moved from one publisher to another
+        revised(model.Session.query(model.MemberRevision.group_id)
+                .filter(model.MemberRevision.table_name == 'package'),
+                model.MemberRevision),
+        # covers sub-publishers moved from one parent to another - both the
+        # parents and the sub-publisher, so that both ancestor chains are
+        # recalculated
+        revised(model.Session.query(model.MemberRevision.group_id)
+                .filter(model.MemberRevision.table_name == 'group'),
+                model.MemberRevision),
+        revised(model.Session.query(model.MemberRevision.table_id)
+                .filter(model.MemberRevision.table_name == 'group'),
+                model.MemberRevision),
+        )
+    publisher_ids = set()
+    for q in queries:
+        publisher_ids.update(row[0] for row in q.distinct())
+    publisher_ids.discard(None)
+    return publisher_ids
+
+def publishers_needing_metrics_update(last_update, max_age):
+    '''Returns the ids of the active publishers whose publisher_metrics
+    rows need recalculating: those changed since last_update (the start of
+    the last full or incremental update, or None if that's not known), those
+    whose rows are older than max_age (a timedelta) and those without rows.
+    '''
+    import datetime
+    from ckanext.dgu.model.publisher_metrics import PublisherMetrics
+    all_ids = set(row[0] for row in
+                  model.Session.query(model.Group.id)
+                  .filter(model.Group.type == 'organization')
+                  .filter(model.Group.state == 'active'))
+    own_rows = model.Session.query(PublisherMetrics.publisher_id,
+                                   PublisherMetrics.updated) \
+        .filter(PublisherMetrics.include_sub_publishers == False) \
+        .all()
+    if not own_rows:
+        return all_ids
+    if last_update is None:
+        # the oldest row is a safe place to start - a row updated on its
+        # own (e.g. 'publisher_metrics update <name>') says nothing about
+        # the others
+        last_update = min(updated for id_, updated in own_rows)
+    stale_before = datetime.datetime.utcnow() - max_age
+    publisher_ids = publishers_changed_since(last_update)
+    log.info('Publishers changed since %s: %s', last_update,
+             len(publisher_ids))
+    publisher_ids |= set(id_ for id_, updated in own_rows
+                         if updated < stale_before)
+    publisher_ids |= all_ids - set(id_ for id_, updated in own_rows)
+    return publisher_ids & all_ids
+
+def update_publisher_metrics(publisher_ids):
+    '''Recalculates the publisher_metrics rows of the given publishers, and
+    the rows including sub-publishers of them and their ancestors. Doesn't
+    commit.
+    '''
+    import datetime
+    from ckanext.dgu.model.publisher_metrics import PublisherMetrics
+    started = datetime.datetime.utcnow()
+    tree = PublisherTree.load()
+    publisher_ids = set(id_ for id_ in publisher_ids
+                        if id_ in tree.publishers)
+    own_metrics = calculate_publisher_metrics(publisher_ids)
+    for publisher_id, metrics in own_metrics.items():
+        PublisherMetrics.set(publisher_id, False, metrics, started)
+    model.Session.flush()
 
+    affected_ids = set()
+    for publisher_id in publisher_ids:
+        affected_ids.update(tree.all_ancestor_ids(publisher_id))
+    for publisher_id in affected_ids:
+        own_row = PublisherMetrics.get(publisher_id, False)
+        PublisherMetrics.set(
+            publisher_id, True,
+            calculate_publisher_metrics_including_sub(
+                publisher_id, tree, own_row.as_dict() if own_row else None),
+            started)
+    log.info('Updated publisher metrics: %s publishers, %s including '
+             'sub-publishers', len(publisher_ids), len(affected_ids))
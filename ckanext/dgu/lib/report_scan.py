@@ -0,0 +1,156 @@
+'''
+Reads the whole catalogue once and feeds each dataset to every report that
+is worked out from it, so that refreshing the reports doesn't walk the
+catalogue (and lazily load each dataset's resources and extras) once per
+report.
+
+A report registers a class with add(dataset) and finish() methods:
+
+    @report_scan.register
+    class MyReport(report_scan.CatalogueReport):
+        def add(self, dataset):
+            ...
+
+and its generate function gets the filled-in instance with
+report_scan.get_report(MyReport). The first report asked for runs the scan
+for all of them and the results are kept for CACHE_SECONDS.
+'''
+import time
+import logging
+from collections import namedtuple
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+# The reports are usually generated together (by the nightly report cache
+# refresh), so share one scan between them for this long.
+CACHE_SECONDS = 600
+
+ScannedResource = namedtuple('ScannedResource', (
+    'id', 'format', 'resource_type', 'description', 'url'))
+
+_report_classes = []
+_scan_results = None  # (time_scanned, {report_class: report})
+
+
+class ScannedDataset(object):
+    '''The properties of an active dataset needed by the reports. Looks enough
+    like a Package for ckanext-report's dataset_notes.'''
+    __slots__ = ('id', 'name', 'title', 'notes', 'license_id', 'owner_org',
+                 'organization_name', 'organization_title',
+                 'metadata_created', 'metadata_modified', 'extras',
+                 'resources')
+
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.get(key))
+
+
+class CatalogueReport(object):
+    '''Base class for a report that is worked out from the catalogue scan.'''
+    def add(self, dataset):
+        '''Called with each active ScannedDataset in turn.'''
+        raise NotImplementedError
+
+    def finish(self):
+        '''Called once all the datasets have been added.'''
+        pass
+
+
+def register(report_class):
+    '''Class decorator that adds a CatalogueReport to the scan.'''
+    if report_class not in _report_classes:
+        _report_classes.append(report_class)
+    return report_class
+
+
+def get_report(report_class):
+    '''Returns the instance of the report_class, filled in by a scan of the
+    catalogue. The scan is shared by all registered reports.'''
+    global _scan_results
+    if _scan_results is None or \
+            time.time() - _scan_results[0] > CACHE_SECONDS or \
+            report_class not in _scan_results[1]:
+        reports = scan_catalogue(_report_classes)
+        _scan_results = (time.time(), reports)
+    return _scan_results[1][report_class]
+
+
+def clear_cache():
+    global _scan_results
+    _scan_results = None
+
+
+def scan_catalogue(report_classes):
+    '''Feeds every active dataset to a new instance of each of the
+    report_classes. Returns {report_class: report}.'''
+    reports = dict((cls, cls()) for cls in report_classes)
+    num_datasets = 0
+    start = time.time()
+    for dataset in iter_datasets():
+        for report in reports.values():
+            report.add(dataset)
+        num_datasets += 1
+    for report in reports.values():
+        report.finish()
+    log.info('Scanned %s datasets for %s reports in %.1fs', num_datasets,
+             len(reports), time.time() - start)
+    return reports
+
+
+def iter_datasets(chunk_size=CHUNK_SIZE):
+    '''Yields a ScannedDataset for every active dataset, in name order. The
+    extras and resources are loaded with a query per chunk of datasets and
+    the organizations come from the publisher tree.'''
+    from ckanext.dgu.lib.publisher import publisher_tree
+    tree = publisher_tree()
+    packages = model.Session.query(
+        model.Package.id, model.Package.name, model.Package.title,
+        model.Package.notes, model.Package.license_id,
+        model.Package.owner_org, model.Package.metadata_created,
+        model.Package.metadata_modified) \
+        .filter(model.Package.state == 'active') \
+        .order_by(model.Package.name) \
+        .all()
+    for i in xrange(0, len(packages), chunk_size):
+        chunk = packages[i:i + chunk_size]
+        ids = [row[0] for row in chunk]
+
+        extras = dict((id_, {}) for id_ in ids)
+        q = model.Session.query(model.PackageExtra.package_id,
+                                model.PackageExtra.key,
+                                model.PackageExtra.value) \
+            .filter(model.PackageExtra.package_id.in_(ids)) \
+            .filter(model.PackageExtra.state == 'active')
+        for package_id, key, value in q:
+            extras[package_id][key] = value
+
+        resources = dict((id_, []) for id_ in ids)
+        q = model.Session.query(model.ResourceGroup.package_id,
+                                model.Resource.id, model.Resource.format,
+                                model.Resource.resource_type,
+                                model.Resource.description,
+                                model.Resource.url) \
+            .join(model.Resource,
+                  model.Resource.resource_group_id == model.ResourceGroup.id) \
+            .filter(model.ResourceGroup.package_id.in_(ids)) \
+            .filter(model.Resource.state != 'deleted') \
+            .order_by(model.Resource.position)
+        for row in q:
+            resources[row[0]].append(ScannedResource(*row[1:]))
+
+        for (id_, name, title, notes, license_id, owner_org, created,
+             modified) in chunk:
+            if owner_org in tree.publishers:
+                org_name, org_title = tree.publishers[owner_org]
+            else:
+                org_name = org_title = None
+            yield ScannedDataset(
+                id=id_, name=name, title=title, notes=notes,
+                license_id=license_id, owner_org=owner_org,
+                organization_name=org_name, organization_title=org_title,
+                metadata_created=created, metadata_modified=modified,
+                extras=extras[id_], resources=resources[id_])
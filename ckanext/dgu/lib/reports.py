@@ -4,13 +4,15 @@ import logging
 import os
 
 from paste.deploy.converters import asbool
+from sqlalchemy import orm
 
 from ckan import model
 from ckan.lib.helpers import OrderedDict
 import ckan.plugins as p
 from ckanext.report import lib
-from ckanext.dgu.lib.publisher import go_up_tree
+from ckanext.dgu.lib.publisher import publisher_tree
 from ckanext.dgu.lib import helpers as dgu_helpers
+from ckanext.dgu.lib import report_scan
 
 log = logging.getLogger(__name__)
 
@@ -18,32 +20,54 @@ log = logging.getLogger(__name__)
 # NII
 
 
+@report_scan.register
+class NiiDatasets(report_scan.CatalogueReport):
+    def __init__(self):
+        self.datasets = []
+
+    def add(self, dataset):
+        if dataset.extras.get('core-dataset') == 'true' and \
+                dataset.organization_name:
+            self.datasets.append(dataset)
+
+    def finish(self):
+        self.datasets.sort(key=lambda d: (d.organization_title, d.title))
+
+
+def nii_broken_resources(package_ids):
+    '''Returns the broken resources of the datasets as
+    {package_id: [(resource description, resource id), ...]}, querying them
+    for 1000 datasets at a time.'''
+    from ckanext.archiver.model import Archival
+
+    broken_resources = dict((id_, []) for id_ in package_ids)
+    for ids in _chunks(package_ids, 1000):
+        q = model.Session.query(Archival.package_id,
+                                model.Resource.description,
+                                model.Resource.id)\
+            .join(model.Resource, Archival.resource_id == model.Resource.id)\
+            .filter(Archival.package_id.in_(ids))\
+            .filter(Archival.is_broken == True)\
+            .filter(model.Resource.state == 'active')\
+            .order_by(model.Resource.position)
+        for package_id, description, resource_id in q:
+            broken_resources[package_id].append((description, resource_id))
+    return broken_resources
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
 def nii_report():
     '''A list of the NII datasets, grouped by publisher, with details of broken
     links and source.'''
-    nii_dataset_q = model.Session.query(model.Package)\
-        .join(model.PackageExtra, model.PackageExtra.package_id == model.Package.id)\
-        .join(model.Group, model.Package.owner_org == model.Group.id)\
-        .filter(model.PackageExtra.key == 'core-dataset')\
-        .filter(model.PackageExtra.value == 'true')\
-        .filter(model.Package.state == 'active')
-    nii_dataset_objects = nii_dataset_q\
-            .order_by(model.Group.title, model.Package.title).all()
-
-    def broken_resources_for_package(package_id):
-        from ckanext.archiver.model import Archival
-
-        results = model.Session.query(Archival, model.Resource)\
-                       .filter(Archival.package_id == package_id)\
-                       .filter(Archival.is_broken == True)\
-                       .join(model.Package, Archival.package_id == model.Package.id)\
-                       .filter(model.Package.state == 'active')\
-                       .join(model.Resource, Archival.resource_id == model.Resource.id)\
-                       .filter(model.Resource.state == 'active')
-
-        broken_resources = [(resource.description, resource.id)
-                            for archival, resource in results.all()]
-        return broken_resources
+    nii_datasets = report_scan.get_report(NiiDatasets).datasets
+
+    broken_resources_by_package = nii_broken_resources(
+        [dataset.id for dataset in nii_datasets])
 
     nii_dataset_details = []
     num_resources = 0
@@ -51,15 +75,14 @@ def nii_report():
     num_broken_datasets = 0
     broken_organization_names = set()
     nii_organizations = set()
-    for dataset_object in nii_dataset_objects:
-        broken_resources = broken_resources_for_package(dataset_object.id)
-        org = dataset_object.get_organization()
+    for dataset in nii_datasets:
+        broken_resources = broken_resources_by_package[dataset.id]
         dataset_details = {
-                'name': dataset_object.name,
-                'title': dataset_object.title,
-                'dataset_notes': lib.dataset_notes(dataset_object),
-                'organization_name': org.name,
-                'unpublished': p.toolkit.asbool(dataset_object.extras.get('unpublished')),
+                'name': dataset.name,
+                'title': dataset.title,
+                'dataset_notes': lib.dataset_notes(dataset),
+                'organization_name': dataset.organization_name,
+                'unpublished': p.toolkit.asbool(dataset.extras.get('unpublished')),
                 'num_broken_resources': len(broken_resources),
                 'broken_resources': broken_resources,
                 }
@@ -67,17 +90,17 @@ def nii_report():
         if broken_resources:
             num_broken_resources += len(broken_resources)
             num_broken_datasets += 1
-            broken_organization_names.add(org.name)
-        nii_organizations.add(org)
-        num_resources += len(dataset_object.resources)
+            broken_organization_names.add(dataset.organization_name)
+        nii_organizations.add((dataset.organization_name,
+                               dataset.organization_title))
+        num_resources += len(dataset.resources)
 
-    org_tuples = [(org.name, org.title) for org in
-                  sorted(nii_organizations, key=lambda o: o.title)]
+    org_tuples = sorted(nii_organizations, key=lambda o: o[1])
 
     return {'table': nii_dataset_details,
             'organizations': org_tuples,
             'num_resources': num_resources,
-            'num_datasets': len(nii_dataset_objects),
+            'num_datasets': len(nii_datasets),
             'num_organizations': len(nii_organizations),
             'num_broken_resources': num_broken_resources,
             'num_broken_datasets': num_broken_datasets,
@@ -241,9 +264,20 @@ def publisher_activity(organization, include_sub_organizations=False):
             filter(model.Group.type=='organization').\
             filter(model.Group.state=='active').order_by('name').\
             all()
-        for organization in add_progress_bar(all_orgs):
-            created, modified = _get_activity(
-                organization.name, include_sub_organizations, periods)
+        activity = _get_all_activity(periods)
+        tree = publisher_tree()
+        package_ids_by_org = collections.defaultdict(set)
+        for package_id, owner_org in activity['owner_org'].iteritems():
+            if include_sub_organizations:
+                # all parents, as filter_by_organizations (go_up_tree)
+                org_ids = tree.all_ancestor_ids(owner_org)
+            else:
+                org_ids = [owner_org]
+            for org_id in org_ids:
+                package_ids_by_org[org_id].add(package_id)
+        for organization in all_orgs:
+            created, modified = _activity_of_packages(
+                activity, package_ids_by_org[organization.id])
             created_names = [dataset[0] for dataset in created.values()[0]]
             modified_names = [dataset[0] for dataset in modified.values()[0]]
             num_created = len(created_names)
@@ -271,104 +305,200 @@ def publisher_activity(organization, include_sub_organizations=False):
                 'period': period_iso}
 
 
+# These are the authors whose revisions we ignore, as they are trivial
+# changes. NB we do want to know about revisions by:
+# * harvest (harvested metadata)
+# * dgu (NS Stat Hub imports)
+# * Fix national indicators
+activity_system_authors = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
+                           'Date format tidier', 'current_revision_fixer',
+                           'current_revision_fixer2', 'fix_contact_details.py',
+                           'Repoint 410 Gone to webarchive url',
+                           'Fix duplicate resources',
+                           'fix_secondary_theme.py',
+                           )
+activity_system_author_template = 'script%'  # "%" is a wildcard
+
+# The activity of all datasets is worked out once and shared by the
+# publisher_activity report for every organization (and the index), for
+# this many seconds.
+ACTIVITY_CACHE_SECONDS = 600
+_activity_cache = {}  # {periods_key: (time_calculated, activity)}
+
+
 def _get_activity(organization_name, include_sub_organizations, periods):
+    '''Returns the datasets of the organization that were created and
+    modified in each of the periods, as (created, modified) where each is
+    {period_name: [row, ...]}.
+    '''
     import ckan.model as model
-    from paste.deploy.converters import asbool
-
-    created = dict((period_name, []) for period_name in periods)
-    modified = dict((period_name, []) for period_name in periods)
-
-    # These are the authors whose revisions we ignore, as they are trivial
-    # changes. NB we do want to know about revisions by:
-    # * harvest (harvested metadata)
-    # * dgu (NS Stat Hub imports)
-    # * Fix national indicators
-    system_authors = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
-                      'Date format tidier', 'current_revision_fixer',
-                      'current_revision_fixer2', 'fix_contact_details.py',
-                      'Repoint 410 Gone to webarchive url',
-                      'Fix duplicate resources',
-                      'fix_secondary_theme.py',
-                      )
-    system_author_template = 'script%'  # "%" is a wildcard
 
     if organization_name:
         organization = model.Group.by_name(organization_name)
         if not organization:
             raise p.toolkit.ObjectNotFound()
-
-    if not organization_name:
-        pkgs = model.Session.query(model.Package)\
-                    .all()
-    else:
-        pkgs = model.Session.query(model.Package)
+        pkgs = model.Session.query(model.Package.id)
         pkgs = lib.filter_by_organizations(pkgs, organization,
-                                           include_sub_organizations).all()
+                                           include_sub_organizations)
+        package_ids = set(row[0] for row in pkgs)
+    else:
+        package_ids = None  # all of them
+
+    return _activity_of_packages(_get_all_activity(periods), package_ids)
+
+
+def _activity_of_packages(activity, package_ids):
+    '''Picks out the rows of the given packages (or all if None) from the
+    result of _get_all_activity.'''
+    created = {}
+    modified = {}
+    for period_name, period_activity in activity['created'].iteritems():
+        created[period_name] = [
+            row for package_id, row in period_activity.iteritems()
+            if package_ids is None or package_id in package_ids]
+    for period_name, period_activity in activity['modified'].iteritems():
+        modified[period_name] = [
+            row for package_id, row in period_activity.iteritems()
+            if package_ids is None or package_id in package_ids]
+    return created, modified
 
-    for pkg in pkgs:
-        created_ = model.Session.query(model.PackageRevision)\
-            .filter(model.PackageRevision.id == pkg.id) \
-            .order_by("revision_timestamp asc").first()
-
-        pr_q = model.Session.query(model.PackageRevision, model.Revision)\
-            .filter(model.PackageRevision.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors)) \
-            .filter(~model.Revision.author.like(system_author_template))
-        rr_q = model.Session.query(model.Package, model.ResourceRevision, model.Revision)\
-            .filter(model.Package.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.ResourceGroup)\
-            .join(model.ResourceRevision,
-                  model.ResourceGroup.id == model.ResourceRevision.resource_group_id)\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors))\
-            .filter(~model.Revision.author.like(system_author_template))
-        pe_q = model.Session.query(model.Package, model.PackageExtraRevision, model.Revision)\
-            .filter(model.Package.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.PackageExtraRevision,
-                  model.Package.id == model.PackageExtraRevision.package_id)\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors))\
-            .filter(~model.Revision.author.like(system_author_template))
-
-        for period_name in periods:
-            period = periods[period_name]
-            # created
-            if period[0] < created_.revision_timestamp < period[1]:
+
+def _get_all_activity(periods):
+    '''Returns the activity of all datasets in the periods, calculating it
+    if it is not cached.'''
+    import time
+    key = tuple(sorted(periods.items()))
+    cached = _activity_cache.get(key)
+    if cached and time.time() - cached[0] < ACTIVITY_CACHE_SECONDS:
+        return cached[1]
+    activity = _calculate_activity(periods)
+    _activity_cache.clear()
+    _activity_cache[key] = (time.time(), activity)
+    return activity
+
+
+def _calculate_activity(periods):
+    '''Works out which datasets were created and modified in each of the
+    periods, for all datasets at once, using a few grouped queries.
+
+    Returns {'created': {period_name: {package_id: row}},
+             'modified': {period_name: {package_id: row}},
+             'owner_org': {package_id: owner_org}}
+    '''
+    import ckan.model as model
+    from sqlalchemy import func, and_
+
+    PR = model.PackageRevision
+    start = min(period[0] for period in periods.values())
+    end = max(period[1] for period in periods.values())
+
+    # when each package was created i.e. its first revision
+    first_revision = model.Session.query(
+        PR.id.label('package_id'),
+        func.min(PR.revision_timestamp).label('created')) \
+        .group_by(PR.id) \
+        .subquery()
+
+    # created
+    created_revisions = {}  # package_id: (name, title, timestamp, author)
+    q = model.Session.query(PR.id, PR.name, PR.title, PR.revision_timestamp,
+                            model.Revision.author) \
+        .join(first_revision,
+              and_(PR.id == first_revision.c.package_id,
+                   PR.revision_timestamp == first_revision.c.created)) \
+        .join(model.Revision, PR.revision_id == model.Revision.id) \
+        .filter(PR.revision_timestamp > start) \
+        .filter(PR.revision_timestamp < end)
+    for package_id, name, title, timestamp, author in q:
+        created_revisions[package_id] = (name, title, timestamp, author)
+
+    # modified - the package, its resources and its extras, excluding the
+    # creation revision and those by system authors. The resource and extra
+    # revisions are only counted for packages that are active.
+    date_ = func.date(model.Revision.timestamp)
+    modified_queries = (
+        (model.Session.query(PR.id, model.Revision.author, date_)
+         .join(model.Revision, PR.revision_id == model.Revision.id)
+         .filter(PR.state == 'active'),
+         PR.id, PR.revision_timestamp),
+        (model.Session.query(model.Package.id, model.Revision.author, date_)
+         .join(model.ResourceGroup,
+               model.ResourceGroup.package_id == model.Package.id)
+         .join(model.ResourceRevision,
+               model.ResourceGroup.id ==
+               model.ResourceRevision.resource_group_id)
+         .join(model.Revision,
+               model.ResourceRevision.revision_id == model.Revision.id)
+         .filter(model.Package.state == 'active'),
+         model.Package.id, model.ResourceRevision.revision_timestamp),
+        (model.Session.query(model.Package.id, model.Revision.author, date_)
+         .join(model.PackageExtraRevision,
+               model.Package.id == model.PackageExtraRevision.package_id)
+         .join(model.Revision,
+               model.PackageExtraRevision.revision_id == model.Revision.id)
+         .filter(model.Package.state == 'active'),
+         model.Package.id, model.PackageExtraRevision.revision_timestamp),
+        )
+    # {period_name: {package_id: (authors, dates)}}
+    modifications = dict((period_name, collections.defaultdict(
+        lambda: (set(), set()))) for period_name in periods)
+    for q, package_id_column, timestamp_column in modified_queries:
+        q = q.join(first_revision,
+                   package_id_column == first_revision.c.package_id) \
+            .filter(timestamp_column > first_revision.c.created) \
+            .filter(~model.Revision.author.in_(activity_system_authors)) \
+            .filter(~model.Revision.author.like(
+                activity_system_author_template)) \
+            .group_by(package_id_column, model.Revision.author, date_)
+        for period_name, period in periods.iteritems():
+            period_q = q.filter(timestamp_column > period[0]) \
+                        .filter(timestamp_column < period[1])
+            for package_id, author, date in period_q:
+                authors, dates = modifications[period_name][package_id]
+                authors.add(author)
+                dates.add(date)
+
+    # details of the packages involved
+    package_ids = set(created_revisions)
+    for period_modifications in modifications.values():
+        package_ids.update(period_modifications)
+    pkgs = {}
+    package_ids = list(package_ids)
+    for i in xrange(0, len(package_ids), 1000):
+        q = model.Session.query(model.Package) \
+            .filter(model.Package.id.in_(package_ids[i:i + 1000])) \
+            .options(orm.subqueryload('_extras'))
+        for pkg in q:
+            pkgs[pkg.id] = pkg
+
+    activity = {'created': {}, 'modified': {},
+                'owner_org': dict((id_, pkg.owner_org)
+                                  for id_, pkg in pkgs.iteritems())}
+    for period_name, period in periods.iteritems():
+        created = activity['created'][period_name] = {}
+        for package_id, (name, title, timestamp, author) in \
+                created_revisions.iteritems():
+            pkg = pkgs.get(package_id)
+            if pkg and period[0] < timestamp < period[1]:
                 published = not asbool(pkg.extras.get('unpublished'))
-                created[period_name].append(
-                    (created_.name, created_.title, lib.dataset_notes(pkg),
-                     'created', period_name,
-                     created_.revision_timestamp.isoformat(),
-                     created_.revision.author, published))
-
-            # modified
-            # exclude the creation revision
-            period_start = max(period[0], created_.revision_timestamp)
-            prs = pr_q.filter(model.PackageRevision.revision_timestamp > period_start)\
-                        .filter(model.PackageRevision.revision_timestamp < period[1])
-            rrs = rr_q.filter(model.ResourceRevision.revision_timestamp > period_start)\
-                        .filter(model.ResourceRevision.revision_timestamp < period[1])
-            pes = pe_q.filter(model.PackageExtraRevision.revision_timestamp > period_start)\
-                        .filter(model.PackageExtraRevision.revision_timestamp < period[1])
-            authors = ' '.join(set([r[1].author for r in prs] +
-                                   [r[2].author for r in rrs] +
-                                   [r[2].author for r in pes]))
-            dates = set([r[1].timestamp.date() for r in prs] +
-                        [r[2].timestamp.date() for r in rrs] +
-                        [r[2].timestamp.date() for r in pes])
+                created[package_id] = (
+                    name, title, lib.dataset_notes(pkg),
+                    'created', period_name, timestamp.isoformat(),
+                    author, published)
+        modified = activity['modified'][period_name] = {}
+        for package_id, (authors, dates) in \
+                modifications[period_name].iteritems():
+            pkg = pkgs.get(package_id)
+            if not pkg:
+                continue
+            published = not asbool(pkg.extras.get('unpublished'))
             dates_formatted = ' '.join([date.isoformat()
                                         for date in sorted(dates)])
-            if authors:
-                published = not asbool(pkg.extras.get('unpublished'))
-                modified[period_name].append(
-                    (pkg.name, pkg.title, lib.dataset_notes(pkg),
-                        'modified', period_name,
-                        dates_formatted, authors, published))
-    return created, modified
+            modified[package_id] = (
+                pkg.name, pkg.title, lib.dataset_notes(pkg),
+                'modified', period_name,
+                dates_formatted, ' '.join(sorted(authors)), published)
+    return activity
 
 
 def publisher_activity_combinations():
@@ -389,29 +519,28 @@ publisher_activity_report_info = {
     }
 
 
+@report_scan.register
+class UnpublishedDatasets(report_scan.CatalogueReport):
+    def __init__(self):
+        self.rows = []
+
+    def add(self, dataset):
+        if dataset.extras.get('unpublished') != 'true':
+            return
+        self.rows.append({
+                'name': dataset.name,
+                'title': dataset.title,
+                'organization title': dataset.organization_title,
+                'organization name': dataset.organization_name,
+                'notes': dataset.notes,
+                'publish date': dataset.extras.get('publish-date'),
+                'will not be released': dataset.extras.get('publish-restricted'),
+                'release notes': dataset.extras.get('release-notes'),
+                })
+
+
 def unpublished():
-    pkgs = model.Session.query(model.Package)\
-                .filter_by(state='active')\
-                .join(model.PackageExtra)\
-                .filter_by(key='unpublished')\
-                .filter_by(value='true')\
-                .filter_by(state='active')\
-                .all()
-    pkg_dicts = []
-    for pkg in pkgs:
-        org = pkg.get_organization()
-        pkg_dict = {
-                'name': pkg.name,
-                'title': pkg.title,
-                'organization title': org.title,
-                'organization name': org.name,
-                'notes': pkg.notes,
-                'publish date': pkg.extras.get('publish-date'),
-                'will not be released': pkg.extras.get('publish-restricted'),
-                'release notes': pkg.extras.get('release-notes'),
-                }
-        pkg_dicts.append(pkg_dict)
-    return {'table': pkg_dicts}
+    return {'table': report_scan.get_report(UnpublishedDatasets).rows}
 
 unpublished_report_info = {
     'name': 'unpublished',
@@ -445,23 +574,31 @@ def last_resource_deleted(pkg):
         previous_rr = rr
     return None, ''
 
+@report_scan.register
+class DatasetsWithoutResources(report_scan.CatalogueReport):
+    def __init__(self):
+        self.datasets = []
+
+    def add(self, dataset):
+        if dataset.resources or \
+                dataset.extras.get('unpublished', '').lower() == 'true':
+            return
+        self.datasets.append(dataset)
+
+    def finish(self):
+        self.datasets.sort(key=lambda d: d.title)
+
+
 def datasets_without_resources():
     pkg_dicts = []
-    pkgs = model.Session.query(model.Package)\
-                .filter_by(state='active')\
-                .order_by(model.Package.title)\
-                .all()
-    for pkg in add_progress_bar(pkgs):
-        if len(pkg.resources) != 0 or \
-                pkg.extras.get('unpublished', '').lower() == 'true':
-            continue
-        org = pkg.get_organization()
+    datasets = report_scan.get_report(DatasetsWithoutResources).datasets
+    for pkg in add_progress_bar(datasets):
         deleted, url = last_resource_deleted(pkg)
         pkg_dict = OrderedDict((
             ('name', pkg.name),
             ('title', pkg.title),
-            ('organization title', org.title),
-            ('organization name', org.name),
+            ('organization title', pkg.organization_title),
+            ('organization name', pkg.organization_name),
             ('metadata created', pkg.metadata_created.isoformat()),
             ('metadata modified', pkg.metadata_modified.isoformat()),
             ('last resource deleted', deleted.isoformat() if deleted else None),
@@ -491,7 +628,8 @@ def app_dataset_report():
                         .all():
         dataset = related.dataset
         org = dataset.get_organization()
-        top_org = list(go_up_tree(org))[-1]
+        tree = publisher_tree()
+        top_org_id = tree.top_level_id(org.id) or org.id
 
         app_dataset_dict = OrderedDict((
             ('app title', related.related.title),
@@ -500,8 +638,10 @@ def app_dataset_report():
             ('dataset title', dataset.title),
             ('organization title', org.title),
             ('organization name', org.name),
-            ('top-level organization title', top_org.title),
-            ('top-level organization name', top_org.name),
+            ('top-level organization title', tree.title(top_org_id)
+             if top_org_id in tree.publishers else org.title),
+            ('top-level organization name', tree.name(top_org_id)
+             if top_org_id in tree.publishers else org.name),
             ('dataset theme', related.dataset.extras.get('theme-primary', '')),
             ('dataset notes', lib.dataset_notes(dataset)),
             ))
@@ -661,15 +801,13 @@ def user_is_admin(user, org=None):
 def user_is_rm(user, org=None):
     from pylons import config
     from ast import literal_eval
-    from ckanext.dgu.lib.publisher import go_up_tree
-
     relationship_managers = literal_eval(config.get('dgu.relationship_managers', '{}'))
 
     allowed_orgs = relationship_managers.get(user.name, [])
 
     if org:
-        for o in go_up_tree(org):
-            if o.name in allowed_orgs:
+        for name in publisher_tree().all_ancestor_names(org.id):
+            if name in allowed_orgs:
                 return True
 
         return False
@@ -748,48 +886,58 @@ la_schemas_info = {
 
 # Licence report
 
+@report_scan.register
+class DatasetLicences(report_scan.CatalogueReport):
+    def __init__(self):
+        # {owner_org: {licence_tuple: [(name, title), ...]}}
+        self.packages_by_org = collections.defaultdict(
+            lambda: collections.defaultdict(list))
+        self.license_register = model.Package.get_license_register()
+
+    def add(self, dataset):
+        if asbool(dataset.extras.get('unpublished')) is True:
+            # Ignore unpublished datasets
+            return
+        license = self.license_register.get(dataset.license_id) \
+            if dataset.license_id else None
+        licence_tuple = (dataset.license_id or '',
+                         license.title if license else '',
+                         dataset.extras.get('licence', ''))
+        self.packages_by_org[dataset.owner_org][licence_tuple].append(
+            (dataset.name, dataset.title))
+
+
 def licence_report(organization=None, include_sub_organizations=False):
     '''
     Returns a dictionary detailing licences for datasets in the
     organisation specified, and optionally sub organizations.
     '''
-    # Get packages
+    packages_by_org = \
+        report_scan.get_report(DatasetLicences).packages_by_org
+
+    # Get the organizations
     if organization:
         top_org = model.Group.by_name(organization)
         if not top_org:
             raise p.toolkit.ObjectNotFound('Publisher not found')
 
         if include_sub_organizations:
-            orgs = lib.go_down_tree(top_org)
+            org_ids = publisher_tree().descendant_ids(top_org.id) or \
+                [top_org.id]
         else:
-            orgs = [top_org]
-        pkgs = set()
-        for org in orgs:
-            org_pkgs = model.Session.query(model.Package)\
-                            .filter_by(state='active')
-            org_pkgs = lib.filter_by_organizations(
-                org_pkgs, organization,
-                include_sub_organizations=False)\
-                .all()
-            pkgs |= set(org_pkgs)
+            org_ids = [top_org.id]
     else:
-        pkgs = model.Session.query(model.Package)\
-                    .filter_by(state='active')\
-                    .all()
+        org_ids = packages_by_org.keys()
 
     # Get their licences
     packages_by_licence = collections.defaultdict(list)
     rows = []
     num_pkgs = 0
-    for pkg in pkgs:
-        if asbool(pkg.extras.get('unpublished')) is True:
-            # Ignore unpublished datasets
-            continue
-        licence_tuple = (pkg.license_id or '',
-                         pkg.license.title if pkg.license else '',
-                         pkg.extras.get('licence', ''))
-        packages_by_licence[licence_tuple].append((pkg.name, pkg.title))
-        num_pkgs += 1
+    for org_id in org_ids:
+        for licence_tuple, dataset_tuples in \
+                packages_by_org.get(org_id, {}).iteritems():
+            packages_by_licence[licence_tuple].extend(dataset_tuples)
+            num_pkgs += len(dataset_tuples)
 
     for licence_tuple, dataset_tuples in sorted(packages_by_licence.items(),
                                                 key=lambda x: -len(x[1])):
@@ -831,63 +979,79 @@ licence_report_info = {
     }
 
 
-# Datasets only in PDF
+# Datasets only in PDF / HTML
 
-def pdf_datasets_report():
-    '''
-    Returns datasets that have data in PDF format, by organization.
-    '''
-    # Get packages
-    pkgs = model.Session.query(model.Package)\
-                .filter_by(state='active')
+class DatasetsOnlyInFormat(report_scan.CatalogueReport):
+    '''Finds the published datasets whose data is only in a particular
+    format, by organization. Subclasses set the format and the formats that
+    are ignored alongside it.'''
+    format = None
+    ignored_formats = set()
+
+    def __init__(self):
+        self.num_datasets_published = 0
+        self.num_datasets_only_format = 0
+        # {org_id: [(name, title), ...]}
+        self.datasets_by_publisher = collections.defaultdict(list)
+
+    def add(self, dataset):
+        if p.toolkit.asbool(dataset.extras.get('unpublished')):
+            return
+        self.num_datasets_published += 1
 
-    # See if PDF
-    num_datasets_published = 0
-    num_datasets_only_pdf = 0
-    datasets_by_publisher_only_pdf = collections.defaultdict(list)
-    # use yield_per, otherwise memory use just goes up til the script is killed
-    # by the os.
-    for pkg in pkgs.yield_per(100):
-        if p.toolkit.asbool(pkg.extras.get('unpublished')):
-            continue
-        num_datasets_published += 1
-
-        formats = set([res.format.lower() for res in pkg.resources
+        formats = set([(res.format or '').lower()
+                       for res in dataset.resources
                        if res.resource_type != 'documentation'])
-        if 'pdf' not in formats:
-            continue
-        org = pkg.get_organization().name
+        if self.format not in formats:
+            return
+        data_formats = formats - self.ignored_formats
+        if data_formats == set((self.format,)) and dataset.organization_name:
+            self.num_datasets_only_format += 1
+            self.datasets_by_publisher[dataset.owner_org].append(
+                (dataset.name, dataset.title))
+
+    def rows(self, format_name):
+        tree = publisher_tree()
+        rows = []
+        for org_id, datasets_only_format in sorted(
+                self.datasets_by_publisher.iteritems(),
+                key=lambda x: -len(x[1])):
+            top_org_id = tree.ancestor_ids(org_id)[-1]
+            rows.append(OrderedDict((
+                ('organization title', tree.title(org_id)),
+                ('organization name', tree.name(org_id)),
+                ('top-level organization title', tree.title(top_org_id)),
+                ('top-level organization name', tree.name(top_org_id)),
+                ('num datasets only %s' % format_name,
+                 len(datasets_only_format)),
+                ('name datasets only %s' % format_name,
+                 ' '.join(d[0] for d in datasets_only_format)),
+                ('title datasets only %s' % format_name,
+                 '|'.join(d[1] for d in datasets_only_format)),
+                )))
+        return rows
 
-        data_formats = formats - set(('html', '', None))
-        if data_formats == set(('pdf',)):
-            num_datasets_only_pdf += 1
-            datasets_by_publisher_only_pdf[org].append((pkg.name, pkg.title))
 
-    rows = []
-    for org_name, datasets_only_pdf in sorted(
-            datasets_by_publisher_only_pdf.iteritems(),
-            key=lambda x: -len(x[1])):
-        org = model.Session.query(model.Group) \
-                   .filter_by(name=org_name) \
-                   .first()
-        top_org = list(go_up_tree(org))[-1]
+@report_scan.register
+class DatasetsOnlyInPdf(DatasetsOnlyInFormat):
+    format = 'pdf'
+    ignored_formats = set(('html', ''))
 
-        row = OrderedDict((
-            ('organization title', org.title),
-            ('organization name', org.name),
-            ('top-level organization title', top_org.title),
-            ('top-level organization name', top_org.name),
-            ('num datasets only pdf', len(datasets_only_pdf)),
-            ('name datasets only pdf',
-             ' '.join(d[0] for d in datasets_only_pdf)),
-            ('title datasets only pdf',
-             '|'.join(d[1] for d in datasets_only_pdf)),
-            ))
-        rows.append(row)
 
-    return {'table': rows,
-            'num_datasets_published': num_datasets_published,
-            'num_datasets_only_pdf': num_datasets_only_pdf,
+@report_scan.register
+class DatasetsOnlyInHtml(DatasetsOnlyInFormat):
+    format = 'html'
+    ignored_formats = set(('asp', ''))
+
+
+def pdf_datasets_report():
+    '''
+    Returns datasets that have data in PDF format, by organization.
+    '''
+    report = report_scan.get_report(DatasetsOnlyInPdf)
+    return {'table': report.rows('pdf'),
+            'num_datasets_published': report.num_datasets_published,
+            'num_datasets_only_pdf': report.num_datasets_only_format,
             }
 
 
@@ -902,63 +1066,14 @@ pdf_datasets_report_info = {
     }
 
 
-# Datasets with HTML link
-
 def html_datasets_report():
     '''
     Returns datasets that only have an HTML link, by organization.
     '''
-    # Get packages
-    pkgs = model.Session.query(model.Package)\
-                .filter_by(state='active')
-
-    # See if HTML
-    num_datasets_published = 0
-    num_datasets_only_html = 0
-    datasets_by_publisher_only_html = collections.defaultdict(list)
-    # use yield_per, otherwise memory use just goes up til the script is killed
-    # by the os.
-    for pkg in pkgs.yield_per(100):
-        if p.toolkit.asbool(pkg.extras.get('unpublished')):
-            continue
-        num_datasets_published += 1
-
-        formats = set([res.format.lower() for res in pkg.resources
-                       if res.resource_type != 'documentation'])
-        if 'html' not in formats:
-            continue
-        org = pkg.get_organization().name
-
-        data_formats = formats - set(('asp', '', None))
-        if data_formats == set(('html',)):
-            num_datasets_only_html += 1
-            datasets_by_publisher_only_html[org].append((pkg.name, pkg.title))
-
-    rows = []
-    for org_name, datasets_only_html in sorted(
-            datasets_by_publisher_only_html.iteritems(),
-            key=lambda x: -len(x[1])):
-        org = model.Session.query(model.Group) \
-                   .filter_by(name=org_name) \
-                   .first()
-        top_org = list(go_up_tree(org))[-1]
-
-        row = OrderedDict((
-            ('organization title', org.title),
-            ('organization name', org.name),
-            ('top-level organization title', top_org.title),
-            ('top-level organization name', top_org.name),
-            ('num datasets only html', len(datasets_only_html)),
-            ('name datasets only html',
-             ' '.join(d[0] for d in datasets_only_html)),
-            ('title datasets only html',
-             '|'.join(d[1] for d in datasets_only_html)),
-            ))
-        rows.append(row)
-
-    return {'table': rows,
-            'num_datasets_published': num_datasets_published,
-            'num_datasets_only_html': num_datasets_only_html,
+    report = report_scan.get_report(DatasetsOnlyInHtml)
+    return {'table': report.rows('html'),
+            'num_datasets_published': report.num_datasets_published,
+            'num_datasets_only_html': report.num_datasets_only_format,
             }
 
 
@@ -7,7 +7,6 @@ from collections import defaultdict
 # Use nltk.download() to get the 'stopwords' corpus
 import nltk
 from nltk.corpus import stopwords
-from nltk.util import bigrams, trigrams
 import sqlalchemy
 
 from ckanext.dgu.schema import tag_munge
@@ -100,12 +99,32 @@ class Themes(object):
         self.topic_words_set = self.topic_words.viewkeys() # can do set-like operations on it
         self.topic_bigrams_set = self.topic_bigrams.viewkeys()
         self.topic_trigrams_set = self.topic_trigrams.viewkeys()
-
+        # first words of the bigrams & trigrams, so most words can be
+        # passed over without looking up the ngrams that start with them
+        self.topic_first_words = frozenset(
+            ngram[0] for ngram in self.topic_bigrams.keys() +
+            self.topic_trigrams.keys())
+        # Position of each topic in its dict. Matches are sorted into this
+        # order, so that the reasons come out in a consistent order.
+        self.topic_order = {}
+        for topic_dict in (self.topic_words, self.topic_bigrams,
+                           self.topic_trigrams):
+            for i, ngram in enumerate(topic_dict):
+                self.topic_order[ngram] = i
+
+
+_stopwords = None
+def english_stopwords():
+    global _stopwords
+    if _stopwords is None:
+        _stopwords = frozenset(stopwords.words('english'))
+    return _stopwords
 
 def normalize_text(text):
     words = [normalize_token(w) for w in split_words(text)]
+    stopwords_ = english_stopwords()
     words_without_stopwords = [word for word in words
-            if word not in stopwords.words('english')]
+            if word not in stopwords_]
     return words, words_without_stopwords
 
 def split_words(sentence):
@@ -118,15 +137,22 @@ def split_words(sentence):
 stem_exceptions = set(('parking', 'national', 'coordinates', 'granted', 'hospitality', 'employers', 'employer', 'employee', 'employees', 'nhs', 'consultation'))
 
 porter = None
+# stemming is slow, and the vocabulary is small, so the results are kept
+_normalized_tokens = {}  # token:normalized_token
 def normalize_token(token):
     global porter
+    if token in _normalized_tokens:
+        return _normalized_tokens[token]
     if not porter:
         porter = nltk.PorterStemmer()
-    token = re.sub('[^\w]', '', token)
-    token = token.lower()
-    if token not in stem_exceptions:
-        token = porter.stem(token)
-    return token
+    normalized_token = re.sub('[^\w]', '', token)
+    normalized_token = normalized_token.lower()
+    if normalized_token not in stem_exceptions:
+        normalized_token = porter.stem(normalized_token)
+    if len(_normalized_tokens) > 100000:
+        _normalized_tokens.clear()
+    _normalized_tokens[token] = normalized_token
+    return normalized_token
 
 def dictize_package_nice(pkg):
     # package comes in as dict or an object. Convert both to a convenient dict.
@@ -225,38 +251,62 @@ def categorize_package2(pkg, stats=None):
 
     return theme_scores
 
+def count_topics(words, themes):
+    '''Finds the topics in the (normalized) words, in a single pass over them.
+
+    Returns a dict of occurrences for each length of topic:
+        ({topic_word: count}, {topic_bigram: count}, {topic_trigram: count})
+    Stopwords don't count as topic words, but can be part of bigrams and
+    trigrams.
+    '''
+    stopwords_ = english_stopwords()
+    topic_words = themes.topic_words
+    topic_bigrams = themes.topic_bigrams
+    topic_trigrams = themes.topic_trigrams
+    first_words = themes.topic_first_words
+    word_counts, bigram_counts, trigram_counts = {}, {}, {}
+    num_words = len(words)
+    for i, word in enumerate(words):
+        if word in topic_words and word not in stopwords_:
+            word_counts[word] = word_counts.get(word, 0) + 1
+        if word not in first_words:
+            continue
+        if i + 1 < num_words:
+            bigram = (word, words[i + 1])
+            if bigram in topic_bigrams:
+                bigram_counts[bigram] = bigram_counts.get(bigram, 0) + 1
+            if i + 2 < num_words:
+                trigram = bigram + (words[i + 2],)
+                if trigram in topic_trigrams:
+                    trigram_counts[trigram] = \
+                        trigram_counts.get(trigram, 0) + 1
+    return word_counts, bigram_counts, trigram_counts
+
 def score_by_topic(pkg, scores):
     '''Examines the pkg and adds scores according to topics in it.'''
     themes = Themes.instance()
     for level in range(3):
         pkg_text = package_text(pkg, level)
         words, words_without_stopwords = normalize_text(pkg_text)
-        for num_words in (1, 2, 3):
-            if num_words == 1:
-                ngrams = words_without_stopwords
-                topic_ngrams = themes.topic_words
-                topic_ngrams_set = themes.topic_words_set
-            elif num_words == 2:
-                ngrams = bigrams(words)
-                topic_ngrams = themes.topic_bigrams
-                topic_ngrams_set = themes.topic_bigrams_set
-            elif num_words == 3:
-                ngrams = trigrams(words)
-                topic_ngrams = themes.topic_trigrams
-                topic_ngrams_set = themes.topic_trigrams_set
-            matching_ngrams = set(ngrams) & topic_ngrams_set
-            if matching_ngrams:
-                for ngram in matching_ngrams:
-                    occurrences = ngrams.count(ngram)
-                    score = (3-level) * occurrences * num_words
-                    themes_for_ngram = topic_ngrams[ngram]
-                    ngram_printable = ' '.join(ngram) if isinstance(ngram, tuple) else ngram
-                    reason = '"%s" matched %s' % (ngram_printable, LEVELS[level])
-                    if occurrences > 1:
-                        reason += ' (%s times)' % occurrences
-                    for theme in themes_for_ngram:
-                        scores[theme].append((score, reason))
-                    log.debug(' %s %s %s', theme, score, reason)
+        topic_counts = count_topics(words, themes)
+        topic_dicts = (themes.topic_words, themes.topic_bigrams,
+                       themes.topic_trigrams)
+        for num_words, counts, topic_ngrams in \
+                zip((1, 2, 3), topic_counts, topic_dicts):
+            # in the order of the topic dicts, so the reasons come out in a
+            # consistent order
+            matching_ngrams = sorted(counts, key=themes.topic_order.get)
+            for ngram in matching_ngrams:
+                occurrences = counts[ngram]
+                score = (3-level) * occurrences * num_words
+                themes_for_ngram = topic_ngrams[ngram]
+                ngram_printable = ' '.join(ngram) if isinstance(ngram, tuple) else ngram
+                reason = '"%s" matched %s' % (ngram_printable, LEVELS[level])
+                if occurrences > 1:
+                    reason += ' (%s times)' % occurrences
+                for theme in themes_for_ngram:
+                    scores[theme].append((score, reason))
+                log.debug(' %s %s %s', theme, score, reason)
 
 def score_by_gemet(pkg, scores):
     if pkg['extras'].get('UKLP') != 'True':
@@ -391,3 +441,134 @@ def package_text(package, level):
     elif level == 2:
         return package['notes'] or ''
 
+
+
+# Extras that the theme scoring looks at
+THEME_EXTRAS = ('UKLP', 'external_reference', 'la_function', 'la_service',
+                'dcat_subject', PRIMARY_THEME, SECONDARY_THEMES)
+
+def load_package_dicts(package_ids):
+    '''Returns dicts of the given datasets in the form that
+    categorize_package2 takes (plus the id), loaded with a query each for the
+    datasets, their tags and the extras in THEME_EXTRAS, rather than lazily
+    per dataset.
+    '''
+    package_ids = list(package_ids)
+    if not package_ids:
+        return []
+    pkg_dicts = {}
+    q = model.Session.query(model.Package.id, model.Package.name,
+                            model.Package.title, model.Package.notes) \
+        .filter(model.Package.id.in_(package_ids))
+    for id_, name, title, notes in q:
+        pkg_dicts[id_] = {'id': id_, 'name': name, 'title': title,
+                          'notes': notes, 'tags': [], 'extras': {}}
+    q = model.Session.query(model.PackageTag.package_id, model.Tag.name) \
+        .join(model.Tag, model.Tag.id == model.PackageTag.tag_id) \
+        .filter(model.PackageTag.package_id.in_(package_ids)) \
+        .filter(model.PackageTag.state == 'active') \
+        .filter(model.Tag.vocabulary_id == None) \
+        .order_by(model.Tag.name)
+    for package_id, tag_name in q:
+        pkg_dicts[package_id]['tags'].append(tag_name)
+    q = model.Session.query(model.PackageExtra.package_id,
+                            model.PackageExtra.key, model.PackageExtra.value) \
+        .filter(model.PackageExtra.package_id.in_(package_ids)) \
+        .filter(model.PackageExtra.key.in_(THEME_EXTRAS)) \
+        .filter(model.PackageExtra.state == 'active')
+    for package_id, key, value in q:
+        pkg_dicts[package_id]['extras'][key] = value
+    return [pkg_dicts[id_] for id_ in package_ids if id_ in pkg_dicts]
+
+def _categorize_package_dicts(pkg_dicts):
+    return [(pkg_dict, categorize_package2(pkg_dict))
+            for pkg_dict in pkg_dicts]
+
+def categorize_packages(package_ids, processes=1, chunk_size=200):
+    '''Categorizes many datasets, loading them in chunks (see
+    load_package_dicts) and, if processes > 1, scoring the chunks across a
+    pool of processes. The database is only used by this process.
+
+    Yields (pkg_dict, themes) in the order of package_ids, where themes is
+    as returned by categorize_package2.
+    '''
+    package_ids = list(package_ids)
+    chunks = (package_ids[i:i + chunk_size]
+              for i in xrange(0, len(package_ids), chunk_size))
+    if processes <= 1:
+        for chunk in chunks:
+            for result in _categorize_package_dicts(load_package_dicts(chunk)):
+                yield result
+        return
+
+    from multiprocessing import Pool
+    # the workers get the themes data when they fork, so they don't need
+    # the database
+    Themes.instance()
+    # DB connections must not be shared with the forked workers
+    model.Session.remove()
+    model.meta.engine.dispose()
+    pool = Pool(processes)
+    try:
+        # keep a few chunks queued for each worker, but no more, so memory
+        # use is bounded
+        pending = []
+        for chunk in chunks:
+            pending.append(pool.apply_async(_categorize_package_dicts,
+                                            (load_package_dicts(chunk),)))
+            if len(pending) >= processes * 2:
+                for result in pending.pop(0).get():
+                    yield result
+        for async_result in pending:
+            for result in async_result.get():
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def theme_suggestion(themes):
+    '''Formats the output of categorize_package2 as returned by the
+    suggest_themes action.'''
+    results = {'primary-theme': {}, 'secondary-theme': []}
+    if len(themes) >= 1:
+        results['primary-theme'] = themes[0]
+
+    results['secondary-theme'] = themes[1:]
+    return results
+
+def write_themes_in_bulk(themes_by_package_id, author='autotheme',
+                         batch_size=500):
+    '''Sets the primary theme (and secondary theme, if there is one) of
+    datasets, given {package_id: themes} (as returned by
+    categorize_package2). The existing extras are loaded, and changes
+    committed, a batch of datasets at a time, each batch in a revision.
+    '''
+    package_ids = themes_by_package_id.keys()
+    for i in xrange(0, len(package_ids), batch_size):
+        batch_ids = package_ids[i:i + batch_size]
+        rev = model.repo.new_revision()
+        rev.author = author
+        rev.message = 'Set themes automatically'
+        extras = {}  # (package_id, key): PackageExtra
+        q = model.Session.query(model.PackageExtra) \
+            .filter(model.PackageExtra.package_id.in_(batch_ids)) \
+            .filter(model.PackageExtra.key.in_((PRIMARY_THEME,
+                                                SECONDARY_THEMES)))
+        for extra in q:
+            extras[(extra.package_id, extra.key)] = extra
+        for package_id in batch_ids:
+            themes = themes_by_package_id[package_id]
+            values = {PRIMARY_THEME: themes[0]['name']}
+            if len(themes) > 1:
+                values[SECONDARY_THEMES] = '["%s"]' % themes[1]['name']
+            for key, value in values.items():
+                extra = extras.get((package_id, key))
+                if extra is None:
+                    extra = model.PackageExtra(package_id=package_id,
+                                               key=key)
+                    model.Session.add(extra)
+                extra.value = value
+                extra.state = 'active'
+        model.repo.commit_and_remove()
+        log.info('Written themes: %s/%s datasets',
+                 min(i + batch_size, len(package_ids)), len(package_ids))
@@ -1,11 +1,12 @@
 from ckan.logic import get_or_bust
-from ckan.logic import NotFound, check_access
+from ckan.logic import NotFound, ValidationError, check_access
 from ckan.logic import side_effect_free
 import ckan.lib.dictization.model_dictize as model_dictize
 from ckan import plugins
 import ckan.lib.plugins as lib_plugins
 from ckan.lib.navl.dictization_functions import validate
 from ckan.logic.action.get import organization_show
+from sqlalchemy import or_
 from ckanext.dgu.model.schema_codelist import Schema, Codelist
 
 #from ckan.plugins.toolkit as t
@@ -42,7 +43,7 @@ def suggest_themes(context, data_dict):
     to the categorisation, otherwise it will be formatted as per the required
     dictionary.
     '''
-    from ckanext.dgu.lib.theme import categorize_package2
+    from ckanext.dgu.lib.theme import categorize_package2, theme_suggestion
     themes = []
 
     # TODO: Make this only available to logged in publishers
@@ -62,26 +63,67 @@ def suggest_themes(context, data_dict):
                     }
         themes = categorize_package2(pkg_dict)
 
-    results = {'primary-theme': {}, 'secondary-theme': []}
-    if len(themes) >= 1:
-        results['primary-theme'] = themes[0]
+    return theme_suggestion(themes)
 
-    results['secondary-theme'] = themes[1:]
+@side_effect_free
+def suggest_themes_batch(context, data_dict):
+    '''Suggests themes for many datasets at once, loading them in bulk.
+
+    :param ids: names or ids of the datasets (list or comma-separated)
+    :param organization: name or id of a publisher, to do its datasets
+        (instead of ids)
+    :param limit: maximum number of datasets (default and maximum 1000)
+
+    :returns: a list of dicts with the 'id' and 'name' of each dataset,
+        its 'current-theme', and 'primary-theme' and 'secondary-theme' as
+        returned by suggest_themes
+    '''
+    from ckanext.dgu.lib.theme import (categorize_packages, theme_suggestion,
+                                       PRIMARY_THEME)
+    check_access('suggest_themes_batch', context, data_dict)
 
+    model = context['model']
+    try:
+        limit = min(int(data_dict.get('limit', 1000)), 1000)
+    except ValueError:
+        raise ValidationError({'limit': ['Invalid integer']})
+
+    ids = data_dict.get('ids')
+    if ids:
+        if isinstance(ids, basestring):
+            ids = ids.split(',')
+        q = model.Session.query(model.Package.id) \
+                 .filter(or_(model.Package.id.in_(ids),
+                             model.Package.name.in_(ids)))
+    elif data_dict.get('organization'):
+        org = model.Group.get(data_dict['organization'])
+        if not org:
+            raise NotFound('Organization not found')
+        q = model.Session.query(model.Package.id) \
+                 .filter_by(owner_org=org.id) \
+                 .order_by(model.Package.name)
+    else:
+        raise ValidationError({'ids': ['Specify ids or an organization']})
+    package_ids = [row[0] for row in
+                   q.filter(model.Package.state == 'active').limit(limit)]
+
+    results = []
+    for pkg_dict, themes in categorize_packages(package_ids):
+        result = theme_suggestion(themes)
+        result['id'] = pkg_dict['id']
+        result['name'] = pkg_dict['name']
+        result['current-theme'] = pkg_dict['extras'].get(PRIMARY_THEME)
+        results.append(result)
     return results
 
 @side_effect_free
 def schema_list(context, data_dict):
     check_access('schema_list', context, data_dict)
 
-    model = context['model']
-    items = model.Session.query(Schema).order_by('title')
-    return [item.as_dict() for item in items.all()]
+    return Schema.cached_list()
 
 @side_effect_free
 def codelist_list(context, data_dict):
     check_access('codelist_list', context, data_dict)
 
-    model = context['model']
-    items = model.Session.query(Codelist).order_by('title')
-    return [item.as_dict() for item in items.all()]
+    return Codelist.cached_list()
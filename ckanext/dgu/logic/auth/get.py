@@ -15,3 +15,10 @@ def codelist_list(context=None, data_dict=None):
     This is always yes.
     """
     return {'success': True}
+
+def suggest_themes_batch(context=None, data_dict=None):
+    """
+    Suggesting themes in bulk is for sysadmins only (who are allowed
+    regardless), as it can be heavy.
+    """
+    return {'success': False}
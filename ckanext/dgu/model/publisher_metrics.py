@@ -0,0 +1,116 @@
+import json
+import time
+import datetime
+
+from sqlalchemy import Column, types
+from sqlalchemy.ext.declarative import declarative_base
+
+from ckan import model
+
+Base = declarative_base()
+
+
+class PublisherMetrics(Base):
+    """
+    Precomputed figures for a publisher's performance traffic lights, so that
+    the publisher page doesn't have to run the queries itself. There is a row
+    for the publisher on its own and one including its sub-publishers.
+
+    Kept up to date by: paster publisher_metrics update
+    """
+    __tablename__ = 'publisher_metrics'
+
+    publisher_id = Column(types.UnicodeText, primary_key=True)
+    include_sub_publishers = Column(types.Boolean, primary_key=True)
+    resource_count = Column(types.Integer, nullable=False, default=0)
+    broken_count = Column(types.Integer, nullable=False, default=0)
+    # JSON {score: count} e.g. {"0": 3, "3": 10}
+    openness_scores_json = Column(types.UnicodeText, nullable=False,
+                                  default=u'{}')
+    issues_older_than_fortnight = Column(types.Boolean, nullable=False,
+                                         default=False)
+    issues_older_than_month = Column(types.Boolean, nullable=False,
+                                     default=False)
+    updated = Column(types.DateTime, nullable=False,
+                     default=datetime.datetime.utcnow)
+
+    @property
+    def openness_scores(self):
+        return json.loads(self.openness_scores_json)
+
+    def as_dict(self):
+        return {'resource_count': self.resource_count,
+                'broken_count': self.broken_count,
+                'openness_scores': self.openness_scores,
+                'issues_older_than_fortnight':
+                self.issues_older_than_fortnight,
+                'issues_older_than_month': self.issues_older_than_month,
+                'updated': self.updated}
+
+    @classmethod
+    def get(cls, publisher_id, include_sub_publishers):
+        return model.Session.query(cls).get(
+            (publisher_id, bool(include_sub_publishers)))
+
+    @classmethod
+    def set(cls, publisher_id, include_sub_publishers, metrics,
+            updated=None):
+        '''Creates or updates the row for the publisher with the values in
+        the metrics dict. updated should be when the calculation started, so
+        that changes made during it are picked up next time. Doesn't
+        commit.'''
+        row = cls.get(publisher_id, include_sub_publishers)
+        if not row:
+            row = cls(publisher_id=publisher_id,
+                      include_sub_publishers=bool(include_sub_publishers))
+            model.Session.add(row)
+        row.resource_count = metrics['resource_count']
+        row.broken_count = metrics['broken_count']
+        row.openness_scores_json = json.dumps(metrics['openness_scores'])
+        row.issues_older_than_fortnight = \
+            metrics['issues_older_than_fortnight']
+        row.issues_older_than_month = metrics['issues_older_than_month']
+        row.updated = updated or datetime.datetime.utcnow()
+        return row
+
+
+# (exists, time_checked)
+_table_exists = (False, None)
+
+# While the table doesn't exist, check again after this many seconds
+TABLE_EXISTS_RECHECK_SECONDS = 60
+
+LAST_UPDATE_KEY = 'dgu.publisher_metrics.last_update'
+
+
+def table_exists():
+    '''Returns whether the table has been created, so that the site works
+    before it has been set up. Once it exists that is remembered, but until
+    then it is checked again every TABLE_EXISTS_RECHECK_SECONDS.'''
+    global _table_exists
+    exists, time_checked = _table_exists
+    if not exists and (time_checked is None or time.time() - time_checked >
+                       TABLE_EXISTS_RECHECK_SECONDS):
+        exists = model.meta.engine.has_table(PublisherMetrics.__tablename__)
+        _table_exists = (exists, time.time())
+    return exists
+
+
+def get_last_update():
+    '''Returns when the last full or incremental update started (UTC), or
+    None if it isn't recorded.'''
+    value = model.get_system_info(LAST_UPDATE_KEY)
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def set_last_update(timestamp):
+    '''Records when an update of all the publishers that need it started.
+    (It commits.)'''
+    model.set_system_info(LAST_UPDATE_KEY,
+                          timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+
+
+def init_tables(e):
+    Base.metadata.create_all(e)
@@ -1,7 +1,9 @@
 import uuid
+import time
 
 from sqlalchemy import Column
 from sqlalchemy import types
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 
 from ckan import model
@@ -13,7 +15,62 @@ def make_uuid():
     return unicode(uuid.uuid4())
 
 
-class Schema(DeclarativeBase, model.DomainObject):
+# {class: (time_loaded, [dicts in title order], {id: dict})}
+_cache = {}
+
+
+class CachedListMixin(object):
+    """
+    Schemas and code lists are few and rarely change, so all of them are
+    loaded in one query and kept in-process, for the dataset form and search
+    indexing. The cache is cleared on any write by this process and expires
+    after dgu.schema_cache.max_age seconds, to pick up writes by others. An id
+    missing from the cache is looked up in the database, in case another
+    process has added it since, and if found the cache is reloaded.
+    """
+    @classmethod
+    def _cached(cls):
+        from pylons import config
+        max_age = int(config.get('dgu.schema_cache.max_age', 300))
+        if cls not in _cache or time.time() - _cache[cls][0] > max_age:
+            dicts = [obj.as_dict() for obj in
+                     model.Session.query(cls).order_by(cls.title)]
+            _cache[cls] = (time.time(), dicts,
+                           dict((d['id'], d) for d in dicts))
+        return _cache[cls]
+
+    @classmethod
+    def _cached_by_id(cls, id):
+        obj_dict = cls._cached()[2].get(id)
+        if obj_dict is None and id and cls.get(id) is not None:
+            # added by another process since the cache was loaded
+            cls.invalidate_cache()
+            obj_dict = cls._cached()[2].get(id)
+        return obj_dict
+
+    @classmethod
+    def cached_list(cls):
+        '''Returns dicts of all the objects, ordered by title.'''
+        return [dict(obj_dict) for obj_dict in cls._cached()[1]]
+
+    @classmethod
+    def cached_dict(cls, id):
+        '''Returns the dict of the object with the given id, or None.'''
+        obj_dict = cls._cached_by_id(id)
+        return dict(obj_dict) if obj_dict else None
+
+    @classmethod
+    def cached_title(cls, id):
+        '''Returns the title of the object with the given id, or None.'''
+        obj_dict = cls._cached_by_id(id)
+        return obj_dict['title'] if obj_dict else None
+
+    @classmethod
+    def invalidate_cache(cls):
+        _cache.pop(cls, None)
+
+
+class Schema(DeclarativeBase, model.DomainObject, CachedListMixin):
     """
     A data schema/vocabulary/ontology that describes the structure/types in
     data.
@@ -42,7 +99,7 @@ class Schema(DeclarativeBase, model.DomainObject):
         return model.Session.query(cls).filter(cls.url==url).first()
 
 
-class Codelist(DeclarativeBase, model.DomainObject):
+class Codelist(DeclarativeBase, model.DomainObject, CachedListMixin):
     """
     A code list defines a set of values to be used in a field of a dataset.
     """
@@ -70,5 +127,13 @@ class Codelist(DeclarativeBase, model.DomainObject):
         return model.Session.query(cls).filter(cls.url==url).first()
 
 
+def _invalidate_cache(mapper, connection, target):
+    target.invalidate_cache()
+
+for _cls in (Schema, Codelist):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_cls, _event_name, _invalidate_cache)
+
+
 def init_tables(e):
     DeclarativeBase.metadata.create_all(e)
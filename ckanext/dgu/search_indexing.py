@@ -9,7 +9,7 @@ from ckan.model.group import Group
 from ckan import model
 from ckan.lib import helpers
 from ckanext.dgu.lib import helpers as dgu_helpers
-from ckanext.dgu.plugins_toolkit import ObjectNotFound
+from ckanext.dgu.lib.publisher import publisher_tree
 
 log = getLogger(__name__)
 
@@ -17,6 +17,32 @@ class SearchIndexing(object):
     '''Functions that edit the package dictionary fields to affect the way it
     gets indexed in Solr.'''
 
+    # Enrichment data loaded in bulk for a chunk of datasets that are being
+    # indexed together. See prefetch().
+    _prefetched = {}
+
+    @classmethod
+    def prefetch(cls, package_ids):
+        '''Loads enrichment data in bulk for datasets that are about to be
+        indexed together (e.g. by the search_index command), so that the
+        add_* methods don't need to query for each dataset. Call
+        clear_prefetch() afterwards.
+
+        The archiver and QA data is not loaded here - it is added to the
+        pkg_dict by those plugins during package_show, before indexing.'''
+        from ckanext.dgu.model.schema_codelist import Schema, Codelist
+        cls.clear_prefetch()
+        publisher_tree()
+        Schema.cached_list()
+        Codelist.cached_list()
+        if dgu_helpers.is_plugin_enabled('harvest'):
+            cls._prefetched['harvest_document_content'] = \
+                cls.load_harvest_document_content(package_ids=package_ids)
+
+    @classmethod
+    def clear_prefetch(cls):
+        cls._prefetched = {}
+
     @classmethod
     def add_popularity(cls, pkg_dict):
         '''Adds the views field from the ga-report plugin, if it is installed'''
@@ -130,20 +156,15 @@ class SearchIndexing(object):
     @classmethod
     def add_field__organization_title_and_abbreviation(cls, pkg_dict):
         '''Adds any group abbreviation '''
-        abbr = None
-
-        g = model.Group.get(pkg_dict['organization'])
-        if not g:
+        tree = publisher_tree()
+        publisher_id = tree.get_id(pkg_dict['organization'])
+        if not publisher_id:
             log.error("Package %s does not belong to an organization" % pkg_dict['name'])
             return
 
-        pkg_dict['organization_titles'] = [g.title]
-
-        try:
-            abbr = g.extras.get('abbreviation')
-        except:
-            raise
+        pkg_dict['organization_titles'] = [tree.title(publisher_id)]
 
+        abbr = tree.abbreviation(publisher_id)
         if abbr:
             pkg_dict['organization_titles'].append(abbr)
 
@@ -152,10 +173,9 @@ class SearchIndexing(object):
     @classmethod
     def add_field__publisher(cls, pkg_dict):
         '''Adds the 'publisher' based on group.'''
-        import ckan.model as model
-
-        publisher = model.Group.get(pkg_dict.get('organization'))
-        if not publisher:
+        tree = publisher_tree()
+        ancestors = tree.ancestor_names(pkg_dict.get('organization'))
+        if not ancestors:
             log.warning('Dataset %s doesn\'t seem to have a publisher!  '
                         'Unable to add publisher to index.',
                         pkg_dict['name'])
@@ -163,29 +183,15 @@ class SearchIndexing(object):
 
         # Publisher names
         if not pkg_dict.has_key('publisher'):
-            pkg_dict['publisher'] = publisher.name
-            log.debug(u"Publisher: %s", publisher.name)
+            pkg_dict['publisher'] = ancestors[0]
+            log.debug(u"Publisher: %s", ancestors[0])
         else:
             log.warning('Unable to add "publisher" to index, as the datadict '
                         'already contains a key of that name')
 
         # Ancestry of publishers
-        ancestors = []
-        while(publisher is not None):
-            ancestors.append(publisher)
-            parent_publishers = publisher.get_parent_groups('organization')
-            if len(parent_publishers) == 0:
-                publisher = None
-            else:
-                if len(parent_publishers) > 1:
-                    log.warning('Publisher %s has more than one parent publisher. '
-                                'Ignoring all but the first. %s',
-                                publisher, repr(parent_publishers))
-                publisher = parent_publishers[0]
-
-
         if not pkg_dict.has_key('parent_publishers'):
-            pkg_dict['parent_publishers'] = [ p.name for p in ancestors ]
+            pkg_dict['parent_publishers'] = ancestors
         else:
             log.warning('Unable to add "parent_publishers" to index, as the datadict '
                         'already contains a key of that name. '
@@ -197,22 +203,70 @@ class SearchIndexing(object):
         '''Index a harvested dataset\'s XML content
            (Given a low priority when searching)'''
         if pkg_dict.get('UKLP', '') == 'True':
-            import ckan
-            from ckanext.dgu.plugins_toolkit import get_action
+            harvest_object_id = pkg_dict.get('harvest_object_id', '')
+            contents = cls._prefetched.get('harvest_document_content', {})
+            if harvest_object_id not in contents:
+                contents = cls.load_harvest_document_content(
+                    harvest_object_ids=[harvest_object_id])
+            if harvest_object_id in contents:
+                pkg_dict['extras_harvest_document_content'] = \
+                    contents[harvest_object_id]
+            else:
+                log.warning('Unable to find harvest object "%s" '
+                            'referenced by dataset "%s"',
+                            harvest_object_id, pkg_dict['id'])
 
-            context = {'model': ckan.model,
-                       'session': ckan.model.Session,
-                       'ignore_auth': True}
+    @classmethod
+    def load_harvest_document_content(cls, harvest_object_ids=None,
+                                      package_ids=None):
+        '''Returns the harvested document content for the given harvest
+        objects, or for the current harvest objects of the given datasets, in
+        one query, as {harvest_object_id: content}.
+
+        The content is reduced to what is worth indexing according to the
+        config options:
+          dgu.search.harvest_document_text_only - index the text of the XML
+              elements rather than the whole XML document
+          dgu.search.harvest_document_max_length - truncate to this many
+              characters (default 0, meaning no limit)
+        '''
+        from pylons import config
+        from ckanext.harvest.model import HarvestObject
 
-            data_dict = {'id': pkg_dict.get('harvest_object_id', '')}
+        if not (harvest_object_ids or package_ids):
+            return {}
+        q = model.Session.query(HarvestObject.id, HarvestObject.content)
+        if harvest_object_ids:
+            q = q.filter(HarvestObject.id.in_(harvest_object_ids))
+        else:
+            q = q.filter(HarvestObject.package_id.in_(package_ids)) \
+                 .filter(HarvestObject.current == True)
+
+        text_only = asbool(config.get('dgu.search.harvest_document_text_only',
+                                      False))
+        max_length = int(config.get('dgu.search.harvest_document_max_length',
+                                    0))
+        contents = {}
+        for harvest_object_id, content in q:
+            content = content or ''
+            if text_only:
+                content = cls._xml_text(content)
+            if max_length:
+                content = content[:max_length]
+            contents[harvest_object_id] = content
+        return contents
 
-            try:
-                harvest_object = get_action('harvest_object_show')(context, data_dict)
-                pkg_dict['extras_harvest_document_content'] = harvest_object.get('content', '')
-            except ObjectNotFound:
-                log.warning('Unable to find harvest object "%s" '
-                            'referenced by dataset "%s"',
-                            data_dict['id'], pkg_dict['id'])
+    @classmethod
+    def _xml_text(cls, xml):
+        '''Returns the text content of an XML document, with whitespace
+        collapsed. If it is not valid XML it is returned as it is.'''
+        from lxml import etree
+        try:
+            root = etree.fromstring(xml.encode('utf8')
+                                    if isinstance(xml, unicode) else xml)
+        except etree.XMLSyntaxError:
+            return xml
+        return u' '.join(u' '.join(root.itertext()).split())
 
     @classmethod
     def add_field__openness(cls, pkg_dict):
@@ -265,10 +319,11 @@ class SearchIndexing(object):
             schema_ids = None
         schemas = []
         for schema_id in schema_ids:
-            try:
-                schemas.append(Schema.get(schema_id).title)
-            except AttributeError, e:
-                log.error('Invalid schema_id: %r %s', schema_id, e)
+            title = Schema.cached_title(schema_id)
+            if title is None:
+                log.error('Invalid schema_id: %r', schema_id)
+                continue
+            schemas.append(title)
         pkg_dict['schema_multi'] = schemas
         #log.debug('Schema: %s', ' '.join(schemas))
 
@@ -280,6 +335,10 @@ class SearchIndexing(object):
             codelists = None
         codelists = []
         for codelist_id in codelist_ids:
-            codelists.append(Codelist.get(codelist_id).title)
+            title = Codelist.cached_title(codelist_id)
+            if title is None:
+                log.error('Invalid codelist_id: %r', codelist_id)
+                continue
+            codelists.append(title)
         pkg_dict['codelist_multi'] = codelists
         #log.debug('Code lists: %s', ' '.join(codelists))
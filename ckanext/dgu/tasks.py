@@ -7,6 +7,7 @@ queue and processed here.
 import datetime
 import json
 import os
+import time
 import requests
 import urlparse
 import traceback
@@ -18,6 +19,12 @@ import ckan.lib.munge as munge
 from ckan.lib.field_types import DateType, DateConvertError
 from ckanclient import CkanClient, CkanApiError
 
+from ckanext.dgu.celery_env import load_environment
+
+# Rows are written in a transaction per batch of this size, when ingesting
+# in the worker (see ingest_inventory_file)
+BATCH_SIZE = 100
+
 def _process_upload(context, data):
     """
     When provided with a filename this function will process each row
@@ -28,6 +35,9 @@ def _process_upload(context, data):
                  'package': 'a_package_id',
                  'action':  'Added' or 'Updated'
                 }
+
+    The progress is saved every BATCH_SIZE rows and if the upload was
+    interrupted, it carries on after the last row saved.
     """
     log = inventory_upload.get_logger()
 
@@ -41,50 +51,159 @@ def _process_upload(context, data):
     client = CkanClient(base_location=urlparse.urljoin(context['site_url'],'api'),
                         api_key=context['apikey'])
 
+    tableset, errors = _load_tableset(filename)
+    if not tableset:
+        return errors, results
+
+    rows, errors = _read_rows(tableset)
+    if errors:
+        return errors, results
+
+    progress = UploadProgress.resume(
+        data['jobid'], len(rows),
+        get_task_status_value(context, data['jobid'], 'progress', log))
+    for i in xrange(progress.rows_done, len(rows)):
+        pos, row = rows[i]
+        try:
+            pkg, msg = \
+                process_incoming_inventory_row(pos, row, publisher_name, client, log)
+            if pkg:
+                progress.results.append({'package': pkg['id'], 'action': msg})
+        except Exception, exc:
+            progress.errors.append('Row %s: %s' % (_row_identity(pos, row), str(exc)))
+        progress.rows_done = i + 1
+
+        if progress.rows_done % BATCH_SIZE == 0 or \
+                progress.rows_done == len(rows):
+            update_task_status(context, progress.task_status(), log)
+
+    return progress.errors, progress.results
+
+
+def _read_rows(tableset):
+    """
+    Returns ([(pos, row), ...], errors) for the rows after the header row,
+    where pos is the row number in the spreadsheet.
+    """
+    rows = []
+    for pos, row in enumerate(tableset.tables[0], 1):
+        if pos == 1:
+            # Validate the header row to make sure it hasn't been modified
+            ok, msg = validate_incoming_inventory_header(row)
+            if not ok:
+                return [], [msg]
+            continue
+        rows.append((pos, row))
+
+    if not rows:
+        return [], ["There was not enough data in the upload file"]
+    return rows, []
+
+
+class UploadProgress(object):
+    """
+    How far an upload has got. It is saved in the upload's task status (key
+    'progress') at each checkpoint, for InventoryController.upload_progress
+    to report, and so that if the worker is restarted the upload can carry
+    on after the last row saved, rather than start again.
+    """
+    def __init__(self, jobid, rows, rows_done=0, errors=None, results=None,
+                 started=None):
+        self.jobid = jobid
+        self.rows = rows
+        self.rows_done = rows_done
+        self.errors = errors or []
+        self.results = results or []
+        self.started = started or datetime.datetime.now().isoformat()
+        # the rate is worked out from this run only
+        self.resumed_from = rows_done
+        self._run_started = time.time()
+
+    @classmethod
+    def resume(cls, jobid, rows, saved):
+        """
+        Returns the progress to carry on from, given the value saved in the
+        task status (or None if there isn't one).
+        """
+        if not saved or saved.get('rows') != rows:
+            return cls(jobid, rows)
+        log = inventory_upload.get_logger()
+        log.info('Resuming inventory upload %s after row %s/%s', jobid,
+                 saved['rows_done'], rows)
+        return cls(jobid, rows, rows_done=saved['rows_done'],
+                   errors=saved['errors'], results=saved['results'],
+                   started=saved['started'])
+
+    def rows_per_second(self):
+        elapsed = time.time() - self._run_started
+        rows_done = self.rows_done - self.resumed_from
+        if not rows_done or not elapsed:
+            return None
+        return rows_done / elapsed
+
+    def eta_seconds(self):
+        rate = self.rows_per_second()
+        if not rate:
+            return None
+        return int((self.rows - self.rows_done) / rate)
+
+    def as_dict(self):
+        rate = self.rows_per_second()
+        return {
+            'rows': self.rows,
+            'rows_done': self.rows_done,
+            'rows_per_second': round(rate, 2) if rate else None,
+            'eta_seconds': self.eta_seconds(),
+            'added': len([r for r in self.results if r['action'] == 'Added']),
+            'updated': len([r for r in self.results
+                            if r['action'] == 'Updated']),
+            'errors': self.errors,
+            'results': self.results,
+            'started': self.started,
+            'resumed_from': self.resumed_from or None,
+            }
+
+    def task_status(self):
+        return {
+            'entity_id': self.jobid,
+            'entity_type': u'inventory',
+            'task_type': 'inventory.upload',
+            'key': u'progress',
+            'value': json.dumps(self.as_dict()),
+            'state': 'Running' if self.rows_done < self.rows else 'Finished',
+            'error': u'',
+            'last_updated': datetime.datetime.now().isoformat()
+            }
+
+
+def _load_tableset(filename):
+    """
+    Opens the uploaded spreadsheet. Returns (tableset, errors) and tableset
+    is None if it could not be read.
+    """
+    errors = []
     tableset = None
     try:
         _, ext = os.path.splitext( filename )
         tableset = messytables.any_tableset(open(filename, 'r'), extension=ext[1:])
     except Exception, e:
         if str(e) == "Unrecognized MIME type: text/plain":
-            tableset = messytables.any_tableset(f, mimetype="text/csv")
+            tableset = messytables.any_tableset(open(filename, 'r'), mimetype="text/csv")
         else:
             errors.append("Unable to load file: {0}".format(e))
 
     if not tableset:
         errors.append("Unable to read data from uploaded file. Please contact a sysadmin.")
-        return errors, results
-
-    first = True
-    pos = 0
-    for row in tableset.tables[0]:
-        pos = pos + 1
-        if first:
-            # Validate the header row to make sure it hasn't been modified
-            ok, msg = validate_incoming_inventory_header(row)
-            if not ok:
-                errors.append(msg)
-                break
-            first = False
-            continue
+    return tableset, errors
 
-        try:
-            pkg, msg = \
-                process_incoming_inventory_row(pos, row, publisher_name, client, log)
-            if pkg:
-                results.append({'package': pkg['id'], 'action': msg})
-        except Exception, exc:
-            row_identity = str(pos)
-            try:
-                row_identity += ' (%s)' % row[0].value
-            except:
-                pass
-            errors.append('Row %s: %s' % (row_identity, str(exc)))
-
-    if pos < 2 and len(errors) == 0:
-        errors.append("There was not enough data in the upload file")
 
-    return errors, results
+def _row_identity(pos, row):
+    row_identity = str(pos)
+    try:
+        row_identity += ' (%s)' % row[0].value
+    except:
+        pass
+    return row_identity
 
 
 def upload_inventory_file(context, data):
@@ -95,7 +214,11 @@ def upload_inventory_file(context, data):
     now = datetime.datetime.now().isoformat()
 
     log.info(data)
-    errors, results = _process_upload(context, data)
+    in_worker = bool(context.get('ckan_ini_filepath'))
+    if in_worker:
+        errors, results = ingest_inventory_file(context, data, log)
+    else:
+        errors, results = _process_upload(context, data)
     if not errors:
         try:
             os.unlink(data['file'])
@@ -113,7 +236,12 @@ def upload_inventory_file(context, data):
             'last_updated': now
         }
     log.info(data)
-    update_task_status(context, data, log)
+    if in_worker:
+        from ckan import model
+        save_task_status(data)
+        model.repo.commit()
+    else:
+        update_task_status(context, data, log)
     return json.dumps(results),
 
 
@@ -152,7 +280,9 @@ def update_task_status(context, data, log):
     log.info('Task status updated ok: %s=%s', key, value)
 
 
-@celery.task(name = "inventory.process")
+# acks_late, so that if the worker stops part way through, the task is run
+# again and carries on from the last UploadProgress saved
+@celery.task(name = "inventory.process", acks_late=True)
 def inventory_upload(context, data):
     '''
     Processes an uploaded file
@@ -161,18 +291,24 @@ def inventory_upload(context, data):
             'username': user.name,
             'site_url': config.get('ckan.site_url_internally') or config.get('ckan.site_url'),
             'apikey': user.apikey,
-            'site_user_apikey': site_user['apikey']
+            'site_user_apikey': site_user['apikey'],
+            'ckan_ini_filepath': path of the ckan config (optional),
         }
         data = {
             'file': filename,
             'publisher': publisher.name,
         }
+
+    With ckan_ini_filepath, the rows are written directly by this worker
+    (see ingest_inventory_file), otherwise through the CKAN API.
     '''
     log = inventory_upload.get_logger()
     log.info('Starting inventory upload task: %r', data)
     try:
         data = json.loads(data)
         context = json.loads(context)
+        if context.get('ckan_ini_filepath'):
+            load_environment(context['ckan_ini_filepath'])
         result = upload_inventory_file(context, data)
         return result
     except Exception, e:
@@ -206,13 +342,13 @@ def validate_incoming_inventory_header(header_row):
 
     return True, ""
 
-def process_incoming_inventory_row(row_number, row, default_group_name, client, log):
+def parse_incoming_inventory_row(row, log):
     """
-    Reads the provided row and updates the information found in the
-    database where appropriate.
+    Reads the values from the provided row. Returns (title, description,
+    publisher_name, publish_date, release_notes), with the title and
+    description utf-8 encoded and the publish_date in db format.
 
-    The text of any exception raised will be shown to the user and the
-    processing aborted.
+    The text of any exception raised will be shown to the user.
     """
     try:
         title = row[0].value.encode('utf-8')
@@ -245,6 +381,35 @@ def process_incoming_inventory_row(row_number, row, default_group_name, client,
         log.error(msg)
         raise Exception(msg)
 
+    return title, description, publisher_name, publish_date, release_notes
+
+
+def _missing_fields_error(title, description, group):
+    missing_fields = []
+    if not title.strip():
+        missing_fields.append("Dataset title")
+
+    if not description.strip():
+        missing_fields.append("Description of dataset")
+
+    if not group:
+        missing_fields.append("Owner")
+
+    if missing_fields:
+        return "The following fields were missing: {0}".format(", ".join(missing_fields))
+
+
+def process_incoming_inventory_row(row_number, row, default_group_name, client, log):
+    """
+    Reads the provided row and updates the information found in the
+    database where appropriate.
+
+    The text of any exception raised will be shown to the user and the
+    processing aborted.
+    """
+    title, description, publisher_name, publish_date, release_notes = \
+        parse_incoming_inventory_row(row, log)
+
     group = None
     if publisher_name:
         try:
@@ -260,18 +425,9 @@ def process_incoming_inventory_row(row_number, row, default_group_name, client,
 
     # First validation check, make sure we have enough to either update or create an
     # unpublished item
-    missing_fields = []
-    if not title.strip():
-        missing_fields.append("Dataset title")
-
-    if not description.strip():
-        missing_fields.append("Description of dataset")
-
-    if not group:
-        missing_fields.append("Owner")
-
-    if missing_fields:
-        raise Exception("The following fields were missing: {1}".format(", ".join(missing_fields)))
+    error = _missing_fields_error(title, description, group)
+    if error:
+        raise Exception(error)
 
     # Check if we can find the dataset by title (for inventory items)
     # If this happens it's kinda hard to work out which we want.  The group might be different
@@ -390,3 +546,333 @@ def _get_package(client, pkg_name):
         else:
             raise Exception('Unexpected status %s checking for package under \'%s\': %r' % (client.last_status, pkg_name, e.args))
     return pkg
+
+
+def ingest_inventory_file(context, data, log, batch_size=None):
+    """
+    The same as _process_upload, but run in the worker against the model
+    layer rather than through the API, so it needs the CKAN environment
+    loaded. The publishers, the existing datasets with the rows' titles and
+    the names taken are looked up with a few queries for the whole file,
+    rather than several requests per row. The rows are written in a
+    transaction per batch_size rows (each row in a savepoint, so a bad row
+    doesn't spoil the rest of its batch), which also saves the UploadProgress,
+    so an interrupted upload carries on after the last batch committed.
+    """
+    from pylons import config
+    from ckan import model
+
+    if batch_size is None:
+        batch_size = int(config.get('dgu.inventory_upload.batch_size',
+                                    BATCH_SIZE))
+    errors = []
+    results = []
+
+    tableset, errors = _load_tableset(data['file'])
+    if not tableset:
+        return errors, results
+
+    rows, errors = _read_rows(tableset)
+    if errors:
+        return errors, results
+
+    progress = UploadProgress.resume(data['jobid'], len(rows),
+                                     _saved_task_status_value(data['jobid'],
+                                                              'progress'))
+    # [(pos, row_identity, parsed values or the Exception)]
+    parsed_rows = []
+    for pos, row in rows[progress.rows_done:]:
+        try:
+            values = parse_incoming_inventory_row(row, log)
+        except Exception, exc:
+            values = exc
+        parsed_rows.append((pos, _row_identity(pos, row), values))
+
+    parsed = [values for pos, row_identity, values in parsed_rows
+              if not isinstance(values, Exception)]
+    publishers = _find_publishers(
+        set(values[2] for values in parsed if values[2]))
+    packages_by_title = _find_packages_by_title(
+        set(values[0].decode('utf-8') for values in parsed
+            if values[0].strip()))
+    used_names = set()
+    new_names = unique_package_names(
+        [values[0].decode('utf-8') for values in parsed
+         if values[0].strip() and
+         values[0].decode('utf-8').lower() not in packages_by_title],
+        _names_taken, used_names)
+
+    for pos, row_identity, values in parsed_rows:
+        if isinstance(values, Exception):
+            progress.errors.append('Row %s: %s' % (row_identity, values))
+        else:
+            model.Session.begin_nested()
+            try:
+                package_id, action = _ingest_inventory_row(
+                    values, context['username'], publishers,
+                    packages_by_title, new_names, used_names, log)
+                model.Session.commit()
+            except Exception, exc:
+                model.Session.rollback()
+                progress.errors.append('Row %s: %s' % (row_identity, exc))
+            else:
+                progress.results.append({'package': package_id,
+                                         'action': action})
+        progress.rows_done += 1
+
+        if progress.rows_done % batch_size == 0 or \
+                progress.rows_done == progress.rows:
+            save_task_status(progress.task_status())
+            model.repo.commit()
+            log.info('Inventory upload %s: %s/%s rows done', data['jobid'],
+                     progress.rows_done, progress.rows)
+
+    return progress.errors, progress.results
+
+
+def _ingest_inventory_row(values, username, publishers, packages_by_title,
+                          new_names, used_names, log):
+    """
+    Creates or updates the unpublished dataset for the parsed row, in the
+    same way as process_incoming_inventory_row. Returns (package_id, action).
+
+    The text of any exception raised will be shown to the user.
+    """
+    from ckan import model
+    from ckanext.dgu.plugins_toolkit import (get_action, check_access,
+                                             NotAuthorized)
+    title, description, publisher_name, publish_date, release_notes = values
+    title = title.decode('utf-8')
+    description = description.decode('utf-8')
+    release_notes = unicode(release_notes) if release_notes is not None else u''
+
+    group = None
+    if publisher_name:
+        group = publishers.get(publisher_name)
+        if not group:
+            raise Exception('Publisher does not exist in data.gov.uk: "%s"' % publisher_name)
+
+    error = _missing_fields_error(title, description, group)
+    if error:
+        raise Exception(error)
+
+    possibles = []
+    for possible_pkg in packages_by_title.get(title.lower(), []):
+        if not possible_pkg['unpublished']:
+            # If the title has matched exactly, and the thing we matched isn't an
+            # unpublished item, we should alert the user to the existing of the dataset
+            raise Exception(u"The non-inventory dataset '{0}' already exists".format(title))
+        if possible_pkg['owner_org'] != group['id']:
+            continue
+        possibles.append(possible_pkg)
+
+    if len(possibles) > 1:
+        raise Exception(u"Found {0} existing unpublished items with title '{1}'".format(len(possibles), title))
+
+    context = {'model': model, 'session': model.Session, 'user': username}
+    if possibles:
+        package_id = possibles[0]['id']
+        try:
+            check_access('package_update', context, {'id': package_id})
+        except NotAuthorized:
+            raise Exception(u"You are not authorized to update the dataset '{0}'".format(title))
+        rev = model.repo.new_revision()
+        rev.author = username
+        rev.message = u'Inventory upload'
+        pkg = model.Package.get(package_id)
+        pkg.notes = description
+        pkg.extras['release-notes'] = release_notes
+        pkg.extras['publish-date'] = publish_date
+        return package_id, "Updated"
+
+    name = new_names.pop(title.lower(), None) or \
+        unique_package_names([title], _names_taken, used_names)[title.lower()]
+    package = {
+        'title': title,
+        'name': name,
+        'notes': description or u' ',
+        'license_id': u'unpublished',
+        'owner_org': group['id'],
+        'unpublished': True,
+        # publish_date is already in db format, so it goes in the extras
+        # (as the API route does) rather than through date_to_db again
+        'extras': [{'key': 'publish-date', 'value': publish_date},
+                   {'key': 'release-notes', 'value': release_notes}],
+        }
+    log.info("Creating new unpublished package: {0}".format(name))
+    context.update({'defer_commit': True, 'return_id_only': True})
+    try:
+        package_id = get_action('package_create')(context, package)
+    except NotAuthorized:
+        raise Exception(u"You are not authorized to create datasets for '{0}'".format(group['title']))
+    except Exception, e:
+        log.error(e)
+        raise Exception(u"There was a problem saving '{0}'".format(title))
+
+    # so that a later row with the same title updates it
+    packages_by_title.setdefault(title.lower(), []).append(
+        {'id': package_id, 'owner_org': group['id'], 'unpublished': True})
+    return package_id, "Added"
+
+
+def _find_publishers(publisher_names):
+    """
+    Returns {name_or_title: {'id', 'name', 'title'}} for the active
+    publishers that have any of the given names or titles.
+    """
+    from ckan import model
+    from sqlalchemy import or_
+    publishers = {}
+    publisher_names = list(publisher_names)
+    for chunk in _chunks(publisher_names, 1000):
+        q = model.Session.query(model.Group.id, model.Group.name,
+                                model.Group.title) \
+            .filter(model.Group.type == 'organization') \
+            .filter(model.Group.state == 'active') \
+            .filter(or_(model.Group.name.in_(chunk),
+                        model.Group.title.in_(chunk)))
+        for id_, name, title in q:
+            publisher = {'id': id_, 'name': name, 'title': title}
+            publishers[title] = publisher
+            publishers[name] = publisher
+    return publishers
+
+
+def _find_packages_by_title(titles):
+    """
+    Returns {lower case title: [{'id', 'owner_org', 'unpublished'}, ...]}
+    for the active datasets with any of the titles (case-insensitive).
+    """
+    from ckan import model
+    from sqlalchemy import func
+    from paste.deploy.converters import asbool
+    packages = {}
+    lower_titles = sorted(set(title.lower() for title in titles))
+    for chunk in _chunks(lower_titles, 1000):
+        q = model.Session.query(model.Package.id, model.Package.title,
+                                model.Package.owner_org) \
+            .filter(model.Package.state == 'active') \
+            .filter(func.lower(model.Package.title).in_(chunk))
+        for id_, title, owner_org in q:
+            packages[id_] = {'id': id_, 'title': title,
+                             'owner_org': owner_org, 'unpublished': False}
+    for chunk in _chunks(packages.keys(), 1000):
+        q = model.Session.query(model.PackageExtra.package_id,
+                                model.PackageExtra.value) \
+            .filter(model.PackageExtra.key == 'unpublished') \
+            .filter(model.PackageExtra.state == 'active') \
+            .filter(model.PackageExtra.package_id.in_(chunk))
+        for package_id, value in q:
+            packages[package_id]['unpublished'] = asbool(value)
+
+    packages_by_title = {}
+    for package in packages.values():
+        packages_by_title.setdefault(package.pop('title').lower(), []) \
+            .append(package)
+    return packages_by_title
+
+
+def _names_taken(names):
+    """Returns the ones of the given dataset names that are in use."""
+    from ckan import model
+    taken = set()
+    for chunk in _chunks(list(names), 1000):
+        q = model.Session.query(model.Package.name) \
+            .filter(model.Package.name.in_(chunk))
+        taken.update(name for name, in q)
+    return taken
+
+
+def unique_package_names(titles, names_taken, used_names,
+                         candidates_per_query=10):
+    """
+    Returns {lower case title: name} with a new dataset name for each of the
+    titles, chosen in the same way as get_clean_name does in
+    process_incoming_inventory_row (the munged title, or failing that the
+    munged title with a _1, _2 etc. suffix). names_taken(names) returns those
+    of the names that already exist, and is called for candidate names for
+    all the titles at once. Names in used_names are avoided too, and the
+    returned names are added to it.
+    """
+    titles = dict((title.lower(), title) for title in titles)
+    names = {}
+    pending = sorted(titles)
+    start = 0
+    while pending:
+        candidates = dict(
+            (key, [_candidate_package_name(titles[key], counter)
+                   for counter in xrange(start, start + candidates_per_query)])
+            for key in pending)
+        taken = names_taken(set(name for key in pending
+                                for name in candidates[key]))
+        still_pending = []
+        for key in pending:
+            for name in candidates[key]:
+                if name not in taken and name not in used_names:
+                    names[key] = name
+                    used_names.add(name)
+                    break
+            else:
+                still_pending.append(key)
+        pending = still_pending
+        start += candidates_per_query
+    return names
+
+
+def _candidate_package_name(title, counter):
+    if counter:
+        title = u"{0}_{1}".format(title, counter)
+    return munge.munge_title_to_name(title)
+
+
+def save_task_status(data):
+    """
+    Saves the task status (a dict like update_task_status takes) directly,
+    for when the CKAN environment is loaded. It is not committed.
+    """
+    from ckan import model
+    from ckanext.dgu.plugins_toolkit import get_action
+    context = {'model': model, 'session': model.Session,
+               'ignore_auth': True, 'defer_commit': True}
+    return get_action('task_status_update')(context, data)
+
+
+def _saved_task_status_value(entity_id, key):
+    """
+    Returns the value (decoded from JSON) of the upload's task status with
+    the given key, read directly, or None if there isn't one.
+    """
+    from ckan import model
+    task_status = model.Session.query(model.TaskStatus) \
+        .filter_by(entity_id=entity_id, task_type='inventory.upload',
+                   key=key) \
+        .first()
+    if not task_status or not task_status.value:
+        return None
+    return json.loads(task_status.value)
+
+
+def get_task_status_value(context, entity_id, key, log):
+    """
+    Use CKAN API to read the value (decoded from JSON) of the upload's task
+    status with the given key. Returns None if there isn't one.
+    """
+    api_url = urlparse.urljoin(context['site_url'], 'api/action') + '/task_status_show'
+    res = requests.post(
+        api_url, json.dumps({'entity_id': entity_id,
+                             'task_type': 'inventory.upload',
+                             'key': key}),
+        headers = {'Authorization': context['site_user_apikey'],
+                   'Content-type': 'application/json'}
+    )
+    if res.status_code == 404:
+        return None
+    if res.status_code != 200:
+        raise CkanApiError('ckan failed to read task_status, status_code (%s), error %s' % (res.status_code, res.content))
+    value = json.loads(res.content)['result']['value']
+    return json.loads(value) if value else None
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,69 @@
+import os
+import json
+import gzip
+import tempfile
+import StringIO
+
+from nose.tools import assert_equal, assert_raises
+from ckanext.dgu.bin.dump_analysis import (iter_json_values, DumpAnalysis,
+                                           DumpAnalysisOptions)
+
+PACKAGES = [
+    {'name': 'uklp', 'state': 'active',
+     'extras': {'UKLP': 'True', 'theme-primary': 'Mapping'}},
+    {'name': 'ons', 'state': 'active',
+     'extras': {'import_source': 'ONS-2012', 'theme-primary': 'Economy'}},
+    {'name': 'manual', 'state': 'active', 'extras': {}},
+    {'name': 'deleted', 'state': 'deleted', 'extras': {}},
+    ]
+
+
+class TestIterJsonValues(object):
+    def test_array(self):
+        data = json.dumps(PACKAGES, indent=2)
+        # small chunks, so values are split across them
+        assert_equal(list(iter_json_values(StringIO.StringIO(data), 7)),
+                     PACKAGES)
+
+    def test_lines(self):
+        data = '\n'.join(json.dumps(pkg) for pkg in PACKAGES) + '\n'
+        assert_equal(list(iter_json_values(StringIO.StringIO(data), 7)),
+                     PACKAGES)
+
+    def test_empty(self):
+        assert_equal(list(iter_json_values(StringIO.StringIO('[]'))), [])
+
+    def test_truncated(self):
+        data = json.dumps(PACKAGES)[:-10]
+        assert_raises(ValueError, list,
+                      iter_json_values(StringIO.StringIO(data)))
+
+
+class TestDumpAnalysis(object):
+    def _analyse(self, data, suffix):
+        fd, filepath = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            f = gzip.open(filepath, 'wb')
+            f.write(data)
+            f.close()
+            options = DumpAnalysisOptions(analyse_by_source=True,
+                                          analyse_by_theme=True)
+            return DumpAnalysis(filepath, options).analysis_dict
+        finally:
+            os.remove(filepath)
+
+    def test_json_and_jsonl_agree(self):
+        json_analysis = self._analyse(json.dumps(PACKAGES), '.json.gz')
+        jsonl_packages = []
+        for pkg in PACKAGES:
+            pkg = dict(pkg)
+            pkg['extras'] = [{'key': k, 'value': v}
+                             for k, v in pkg['extras'].items()]
+            jsonl_packages.append(json.dumps(pkg))
+        jsonl_analysis = self._analyse('\n'.join(jsonl_packages), '.jsonl.gz')
+        assert_equal(dict(json_analysis), dict(jsonl_analysis))
+        assert_equal(json_analysis['Total datasets'], 3)
+        assert_equal(json_analysis['Datasets by source: UKLP'], 1)
+        assert_equal(json_analysis['Datasets by theme: Business & Economy'], 1)
+        assert_equal(json_analysis['Datasets by theme: No value'], 1)
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+from ckanext.dgu.commands.search_index import (index_chunk, write_checkpoint,
+                                               remaining_package_ids)
+
+
+class MockPackageIndex(object):
+    '''Fails to index the datasets named in fail_names.'''
+    def __init__(self, fail_names=()):
+        self.fail_names = fail_names
+        self.indexed_names = []
+        self.commits = 0
+
+    def update_dict(self, pkg_dict, defer_commit=False):
+        assert defer_commit
+        if pkg_dict['name'] in self.fail_names:
+            raise Exception('Solr error')
+        self.indexed_names.append(pkg_dict['name'])
+
+    def commit(self):
+        self.commits += 1
+
+
+class TestCheckpoint(object):
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmp_dir, 'checkpoint')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _ids(self, *names):
+        return [model.Package.by_name(name).id for name in names]
+
+    def _index_chunk(self, package_ids, fail_names=()):
+        package_index = MockPackageIndex(fail_names)
+        with mock.patch('ckan.lib.search.index_for',
+                        return_value=package_index):
+            result = index_chunk(package_ids)
+        return result, package_index
+
+    def test_index_chunk(self):
+        package_ids = self._ids('directgov-cota', 'cabinet-office-energy-use')
+
+        (indexed_ids, errors), package_index = self._index_chunk(package_ids)
+
+        assert_equal(indexed_ids, package_ids)
+        assert_equal(errors, [])
+        assert_equal(package_index.indexed_names,
+                     ['directgov-cota', 'cabinet-office-energy-use'])
+        assert_equal(package_index.commits, 1)
+
+    def test_resume_retries_failed_datasets(self):
+        package_ids = self._ids('directgov-cota', 'cabinet-office-energy-use',
+                                'nhs-spend-over-25k-barnsleypct')
+
+        # first run indexes the first two, but one of them fails
+        (indexed_ids, errors), _ = self._index_chunk(
+            package_ids[:2], fail_names=['cabinet-office-energy-use'])
+        write_checkpoint(self.checkpoint, indexed_ids)
+        assert_equal(indexed_ids, package_ids[:1])
+        assert_equal([id_ for id_, error in errors], package_ids[1:2])
+
+        # the resumed run does the failed one and the one not reached
+        assert_equal(remaining_package_ids(package_ids, self.checkpoint),
+                     package_ids[1:])
@@ -127,3 +127,72 @@ class TestInventory(WsgiAppCase, HtmlCheckMethods):
 
 
 
+
+    def _create_upload(self, progress=None, error=None):
+        import json
+        import datetime
+        from ckan.model.types import make_uuid
+        job_id = make_uuid()
+        now = datetime.datetime.now()
+        root = model.TaskStatus(entity_id=job_id, entity_type=u'inventory',
+                                task_type=u'inventory', key=u'celery_task_id',
+                                value=job_id, state=u'Started', error=u'',
+                                last_updated=now)
+        model.Session.add(root)
+        if progress:
+            model.Session.add(model.TaskStatus(
+                entity_id=job_id, entity_type=u'inventory',
+                task_type=u'inventory.upload', key=u'progress',
+                value=json.dumps(progress), state=u'Running', error=u'',
+                last_updated=now))
+        if error:
+            model.Session.add(model.TaskStatus(
+                entity_id=job_id, entity_type=u'inventory',
+                task_type=u'inventory.upload', key=u'celery_task_id',
+                value=job_id, error=error, last_updated=now))
+        model.Session.commit()
+        root_id = root.id
+        model.Session.remove()
+        return root_id
+
+    def test_upload_status_running(self):
+        import json
+        upload_id = self._create_upload(progress={
+            'rows': 10, 'rows_done': 4, 'rows_per_second': 2.0,
+            'eta_seconds': 3, 'added': 3, 'updated': 0,
+            'errors': ['Row 3: bad'], 'results': [], 'started': None,
+            'resumed_from': None})
+        offset = url_for('/unpublished/cabinet-office/edit/upload/%s' % upload_id)
+        res = self.app.get(offset, status=200, extra_environ={'REMOTE_USER': 'co_admin'})
+        assert 'Processed 4 of 10 rows (1 errors so far)' in res.body, res.body
+        assert 'upload-progress' in res.body
+
+        res = self.app.get(offset + '/progress', status=200,
+                           extra_environ={'REMOTE_USER': 'co_admin'})
+        progress = json.loads(res.body)
+        assert_equal(progress['state'], 'Running')
+        assert_equal(progress['rows_done'], 4)
+        assert_equal(progress['errors_so_far'], 1)
+        assert 'results' not in progress
+
+        self.app.get(offset + '/progress', status=401,
+                     extra_environ={'REMOTE_USER': 'co_editor'})
+
+    def test_upload_status_failed(self):
+        import json
+        upload_id = self._create_upload(
+            progress={'rows': 10, 'rows_done': 4, 'errors': [],
+                      'results': []},
+            error=u'KeyError: file')
+        offset = url_for('/unpublished/cabinet-office/edit/upload/%s' % upload_id)
+        res = self.app.get(offset, status=200, extra_environ={'REMOTE_USER': 'co_admin'})
+        assert 'Status: Error' in res.body, res.body
+        assert 'KeyError: file' in res.body
+        # the page doesn't keep polling
+        assert 'upload-progress' not in res.body
+
+        res = self.app.get(offset + '/progress', status=200,
+                           extra_environ={'REMOTE_USER': 'co_admin'})
+        progress = json.loads(res.body)
+        assert_equal(progress['state'], 'Error')
+        assert_equal(progress['errors'], ['KeyError: file'])
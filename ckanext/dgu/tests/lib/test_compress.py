@@ -0,0 +1,63 @@
+import os
+import gzip
+import shutil
+import tempfile
+import zipfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dgu.lib.compress import MultiCompressor
+
+
+class TestMultiCompressor:
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.filepaths = {'zip': os.path.join(self.dir, 'dump.csv.zip'),
+                          'gz': os.path.join(self.dir, 'dump.csv.gz')}
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_close(self):
+        compressor = MultiCompressor(self.filepaths, 'dump.csv')
+        compressor.write('a,b\n' * 1000)
+        compressor.close()
+        assert_equal(zipfile.ZipFile(self.filepaths['zip']).read('dump.csv'),
+                     'a,b\n' * 1000)
+        assert_equal(gzip.open(self.filepaths['gz']).read(), 'a,b\n' * 1000)
+        assert_equal(sorted(os.listdir(self.dir)),
+                     ['dump.csv.gz', 'dump.csv.zip'])
+
+    def test_abort_when_dumper_fails(self):
+        # the previous dump is already published
+        for filepath in self.filepaths.values():
+            with open(filepath, 'wb') as f:
+                f.write('previous')
+
+        def dumper(f):
+            f.write('a,b\n' * 1000)
+            raise IOError('db went away')
+
+        compressor = MultiCompressor(self.filepaths, 'dump.csv')
+        try:
+            dumper(compressor)
+        except IOError:
+            compressor.abort()
+        else:
+            assert 0, 'should have raised'
+
+        # the temporary files are gone and the previous dump is untouched
+        assert_equal(sorted(os.listdir(self.dir)),
+                     ['dump.csv.gz', 'dump.csv.zip'])
+        for filepath in self.filepaths.values():
+            assert_equal(open(filepath, 'rb').read(), 'previous')
+
+    def test_unknown_format(self):
+        self.filepaths['bz2'] = os.path.join(self.dir, 'dump.csv.bz2')
+        assert_raises(ValueError, MultiCompressor, self.filepaths, 'dump.csv')
+        assert_equal(os.listdir(self.dir), [])
+
+    def test_encoder_fails_to_open(self):
+        self.filepaths['gz'] = os.path.join(self.dir, 'missing', 'dump.csv.gz')
+        assert_raises(IOError, MultiCompressor, self.filepaths, 'dump.csv')
+        assert_equal(os.listdir(self.dir), [])
@@ -0,0 +1,115 @@
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+from ckanext.dgu.lib.dumper import (CSVDumper, DATASET_KEYS,
+                                    get_dataset_values, public_packages_query,
+                                    package_dicts_in_bulk,
+                                    package_dicts_in_parallel)
+
+
+class TestFlatten:
+    def test_declared_columns_always_present(self):
+        pkg_dict = {'name': 'test', 'title': 'Test', 'notes': 'Some notes',
+                    'tags': ['a', 'b'], 'extras': {}, 'resources': []}
+        flat_dict, resources = CSVDumper(in_memory=True)._flatten(pkg_dict)
+        values = dict(zip(DATASET_KEYS, get_dataset_values(flat_dict)))
+        assert_equal(values['notes'], 'Some notes')
+        assert_equal(values['tags'], 'a,b')
+        assert_equal(values['version'], None)
+        assert_equal(values['theme-primary'], '')
+
+    def test_cert_url(self):
+        pkg_dict = {'name': 'test', 'resources': [], 'extras': {
+            'odi-certificate': '{"certificate_url": "http://cert"}'}}
+        flat_dict, resources = CSVDumper(in_memory=True)._flatten(pkg_dict)
+        assert_equal(flat_dict['odi-certificate-url'], 'http://cert')
+
+    def test_header(self):
+        dumper = CSVDumper(in_memory=True)
+        dumper.write_header()
+        header = dumper.dataset_file.getvalue().splitlines()[0].split(',')
+        assert_equal(len(header), 10 + len(DATASET_KEYS))
+        assert_equal(header[10], 'Author')
+
+
+class TestIncrementalCSVDumpState:
+    def test_state_round_trip(self):
+        import os
+        import tempfile
+        import datetime
+        from ckanext.dgu.lib.dumper import IncrementalCSVDump
+        state_filepath = os.path.join(tempfile.mkdtemp(), 'state.jsonl.gz')
+        dump = IncrementalCSVDump(state_filepath)
+        assert_equal(dump.load_state(), (None, {}))
+
+        timestamp = datetime.datetime(2015, 3, 1, 12, 30, 0, 5)
+        records = {'id1': {'name': u'caf\xe9', 'metadata_modified': '2015',
+                           'dataset_row': ['caf\xc3\xa9', 1],
+                           'resource_rows': [[u'caf\xe9', 'http://x', 0]]}}
+        dump.save_state(timestamp, records)
+        loaded_timestamp, loaded_records = dump.load_state()
+        assert_equal(loaded_timestamp, timestamp)
+        assert_equal(loaded_records['id1']['dataset_row'], [u'caf\xe9', 1])
+        assert_equal(loaded_records['id1']['resource_rows'],
+                     [[u'caf\xe9', u'http://x', 0]])
+
+    def test_old_state_format_ignored(self):
+        import os
+        import gzip
+        import tempfile
+        from ckanext.dgu.lib.dumper import IncrementalCSVDump
+        state_filepath = os.path.join(tempfile.mkdtemp(), 'state.jsonl.gz')
+        with gzip.open(state_filepath, 'wb') as f:
+            f.write('{"timestamp": "2015-03-01T12:30:00.000005"}\n')
+            f.write('{"id": "id1", "name": "test"}\n')
+        assert_equal(IncrementalCSVDump(state_filepath).load_state(),
+                     (None, {}))
+
+
+class TestPackageDicts:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def _as_dicts(self):
+        return [pkg.as_dict() for pkg in public_packages_query(model.Package)]
+
+    def _assert_same_as_as_dict(self, pkg_dicts):
+        expected_dicts = self._as_dicts()
+        assert_equal([d['name'] for d in pkg_dicts],
+                     [d['name'] for d in expected_dicts])
+        dumper = CSVDumper(in_memory=True)
+        for pkg_dict, expected in zip(pkg_dicts, expected_dicts):
+            for key in ('tags', 'extras', 'resources', 'license', 'isopen',
+                        'tracking_summary', 'metadata_modified',
+                        'metadata_created'):
+                assert_equal((pkg_dict['name'], key, pkg_dict[key]),
+                             (expected['name'], key, expected[key]))
+            assert_equal(dumper.package_rows(pkg_dict),
+                         dumper.package_rows(expected))
+
+    def test_bulk(self):
+        pkg_dicts = list(package_dicts_in_bulk(
+            public_packages_query(model.Package), batch_size=3))
+        self._assert_same_as_as_dict(pkg_dicts)
+
+    def test_parallel(self):
+        pkg_dicts = list(package_dicts_in_parallel(
+            public_packages_query(model.Package), processes=2, chunk_size=3))
+        self._assert_same_as_as_dict(pkg_dicts)
+
+    def _dump(self, **kwargs):
+        dumper = CSVDumper(in_memory=True)
+        dumper.dump(**kwargs)
+        return dumper.dataset_file.getvalue(), dumper.resource_file.getvalue()
+
+    def test_bulk_dump_is_identical(self):
+        assert_equal(self._dump(bulk=True), self._dump())
+
+    def test_parallel_dump_is_identical(self):
+        assert_equal(self._dump(processes=2), self._dump())
@@ -109,6 +109,42 @@ class TestGoUpTree:
         assert_equal(to_names(go_up_tree(model.Group.get(u'barnsley-primary-care-trust'))),
                      ['barnsley-primary-care-trust', 'national-health-service', 'dept-health'])
 
+    def test_find_group_admins(self):
+        recipients, publisher_title = \
+            find_group_admins(model.Group.get(u'barnsley-primary-care-trust'))
+        assert_equal([name for name, email in recipients], ['Barnsley PCT Admin'])
+        assert_equal(publisher_title, 'Barnsley Primary Care Trust')
+
+    def test_find_group_admins_skips_deleted_users(self):
+        user = model.User.by_name(u'co_admin')
+        user.state = u'deleted'
+        model.Session.commit()
+        try:
+            assert_equal(find_group_admins(model.Group.get(u'cabinet-office')),
+                         ([], None))
+        finally:
+            user = model.User.by_name(u'co_admin')
+            user.state = u'active'
+            model.Session.commit()
+
+    def test_publisher_not_in_database(self):
+        publisher = model.Group(name=u'new-publisher', type='organization')
+        publisher.id = u'new-publisher-id'
+        assert_equal(to_names(go_up_tree(publisher)), ['new-publisher'])
+        tree = publisher_tree()
+        assert publisher.id in tree.missing_ids
+        # the tree is not reloaded again for the same publisher
+        assert_equal(to_names(go_up_tree(publisher)), ['new-publisher'])
+        assert publisher_tree() is tree
+
+    def test_not_an_organization(self):
+        group = model.Group(name=u'a-group', type='group')
+        group.id = u'a-group-id'
+        tree = publisher_tree()
+        assert_equal(to_names(go_up_tree(group)), ['a-group'])
+        assert_equal(to_names(go_down_tree(group)), ['a-group'])
+        assert publisher_tree() is tree
+
 class TestGoDownTree:
     @classmethod
     def setup_class(cls):
@@ -129,3 +165,191 @@ class TestGoDownTree:
     def test_barnsley(self):
         assert_equal(to_names(go_down_tree(model.Group.get(u'barnsley-primary-care-trust'))),
                      ['barnsley-primary-care-trust'])
+
+class TestPublisherTree:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        invalidate_publisher_tree()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        invalidate_publisher_tree()
+
+    def test_ancestor_names(self):
+        assert_equal(publisher_tree().ancestor_names(u'barnsley-primary-care-trust'),
+                     ['barnsley-primary-care-trust', 'national-health-service', 'dept-health'])
+
+    def test_ancestor_names_by_id(self):
+        nhs = model.Group.get(u'national-health-service')
+        assert_equal(publisher_tree().ancestor_names(nhs.id),
+                     ['national-health-service', 'dept-health'])
+
+    def test_unknown(self):
+        assert_equal(publisher_tree().ancestor_names(u'not-a-publisher'), [])
+
+    def test_title(self):
+        tree = publisher_tree()
+        nhs = model.Group.get(u'national-health-service')
+        assert_equal(tree.title(tree.get_id(u'national-health-service')),
+                     nhs.title)
+
+    def test_cycle(self):
+        tree = PublisherTree({'a': ('a', 'A'), 'b': ('b', 'B')},
+                             {'a': ['b'], 'b': ['a']}, {})
+        assert_equal(tree.ancestor_names('a'), ['a', 'b'])
+        assert_equal(tree.descendant_names('a'), ['a', 'b'])
+
+    def test_all_ancestor_names(self):
+        # c has two parents, a and b, and b has a parent d
+        tree = PublisherTree({'a': ('a', 'A'), 'b': ('b', 'B'),
+                              'c': ('c', 'C'), 'd': ('d', 'D')},
+                             {'c': ['a', 'b'], 'b': ['d']}, {})
+        assert_equal(tree.ancestor_names('c'), ['c', 'a'])
+        assert_equal(tree.all_ancestor_names('c'), ['c', 'a', 'b', 'd'])
+        assert_equal(tree.all_ancestor_names('not-a-publisher'), [])
+
+    def test_all_ancestor_names_repeated_grandparent(self):
+        tree = PublisherTree({'a': ('a', 'A'), 'b': ('b', 'B'),
+                              'c': ('c', 'C'), 'd': ('d', 'D')},
+                             {'c': ['a', 'b'], 'a': ['d'], 'b': ['d']}, {})
+        assert_equal(tree.all_ancestor_names('c'), ['c', 'a', 'd', 'b'])
+
+    def test_descendant_names(self):
+        assert_equal(publisher_tree().descendant_names(u'dept-health'),
+                     ['dept-health', 'national-health-service',
+                      'barnsley-primary-care-trust',
+                      'newham-primary-care-trust'])
+        assert_equal(publisher_tree().descendant_names(u'not-a-publisher'),
+                     [])
+
+    def test_top_level_and_depth(self):
+        tree = publisher_tree()
+        assert_equal(tree.name(tree.top_level_id(u'newham-primary-care-trust')),
+                     'dept-health')
+        assert_equal(tree.depth(u'newham-primary-care-trust'), 2)
+        assert_equal(tree.depth(u'dept-health'), 0)
+        assert_equal(tree.depth(u'not-a-publisher'), None)
+        top_level_names = [tree.name(id_) for id_ in tree.top_level_ids()]
+        assert 'dept-health' in top_level_names
+        assert 'national-health-service' not in top_level_names
+
+class TestPublisherMetrics:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_resource_count_matches(self):
+        doh = model.Group.get(u'dept-health')
+        for include_sub_publishers in (False, True):
+            metrics = get_publisher_metrics(doh, include_sub_publishers)
+            assert_equal(metrics['resource_count'],
+                         resource_count(doh, include_sub_publishers))
+
+    def test_dataset_in_two_sub_publishers_counted_once(self):
+        # directgov-cota is in national-health-service - put it in barnsley
+        # too, which is also under dept-health
+        pkg = model.Package.by_name(u'directgov-cota')
+        barnsley = model.Group.by_name(u'barnsley-primary-care-trust')
+        model.repo.new_revision()
+        member = model.Member(group=barnsley, table_id=pkg.id,
+                              table_name='package', capacity='public')
+        model.Session.add(member)
+        model.repo.commit_and_remove()
+        try:
+            doh = model.Group.get(u'dept-health')
+            expected = resource_count(doh, include_sub_publishers=True)
+            assert_equal(get_publisher_metrics(doh, True)['resource_count'],
+                         expected)
+        finally:
+            model.repo.new_revision()
+            model.Session.query(model.Member) \
+                .filter_by(group_id=barnsley.id, table_id=pkg.id) \
+                .delete()
+            model.repo.commit_and_remove()
+
+    def test_incremental_update_after_targeted_update(self):
+        import datetime
+        from ckanext.dgu.model import publisher_metrics as pm
+        pm.init_tables(model.meta.engine)
+        all_ids = publishers_needing_metrics_update(
+            None, datetime.timedelta(hours=24))
+        update_publisher_metrics(all_ids)
+        model.repo.commit_and_remove()
+        last_update = datetime.datetime.utcnow()
+
+        # a change to a cabinet-office dataset
+        model.repo.new_revision()
+        pkg = model.Package.by_name(u'cabinet-office-energy-use')
+        pkg.notes = u'Changed'
+        model.repo.commit_and_remove()
+
+        # an update of just dept-health doesn't hide the change from the
+        # next incremental update
+        update_publisher_metrics([model.Group.by_name(u'dept-health').id])
+        model.repo.commit_and_remove()
+        cabinet_office = model.Group.by_name(u'cabinet-office')
+        for watermark in (last_update, None):
+            publisher_ids = publishers_needing_metrics_update(
+                watermark, datetime.timedelta(hours=24))
+            assert cabinet_office.id in publisher_ids, watermark
+        assert model.Group.by_name(u'ons').id not in \
+            publishers_needing_metrics_update(last_update,
+                                              datetime.timedelta(hours=24))
+
+
+    def test_sub_publisher_moved(self):
+        import datetime
+        from ckanext.dgu.model import publisher_metrics as pm
+        pm.init_tables(model.meta.engine)
+        update_publisher_metrics(publishers_needing_metrics_update(
+            None, datetime.timedelta(hours=24)))
+        model.repo.commit_and_remove()
+        last_update = datetime.datetime.utcnow()
+
+        # move barnsley from national-health-service to cabinet-office
+        barnsley = model.Group.by_name(u'barnsley-primary-care-trust')
+        nhs = model.Group.by_name(u'national-health-service')
+        cabinet_office = model.Group.by_name(u'cabinet-office')
+        model.repo.new_revision()
+        old_member = model.Session.query(model.Member) \
+            .filter_by(table_name='group', table_id=barnsley.id,
+                       group_id=nhs.id).one()
+        old_member.state = 'deleted'
+        model.Session.add(model.Member(group=cabinet_office,
+                                       table_id=barnsley.id,
+                                       table_name='group', capacity='parent'))
+        model.repo.commit_and_remove()
+        invalidate_publisher_tree()
+        try:
+            changed_ids = publishers_changed_since(last_update)
+            for name in ('barnsley-primary-care-trust',
+                         'national-health-service', 'cabinet-office'):
+                assert model.Group.by_name(name).id in changed_ids, name
+            assert model.Group.by_name(u'ons').id not in changed_ids
+
+            update_publisher_metrics(changed_ids)
+            model.repo.commit_and_remove()
+            for name in ('dept-health', 'national-health-service',
+                         'cabinet-office'):
+                publisher = model.Group.by_name(name)
+                assert_equal(
+                    get_publisher_metrics(publisher, True)['resource_count'],
+                    resource_count(publisher, include_sub_publishers=True))
+        finally:
+            model.repo.new_revision()
+            model.Session.query(model.Member) \
+                .filter_by(table_name='group', table_id=barnsley.id,
+                           group_id=cabinet_office.id) \
+                .delete()
+            model.Session.query(model.Member) \
+                .filter_by(table_name='group', table_id=barnsley.id,
+                           group_id=nhs.id) \
+                .update({'state': 'active'})
+            model.repo.commit_and_remove()
+            invalidate_publisher_tree()
@@ -1,7 +1,7 @@
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 from nose.tools import assert_equal
 
-from ckanext.dgu.lib.reports import get_quarter_dates
+from ckanext.dgu.lib.reports import get_quarter_dates, _get_activity
 
 class TestQuarters(object):
     def test_may(self):
@@ -20,3 +20,304 @@ class TestQuarters(object):
         assert_equal(qs['last'], (dt(2014, 1, 1), dt(2014, 3, 31)))
 
 
+
+
+class TestPublisherActivity(object):
+    @classmethod
+    def setup_class(cls):
+        from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+        DguCreateTestData.create_dgu_test_data()
+        now = dt.now()
+        cls.periods = {'this': (now - timedelta(days=1),
+                                now + timedelta(days=1))}
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        model.repo.rebuild_db()
+
+    def _dataset_names(self, organization, include_sub_organizations):
+        from ckan import model
+        from ckanext.report import lib
+        pkgs = lib.filter_by_organizations(
+            model.Session.query(model.Package),
+            model.Group.by_name(organization), include_sub_organizations)
+        return sorted(pkg.name for pkg in pkgs)
+
+    def test_created(self):
+        for include_sub_organizations in (False, True):
+            created, modified = _get_activity(
+                'national-health-service', include_sub_organizations,
+                self.periods)
+            assert_equal(
+                sorted(row[0] for row in created['this']),
+                self._dataset_names('national-health-service',
+                                    include_sub_organizations))
+            assert all(row[3] == 'created' for row in created['this'])
+
+    def _old_modified_authors_and_dates(self, pkg, period):
+        '''The authors and dates of the modifications of the dataset in the
+        period, from the queries publisher_activity used to make for each
+        dataset'''
+        from ckan import model
+        from ckanext.dgu.lib.reports import (activity_system_authors,
+                                             activity_system_author_template)
+        created_ = model.Session.query(model.PackageRevision)\
+            .filter(model.PackageRevision.id == pkg.id) \
+            .order_by("revision_timestamp asc").first()
+        pr_q = model.Session.query(model.PackageRevision, model.Revision)\
+            .filter(model.PackageRevision.id == pkg.id)\
+            .filter_by(state='active')\
+            .join(model.Revision)\
+            .filter(~model.Revision.author.in_(activity_system_authors)) \
+            .filter(~model.Revision.author.like(activity_system_author_template))
+        rr_q = model.Session.query(model.Package, model.ResourceRevision, model.Revision)\
+            .filter(model.Package.id == pkg.id)\
+            .filter_by(state='active')\
+            .join(model.ResourceGroup)\
+            .join(model.ResourceRevision,
+                  model.ResourceGroup.id == model.ResourceRevision.resource_group_id)\
+            .join(model.Revision)\
+            .filter(~model.Revision.author.in_(activity_system_authors))\
+            .filter(~model.Revision.author.like(activity_system_author_template))
+        pe_q = model.Session.query(model.Package, model.PackageExtraRevision, model.Revision)\
+            .filter(model.Package.id == pkg.id)\
+            .filter_by(state='active')\
+            .join(model.PackageExtraRevision,
+                  model.Package.id == model.PackageExtraRevision.package_id)\
+            .join(model.Revision)\
+            .filter(~model.Revision.author.in_(activity_system_authors))\
+            .filter(~model.Revision.author.like(activity_system_author_template))
+        period_start = max(period[0], created_.revision_timestamp)
+        prs = pr_q.filter(model.PackageRevision.revision_timestamp > period_start)\
+                  .filter(model.PackageRevision.revision_timestamp < period[1])
+        rrs = rr_q.filter(model.ResourceRevision.revision_timestamp > period_start)\
+                  .filter(model.ResourceRevision.revision_timestamp < period[1])
+        pes = pe_q.filter(model.PackageExtraRevision.revision_timestamp > period_start)\
+                  .filter(model.PackageExtraRevision.revision_timestamp < period[1])
+        authors = set([r[1].author for r in prs] +
+                      [r[2].author for r in rrs] +
+                      [r[2].author for r in pes])
+        dates = set([r[1].timestamp.date() for r in prs] +
+                    [r[2].timestamp.date() for r in rrs] +
+                    [r[2].timestamp.date() for r in pes])
+        return authors, dates
+
+    def test_modified(self):
+        from ckan import model
+        from ckanext.dgu.lib import reports
+        pkg = model.Package.by_name(u'directgov-cota')
+        rev = model.repo.new_revision()
+        rev.author = u'resource-editor'
+        pkg.resources[0].description = u'Edited description'
+        model.repo.commit_and_remove()
+        pkg = model.Package.by_name(u'directgov-cota')
+        rev = model.repo.new_revision()
+        rev.author = u'extra-editor'
+        pkg.extras['edited-extra'] = u'value'
+        model.repo.commit_and_remove()
+        reports._activity_cache.clear()
+
+        created, modified = _get_activity(
+            'national-health-service', False, self.periods)
+
+        rows = dict((row[0], row) for row in modified['this'])
+        pkg = model.Package.by_name(u'directgov-cota')
+        authors, dates = self._old_modified_authors_and_dates(
+            pkg, self.periods['this'])
+        assert_equal(authors, set([u'resource-editor', u'extra-editor']))
+        row = rows['directgov-cota']
+        assert_equal(row[3], 'modified')
+        assert_equal(set(row[6].split(' ')), authors)
+        assert_equal(set(row[5].split(' ')),
+                     set(date.isoformat() for date in dates))
+
+    def test_index_counts_sub_publisher_with_two_parents(self):
+        from ckan import model
+        from ckanext.dgu.lib import reports
+        from ckanext.dgu.lib.publisher import invalidate_publisher_tree
+        # barnsley is under national-health-service - add cabinet-office as
+        # a second parent
+        barnsley = model.Group.by_name(u'barnsley-primary-care-trust')
+        cabinet_office = model.Group.by_name(u'cabinet-office')
+        model.repo.new_revision()
+        model.Session.add(model.Member(group=cabinet_office,
+                                       table_id=barnsley.id,
+                                       table_name='group', capacity='parent'))
+        model.repo.commit_and_remove()
+        invalidate_publisher_tree()
+        reports._activity_cache.clear()
+        try:
+            index = reports.publisher_activity(None, True)
+            rows = dict((row['organization name'], row)
+                        for row in index['table'])
+            for name in ('cabinet-office', 'national-health-service'):
+                assert_equal(rows[name]['num created'],
+                             len(self._dataset_names(name, True)))
+        finally:
+            model.repo.new_revision()
+            model.Session.query(model.Member) \
+                .filter_by(table_name='group', table_id=barnsley.id,
+                           group_id=cabinet_office.id) \
+                .delete()
+            model.repo.commit_and_remove()
+            invalidate_publisher_tree()
+
+    def test_all_organizations(self):
+        created, modified = _get_activity(None, False, self.periods)
+        from ckan import model
+        assert_equal(len(created['this']), model.Session.query(
+            model.Package).count())
+
+
+class TestReportScan(object):
+    @classmethod
+    def setup_class(cls):
+        from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        model.repo.rebuild_db()
+
+    def test_datasets_match_packages(self):
+        from ckan import model
+        from ckanext.dgu.lib.report_scan import iter_datasets
+        # small chunks, so there are several
+        datasets = list(iter_datasets(chunk_size=2))
+        pkgs = model.Session.query(model.Package) \
+                    .filter_by(state='active').all()
+        assert_equal(sorted(d.name for d in datasets),
+                     sorted(pkg.name for pkg in pkgs))
+        for dataset in datasets:
+            pkg = model.Package.get(dataset.id)
+            assert_equal(dataset.extras, pkg.extras)
+            assert_equal([res.id for res in dataset.resources],
+                         [res.id for res in pkg.resources])
+            org = pkg.get_organization()
+            assert_equal(dataset.organization_name, org.name if org else None)
+
+    def test_reports_share_a_scan(self):
+        from ckanext.dgu.lib import report_scan
+        from ckanext.dgu.lib.reports import (DatasetsOnlyInPdf,
+                                             DatasetLicences)
+        report_scan.clear_cache()
+        pdf_report = report_scan.get_report(DatasetsOnlyInPdf)
+        licence_report = report_scan.get_report(DatasetLicences)
+        assert report_scan.get_report(DatasetsOnlyInPdf) is pdf_report
+        assert_equal(
+            pdf_report.num_datasets_published,
+            sum(len(datasets)
+                for licences in licence_report.packages_by_org.values()
+                for datasets in licences.values()))
+
+
+class TestNiiBrokenResources(object):
+    @classmethod
+    def setup_class(cls):
+        from ckan import model
+        from ckanext.archiver.model import init_tables, Archival
+        from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+        DguCreateTestData.create_dgu_test_data()
+        init_tables(model.meta.engine)
+        resources = model.Session.query(model.Resource) \
+                         .filter_by(state='active') \
+                         .order_by(model.Resource.id).all()
+        for i, res in enumerate(resources):
+            model.Session.add(Archival(
+                package_id=res.resource_group.package_id,
+                resource_id=res.id, is_broken=(i % 2 == 0)))
+        # a broken resource that has since been deleted
+        model.repo.new_revision()
+        resources[0].state = 'deleted'
+        model.repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        model.repo.rebuild_db()
+
+    def _broken_resources_for_package(self, package_id):
+        '''The query nii_report used to make for each dataset'''
+        from ckan import model
+        from ckanext.archiver.model import Archival
+        results = model.Session.query(Archival, model.Resource)\
+                       .filter(Archival.package_id == package_id)\
+                       .filter(Archival.is_broken == True)\
+                       .join(model.Package, Archival.package_id == model.Package.id)\
+                       .filter(model.Package.state == 'active')\
+                       .join(model.Resource, Archival.resource_id == model.Resource.id)\
+                       .filter(model.Resource.state == 'active')
+        return [(resource.description, resource.id)
+                for archival, resource in results.all()]
+
+    def test_same_as_per_package_query(self):
+        from ckan import model
+        from ckanext.dgu.lib.reports import nii_broken_resources
+        package_ids = [row[0] for row in
+                       model.Session.query(model.Package.id)
+                       .filter_by(state='active')]
+
+        broken_resources = nii_broken_resources(package_ids)
+
+        assert_equal(sorted(broken_resources.keys()), sorted(package_ids))
+        assert any(broken_resources.values())
+        for package_id in package_ids:
+            assert_equal(sorted(broken_resources[package_id]),
+                         sorted(self._broken_resources_for_package(package_id)))
+
+
+class TestLicenceReport(object):
+    @classmethod
+    def setup_class(cls):
+        from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+        from ckanext.dgu.lib import report_scan
+        DguCreateTestData.create_dgu_test_data()
+        report_scan.clear_cache()
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        model.repo.rebuild_db()
+
+    def _dataset_names(self, report):
+        return sorted(name for row in report['table']
+                      for name in row['dataset_names'].split(' '))
+
+    def test_sub_organizations(self):
+        from ckanext.dgu.lib.reports import licence_report
+        report = licence_report('dept-health', include_sub_organizations=True)
+        assert 'nhs-spend-over-25k-barnsleypct' in self._dataset_names(report)
+        report = licence_report('dept-health', include_sub_organizations=False)
+        assert 'nhs-spend-over-25k-barnsleypct' not in \
+            self._dataset_names(report)
+
+    def test_sub_organization_with_two_parents(self):
+        from ckan import model
+        from ckanext.dgu.lib.publisher import invalidate_publisher_tree
+        from ckanext.dgu.lib.reports import licence_report
+        # barnsley is under national-health-service - add cabinet-office as
+        # a second parent
+        barnsley = model.Group.by_name(u'barnsley-primary-care-trust')
+        cabinet_office = model.Group.by_name(u'cabinet-office')
+        model.repo.new_revision()
+        model.Session.add(model.Member(group=cabinet_office,
+                                       table_id=barnsley.id,
+                                       table_name='group', capacity='parent'))
+        model.repo.commit_and_remove()
+        invalidate_publisher_tree()
+        try:
+            report = licence_report('cabinet-office',
+                                    include_sub_organizations=True)
+            names = self._dataset_names(report)
+            assert 'nhs-spend-over-25k-barnsleypct' in names, names
+            assert 'cabinet-office-energy-use' in names, names
+        finally:
+            model.repo.new_revision()
+            model.Session.query(model.Member) \
+                .filter_by(table_name='group', table_id=barnsley.id,
+                           group_id=cabinet_office.id) \
+                .delete()
+            model.repo.commit_and_remove()
+            invalidate_publisher_tree()
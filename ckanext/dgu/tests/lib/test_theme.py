@@ -3,8 +3,11 @@ import os.path
 from nose.tools import assert_equal
 
 from ckan import model
+from ckan.lib.create_test_data import CreateTestData
 from ckanext.dgu.lib.theme import (categorize_package, categorize_package2,
-                                   normalize_token)
+                                   normalize_token, categorize_packages,
+                                   write_themes_in_bulk, count_topics,
+                                   english_stopwords)
 from ckanext.taxonomy.models import init_tables
 from ckanext.taxonomy import lib
 
@@ -108,6 +111,130 @@ class TestCategorizePackage2(ThemeTestBase):
         assert_equal(set(('Business & Economy',)), set(theme_names))
 
 
+class TestCategorizePackages(ThemeTestBase):
+    @classmethod
+    def setup_class(cls):
+        super(TestCategorizePackages, cls).setup_class()
+        CreateTestData.create_arbitrary([
+            {'name': 'fish', 'title': 'fishing in the river', 'notes': 'Fish',
+             'tags': ['angling']},
+            {'name': 'spend', 'title': 'Spend', 'notes': 'transactions'},
+            ])
+
+    def test_same_as_categorize_package2(self):
+        pkgs = [model.Package.by_name(u'fish'), model.Package.by_name(u'spend')]
+        results = list(categorize_packages([pkg.id for pkg in pkgs]))
+        assert_equal([pkg_dict['name'] for pkg_dict, themes in results],
+                     ['fish', 'spend'])
+        for pkg, (pkg_dict, themes) in zip(pkgs, results):
+            assert_equal(themes, categorize_package2(pkg))
+
+
+class TestWriteThemesInBulk(object):
+    @classmethod
+    def setup_class(cls):
+        CreateTestData.create_arbitrary([
+            {'name': 'themed', 'title': 'Themed',
+             'extras': {'theme-primary': 'Health'}},
+            {'name': 'unthemed', 'title': 'Unthemed'},
+            ])
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_write(self):
+        themed_id = model.Package.by_name(u'themed').id
+        unthemed_id = model.Package.by_name(u'unthemed').id
+
+        write_themes_in_bulk(
+            {themed_id: [{'name': 'Environment'}],
+             unthemed_id: [{'name': 'Society'}, {'name': 'Health'}]},
+            author='test-autotheme')
+
+        themed = model.Package.get(themed_id)
+        assert_equal(themed.extras.get('theme-primary'), 'Environment')
+        assert 'theme-secondary' not in themed.extras
+        unthemed = model.Package.get(unthemed_id)
+        assert_equal(unthemed.extras.get('theme-primary'), 'Society')
+        assert_equal(unthemed.extras.get('theme-secondary'), '["Health"]')
+        rev = model.Session.query(model.Revision) \
+            .filter_by(author='test-autotheme').one()
+        assert_equal(rev.message, 'Set themes automatically')
+        extra_revisions = model.Session.query(model.PackageExtraRevision) \
+            .filter_by(revision_id=rev.id)
+        assert_equal(sorted((extra_rev.package_id, extra_rev.key,
+                             extra_rev.value)
+                            for extra_rev in extra_revisions),
+                     sorted([(themed_id, 'theme-primary', 'Environment'),
+                             (unthemed_id, 'theme-primary', 'Society'),
+                             (unthemed_id, 'theme-secondary', '["Health"]')]))
+
+
+class FakeThemes(object):
+    '''Has the topic attributes of Themes that count_topics uses.'''
+    def __init__(self, words, bigrams, trigrams):
+        self.topic_words = dict((word, ['Theme']) for word in words)
+        self.topic_bigrams = dict((bigram, ['Theme']) for bigram in bigrams)
+        self.topic_trigrams = dict((trigram, ['Theme'])
+                                   for trigram in trigrams)
+        self.topic_first_words = frozenset(
+            ngram[0] for ngram in bigrams + trigrams)
+
+
+class TestCountTopics(object):
+    def _count_ngram_lists(self, words, themes):
+        '''Counts the topics as score_by_topic used to, by listing the
+        n-grams and counting each match in the list'''
+        from nltk.util import bigrams, trigrams
+        stopwords_ = english_stopwords()
+        counts = []
+        for ngrams, topic_ngrams in (
+                ([word for word in words if word not in stopwords_],
+                 themes.topic_words),
+                (list(bigrams(words)), themes.topic_bigrams),
+                (list(trigrams(words)), themes.topic_trigrams)):
+            counts.append(dict((ngram, ngrams.count(ngram))
+                               for ngram in set(ngrams) & set(topic_ngrams)))
+        return tuple(counts)
+
+    def _assert_counts(self, words, themes, expected):
+        counts = count_topics(words, themes)
+        assert_equal(counts, expected)
+        assert_equal(counts, self._count_ngram_lists(words, themes))
+
+    def test_repeated(self):
+        themes = FakeThemes(['road'], [('road', 'traffic')], [])
+        self._assert_counts(
+            ['road', 'traffic', 'and', 'road', 'traffic', 'road'], themes,
+            ({'road': 3}, {('road', 'traffic'): 2}, {}))
+
+    def test_overlapping(self):
+        themes = FakeThemes(
+            ['traffic'], [('road', 'traffic'), ('traffic', 'accid'),
+                          ('bus', 'bus')],
+            [('road', 'traffic', 'accid')])
+        self._assert_counts(
+            ['road', 'traffic', 'accid', 'bus', 'bus', 'bus'], themes,
+            ({'traffic': 1},
+             {('road', 'traffic'): 1, ('traffic', 'accid'): 1,
+              ('bus', 'bus'): 2},
+             {('road', 'traffic', 'accid'): 1}))
+
+    def test_stopword_in_ngram(self):
+        themes = FakeThemes(['of', 'cost'], [('cost', 'of')],
+                            [('cost', 'of', 'live')])
+        self._assert_counts(
+            ['cost', 'of', 'live', 'cost', 'of'], themes,
+            ({'cost': 2}, {('cost', 'of'): 2}, {('cost', 'of', 'live'): 1}))
+
+    def test_ngram_at_end(self):
+        themes = FakeThemes([], [('road', 'traffic')],
+                            [('road', 'traffic', 'accid')])
+        self._assert_counts(['road', 'traffic'], themes,
+                            ({}, {('road', 'traffic'): 1}, {}))
+
+
 class TestNormalizeToken(object):
     def test_no_change(self):
         assert_equal(normalize_token('fish'), 'fish')
@@ -0,0 +1,36 @@
+from nose.tools import assert_equal
+
+from ckan import model
+import ckanext.dgu.model.schema_codelist as schema_model
+from ckanext.dgu.model.schema_codelist import Schema
+import ckanext.dgu.tests.factories as dgu_factories
+
+
+class TestSchemaCache(object):
+    @classmethod
+    def setup_class(cls):
+        schema_model.init_tables(model.meta.engine)
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_cached_dict(self):
+        schema = dgu_factories.SchemaObj(title='cached schema')
+
+        assert_equal(Schema.cached_dict(schema.id)['title'], 'cached schema')
+
+    def test_cached_dict_unknown_id(self):
+        assert_equal(Schema.cached_dict('unknown-id'), None)
+
+    def test_added_by_another_process(self):
+        dgu_factories.SchemaObj(title='existing schema')
+        Schema.cached_list()  # warm the cache
+        # insert without the ORM, so this process's cache is not cleared
+        model.Session.execute(Schema.__table__.insert().values(
+            id=u'new-schema-id', url=u'http://new-schema',
+            title=u'new schema'))
+        model.repo.commit_and_remove()
+
+        assert_equal(Schema.cached_title(u'new-schema-id'), 'new schema')
+        assert u'new schema' in [s['title'] for s in Schema.cached_list()]
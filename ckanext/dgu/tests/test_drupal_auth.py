@@ -1,11 +1,14 @@
 import time
 import datetime
+import threading
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 
 from ckan import model
 
 from ckanext.dgu.authentication.drupal_auth import DrupalAuthMiddleware
+from ckanext.dgu.authentication.drupal_session_cache import DrupalSessionCache
+from ckanext.dgu.drupalclient import DrupalRequestError
 from ckanext.dgu.tests import MockDrupalCase
 
 class TestCookie:
@@ -189,3 +192,68 @@ class TestDrupalAuthMiddleware(MockDrupalCase):
 
     #TODO: test when you were signed in as user A and then logout and sign in
     #      as user B without a clear a request to CKAN in between.
+
+
+class TestDrupalSessionCache:
+    def setup(self):
+        self.lookups = []
+
+    def lookup(self, session_id):
+        self.lookups.append(session_id)
+        if session_id == 'invalid':
+            return None
+        return {'uid': '62', 'session': session_id}
+
+    def test_cached(self):
+        cache = DrupalSessionCache()
+        assert_equal(cache.get_user_properties('abc', self.lookup)['uid'], '62')
+        assert_equal(cache.get_user_properties('abc', self.lookup)['uid'], '62')
+        assert_equal(self.lookups, ['abc'])
+
+    def test_invalid_session_cached(self):
+        cache = DrupalSessionCache()
+        assert_equal(cache.get_user_properties('invalid', self.lookup), None)
+        assert_equal(cache.get_user_properties('invalid', self.lookup), None)
+        assert_equal(self.lookups, ['invalid'])
+
+    def test_expiry(self):
+        cache = DrupalSessionCache(ttl=-1, negative_ttl=-1)
+        cache.get_user_properties('abc', self.lookup)
+        cache.get_user_properties('abc', self.lookup)
+        assert_equal(self.lookups, ['abc', 'abc'])
+
+    def test_least_recently_used_dropped(self):
+        cache = DrupalSessionCache(max_size=2)
+        for session_id in ('a', 'b', 'a', 'c', 'a', 'b'):
+            cache.get_user_properties(session_id, self.lookup)
+        assert_equal(self.lookups, ['a', 'b', 'c', 'b'])
+
+    def test_error_not_cached(self):
+        cache = DrupalSessionCache()
+        def failing_lookup(session_id):
+            raise DrupalRequestError('Drupal down')
+        assert_raises(DrupalRequestError, cache.get_user_properties,
+                      'abc', failing_lookup)
+        cache.get_user_properties('abc', self.lookup)
+        assert_equal(self.lookups, ['abc'])
+
+    def test_concurrent_lookups_done_once(self):
+        cache = DrupalSessionCache()
+        started = threading.Event()
+        def slow_lookup(session_id):
+            started.set()
+            time.sleep(0.2)
+            return self.lookup(session_id)
+        results = []
+        def get():
+            results.append(cache.get_user_properties('abc', slow_lookup))
+        threads = [threading.Thread(target=get)]
+        threads[0].start()
+        started.wait()
+        threads += [threading.Thread(target=get) for i in range(5)]
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(self.lookups, ['abc'])
+        assert_equal(len(results), 6)
@@ -3,7 +3,8 @@ from nose.tools import assert_equal, assert_raises
 
 from ckanext.dgu.tests import MockDrupalCase
 from ckanext.dgu.testtools.mock_drupal import get_mock_drupal_config, MOCK_DRUPAL_URL
-from ckanext.dgu.drupalclient import DrupalClient, DrupalKeyError
+from ckanext.dgu.drupalclient import DrupalClient, DrupalKeyError, CircuitBreaker, \
+     rest_metric_path
 
 class TestDrupalConnection(MockDrupalCase):
 
@@ -61,3 +62,57 @@ class TestDrupalConnection(MockDrupalCase):
         assert_raises(DrupalKeyError, client.get_department_from_organisation, '')
         assert_raises(DrupalKeyError, client.get_department_from_organisation, None)
         
+
+
+class TestCircuitBreaker:
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(max_failures=2, reset_seconds=60)
+        breaker.record_failure()
+        assert not breaker.is_open()
+        breaker.record_failure()
+        assert breaker.is_open()
+
+    def test_success_resets(self):
+        breaker = CircuitBreaker(max_failures=2, reset_seconds=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert not breaker.is_open()
+
+    def test_lets_a_call_through_after_reset_time(self):
+        breaker = CircuitBreaker(max_failures=2, reset_seconds=-1)
+        breaker.record_failure()
+        breaker.record_failure()
+        assert not breaker.is_open()
+        # but one more failure opens it again
+        breaker.record_failure()
+        assert breaker.opened_at
+
+    def test_lets_only_one_call_through_until_it_succeeds(self):
+        breaker = CircuitBreaker(max_failures=2, reset_seconds=60)
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.opened_at -= 61
+        assert not breaker.is_open()
+        # the other callers wait for the trial call
+        assert breaker.is_open()
+        breaker.record_success()
+        assert not breaker.is_open()
+
+    def test_trial_call_fails(self):
+        breaker = CircuitBreaker(max_failures=2, reset_seconds=60)
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.opened_at -= 61
+        assert not breaker.is_open()
+        breaker.record_failure()
+        assert breaker.is_open()
+
+
+class TestRestMetricPath:
+    def test_ids_replaced(self):
+        assert_equal(rest_metric_path('/node/123'), '/node/:id')
+        assert_equal(rest_metric_path('/organogram/4f2a9c1e-77'),
+                     '/organogram/:id')
+        assert_equal(rest_metric_path('/views/dataset_referrers'),
+                     '/views/dataset_referrers')
@@ -1,4 +1,4 @@
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 
 import ckan.new_tests.factories as factories
 import ckan.new_tests.helpers as helpers
@@ -10,6 +10,9 @@ from ckanext.dgu.gemini_postprocess import (
     wms_capabilities_url,
     _wms_base_urls,
     strip_session_id,
+    capabilities_cache_key,
+    ProbeCache,
+    resource_fingerprint,
     )
 
 
@@ -57,6 +60,73 @@ class TestStripSessionId(object):
         )
 
 
+class TestCapabilitiesCacheKey(object):
+    def test_layer_params_removed(self):
+        assert_equal(capabilities_cache_key(
+            'http://example.com/wms?LAYERS=roads&service=WMS&request=GetCapabilities'),
+            'http://example.com/wms?service=WMS&request=GetCapabilities')
+
+    def test_other_params_kept(self):
+        url = 'http://environment.data.gov.uk/ds/wms?SERVICE=WMS&INTERFACE=ENVIRONMENT--6f51a299-351f-4e30-a5a3-2511da9688f7&request=GetCapabilities'
+        assert_equal(capabilities_cache_key(url), url)
+
+
+class TestProbeCache(object):
+    def test_value_cached(self):
+        cache = ProbeCache(ttl=60)
+        calls = []
+        def compute():
+            calls.append(1)
+            return 'xml'
+        assert_equal(cache.get('url', compute), 'xml')
+        assert_equal(cache.get('url', compute), 'xml')
+        assert_equal(len(calls), 1)
+
+    def test_error_cached(self):
+        cache = ProbeCache(ttl=60)
+        calls = []
+        def compute():
+            calls.append(1)
+            raise ValueError('timeout')
+        assert_raises(ValueError, cache.get, 'url', compute)
+        assert_raises(ValueError, cache.get, 'url', compute)
+        assert_equal(len(calls), 1)
+
+    def test_error_expires_sooner(self):
+        cache = ProbeCache(ttl=60, error_ttl=-1)
+        calls = []
+        def compute():
+            calls.append(1)
+            raise ValueError('timeout')
+        assert_raises(ValueError, cache.get, 'url', compute)
+        assert_raises(ValueError, cache.get, 'url', compute)
+        assert_equal(len(calls), 2)
+
+    def test_expires(self):
+        cache = ProbeCache(ttl=-1)
+        calls = []
+        def compute():
+            calls.append(1)
+            return 'xml'
+        cache.get('url', compute)
+        cache.get('url', compute)
+        assert_equal(len(calls), 2)
+
+
+class TestResourceFingerprint(object):
+    def test_order_does_not_matter(self):
+        assert_equal(resource_fingerprint([('a', 'http://a'), ('b', 'http://b')]),
+                     resource_fingerprint([('b', 'http://b'), ('a', 'http://a')]))
+
+    def test_url_change(self):
+        assert resource_fingerprint([('a', 'http://a')]) != \
+            resource_fingerprint([('a', 'http://a2')])
+
+    def test_added_resource(self):
+        assert resource_fingerprint([('a', 'http://a')]) != \
+            resource_fingerprint([('a', 'http://a'), ('b', 'http://a')])
+
+
 class TestWmsBaseUrls(object):
     def test_ea(self):
         # https://data.gov.uk/dataset/lidar-composite-dsm-1m1
@@ -30,3 +30,16 @@ class TestResourceFormatCleanup:
     #def test_ical(self): self.assert_format_clean('ical', 'iCal')
     def test_shapefile(self): self.assert_format_clean('shapefile', 'SHP')
     def test_sql(self): self.assert_format_clean('sql', 'Database')
+
+
+class TestXmlText:
+    def test_text_extracted(self):
+        xml = '<doc><title>Bus  stops</title>\n<abstract>All the bus stops</abstract></doc>'
+        assert_equal(SearchIndexing._xml_text(xml), 'Bus stops All the bus stops')
+
+    def test_unicode(self):
+        xml = u'<?xml version="1.0" encoding="UTF-8"?><doc><title>Caf\xe9s</title></doc>'
+        assert_equal(SearchIndexing._xml_text(xml), u'Caf\xe9s')
+
+    def test_invalid_xml_unchanged(self):
+        assert_equal(SearchIndexing._xml_text('not <xml'), 'not <xml')
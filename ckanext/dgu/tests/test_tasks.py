@@ -0,0 +1,157 @@
+from nose.tools import assert_equal
+
+from ckanext.dgu.tasks import (unique_package_names, UploadProgress,
+                               ingest_inventory_file)
+
+
+class TestUniquePackageNames(object):
+    def test_free(self):
+        assert_equal(unique_package_names([u'Road Traffic'],
+                                          lambda names: set(), set()),
+                     {u'road traffic': u'road-traffic'})
+
+    def test_taken(self):
+        taken = set([u'road-traffic', u'road-traffic_1'])
+        assert_equal(unique_package_names([u'Road Traffic'],
+                                          lambda names: names & taken, set()),
+                     {u'road traffic': u'road-traffic_2'})
+
+    def test_many_taken(self):
+        taken = set([u'road-traffic'] +
+                    [u'road-traffic_%s' % i for i in range(1, 15)])
+        queries = []
+        def names_taken(names):
+            queries.append(names)
+            return names & taken
+        assert_equal(unique_package_names([u'Road Traffic'], names_taken,
+                                          set(), candidates_per_query=10),
+                     {u'road traffic': u'road-traffic_15'})
+        assert_equal(len(queries), 2)
+
+    def test_used_names_avoided(self):
+        used = set([u'road-traffic'])
+        assert_equal(unique_package_names([u'Road Traffic', u'Rail'],
+                                          lambda names: set(), used),
+                     {u'road traffic': u'road-traffic_1', u'rail': u'rail'})
+        assert_equal(used, set([u'road-traffic', u'road-traffic_1', u'rail']))
+
+    def test_one_query_for_all_titles(self):
+        queries = []
+        def names_taken(names):
+            queries.append(names)
+            return set()
+        unique_package_names([u'A title', u'B title', u'C title'],
+                             names_taken, set())
+        assert_equal(len(queries), 1)
+
+
+class TestUploadProgress(object):
+    def test_resume(self):
+        progress = UploadProgress('job', 10, rows_done=4,
+                                  errors=['Row 3: bad'],
+                                  results=[{'package': 'a', 'action': 'Added'}])
+        resumed = UploadProgress.resume('job', 10, progress.as_dict())
+        assert_equal(resumed.rows_done, 4)
+        assert_equal(resumed.errors, ['Row 3: bad'])
+        assert_equal(resumed.results, [{'package': 'a', 'action': 'Added'}])
+        assert_equal(resumed.resumed_from, 4)
+
+    def test_resume_nothing_saved(self):
+        assert_equal(UploadProgress.resume('job', 10, None).rows_done, 0)
+
+    def test_resume_different_file(self):
+        saved = UploadProgress('job', 10, rows_done=4).as_dict()
+        assert_equal(UploadProgress.resume('job', 12, saved).rows_done, 0)
+
+    def test_as_dict(self):
+        progress = UploadProgress('job', 10, results=[
+            {'package': 'a', 'action': 'Added'},
+            {'package': 'b', 'action': 'Updated'},
+            {'package': 'c', 'action': 'Added'}])
+        progress.rows_done = 3
+        progress._run_started -= 3  # 3 rows took 3 seconds
+        progress_dict = progress.as_dict()
+        assert_equal(progress_dict['added'], 2)
+        assert_equal(progress_dict['updated'], 1)
+        assert_equal(round(progress_dict['rows_per_second']), 1)
+        assert 6 <= progress_dict['eta_seconds'] <= 7
+        assert_equal(progress.task_status()['state'], 'Running')
+        progress.rows_done = 10
+        assert_equal(progress.task_status()['state'], 'Finished')
+
+
+class TestIngestInventoryFile(object):
+    @classmethod
+    def setup_class(cls):
+        from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        model.repo.rebuild_db()
+
+    def _ingest(self, csv):
+        import os
+        import logging
+        import tempfile
+        from ckan.model.types import make_uuid
+        fd, filepath = tempfile.mkstemp(suffix='.csv')
+        try:
+            os.write(fd, csv)
+            os.close(fd)
+            return ingest_inventory_file(
+                {'username': 'co_admin'},
+                {'file': filepath, 'jobid': make_uuid()},
+                logging.getLogger(__name__), batch_size=2)
+        finally:
+            os.remove(filepath)
+
+    def test_create_and_update(self):
+        from ckan import model
+        errors, results = self._ingest(
+            'Title,Description,Owner,Publish date,Release notes\n'
+            'Inventory One,First,Cabinet Office,1/2/2014,Soon\n'
+            'Inventory Two,Second,Cabinet Office,,Later\n'
+            'Inventory One,First again,Cabinet Office,1/3/2014,Sooner\n'
+            'Inventory Three,Third,No Such Publisher,,\n')
+        assert_equal(errors, ['Row 5 (Inventory Three): Publisher does not '
+                              'exist in data.gov.uk: "No Such Publisher"'])
+        assert_equal([result['action'] for result in results],
+                     ['Added', 'Added', 'Updated'])
+
+        pkg = model.Package.by_name(u'inventory-one')
+        assert_equal(pkg.id, results[0]['package'])
+        assert_equal(pkg.notes, 'First again')
+        assert_equal(pkg.license_id, 'unpublished')
+        assert_equal(pkg.owner_org, model.Group.by_name('cabinet-office').id)
+        assert_equal(pkg.extras['publish-date'], '2014-03-01')
+        assert_equal(pkg.extras['release-notes'], 'Sooner')
+        assert pkg.extras['unpublished']
+        pkg = model.Package.by_name(u'inventory-two')
+        assert_equal(pkg.extras['publish-date'], '')
+        assert_equal(pkg.extras['release-notes'], 'Later')
+
+    def test_created_date_matches_updated_date(self):
+        from ckan import model
+        errors, results = self._ingest(
+            'Title,Description,Owner,Publish date,Release notes\n'
+            'Inventory Four,Fourth,Cabinet Office,1/2/2014,\n')
+        assert_equal(errors, [])
+        pkg = model.Package.get(results[0]['package'])
+        assert_equal(pkg.extras['publish-date'], '2014-02-01')
+
+        errors, results = self._ingest(
+            'Title,Description,Owner,Publish date,Release notes\n'
+            'Inventory Four,Fourth,Cabinet Office,1/2/2014,\n')
+        assert_equal(errors, [])
+        assert_equal(results[0]['action'], 'Updated')
+        assert_equal(model.Package.get(results[0]['package'])
+                     .extras['publish-date'], '2014-02-01')
+
+    def test_existing_published_title(self):
+        errors, results = self._ingest(
+            'Title,Description,Owner,Publish date,Release notes\n'
+            'Cabinet Office 70 Whitehall energy use,x,Cabinet Office,,\n')
+        assert_equal(results, [])
+        assert 'already exists' in errors[0], errors
@@ -90,6 +90,8 @@ setup(
         check_publisher_requests = ckanext.dgu.commands.check_publisher_requests:CheckRequests
         publisher_request_init = ckanext.dgu.commands.publisher_request_init:InitDB
         schema = ckanext.dgu.commands.schema:Schema
+        search_index = ckanext.dgu.commands.search_index:SearchIndex
+        publisher_metrics = ckanext.dgu.commands.publisher_metrics:PublisherMetricsCommand
         user_sync = ckanext.dgu.commands.user_sync:UserSync
         updated_harvested_schema = ckanext.dgu.commands.update_harvested_schema:UpdateHarvestedSchema
     """,